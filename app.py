@@ -1,9 +1,37 @@
-from flask import Flask, render_template, redirect, url_for, request, jsonify
+from flask import Flask, render_template, redirect, url_for, request, jsonify, g, Response, stream_with_context
 import psycopg2
+import ipaddress
+import re
+import time
+import metrics
+from datetime import datetime
 from scanner import scanner, Scanner
+from scheduler import RefreshScheduler
+from jobs import JobManager
+from export import iter_export, CONTENT_TYPES
 
 app = Flask(__name__)
 
+refresh_scheduler = RefreshScheduler(scanner)
+if scanner.refresh_in_app:
+    refresh_scheduler.start()
+
+jobs = JobManager(scanner)
+
+metrics.REGISTRY.callback('scanner_response_cache_hits_total', "Provider responses served from the memory cache.",
+                          'counter', lambda: scanner.response_cache.stats()['hits'])
+metrics.REGISTRY.callback('scanner_response_cache_misses_total', "Provider responses missing from the memory cache.",
+                          'counter', lambda: scanner.response_cache.stats()['misses'])
+metrics.REGISTRY.callback('scanner_response_cache_disk_hits_total', "Provider responses served from the disk cache.",
+                          'counter', lambda: scanner.response_cache.stats()['disk_hits'])
+metrics.REGISTRY.callback('scanner_response_cache_bytes', "Size of the provider responses held in memory.",
+                          'gauge', lambda: scanner.response_cache.stats()['bytes'])
+if scanner.summary_cache is not None:
+    metrics.REGISTRY.callback('scanner_summary_cache_hits_total', "Summaries served from the result cache.",
+                              'counter', lambda: scanner.summary_cache.stats()['hits'])
+    metrics.REGISTRY.callback('scanner_summary_cache_misses_total', "Summaries read from the database.",
+                              'counter', lambda: scanner.summary_cache.stats()['misses'])
+
 
 # Decorator checking the existence of a database.
 def check_db_exists(func):
@@ -27,15 +55,115 @@ def check_db_not_exists(func):
     return wrapper
 
 
+# Every request is timed. With 'query_metrics' enabled its SQL statements are counted as well.
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.start_query_tracking()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                                         endpoint=endpoint, method=request.method, status=response.status_code)
+
+    query_stats = metrics.finish_query_tracking()
+    if scanner.query_metrics and query_stats is not None:
+        queries, seconds = query_stats
+        metrics.HTTP_REQUEST_DB_QUERIES.observe(queries, endpoint=endpoint)
+        metrics.HTTP_REQUEST_DB_SECONDS.observe(seconds, endpoint=endpoint)
+
+    return response
+
+
+# Every request works on its own pooled connection. Hand it back once the request is done.
+@app.teardown_request
+def release_db_connection(exc):
+    scanner.release_connection()
+
+
+# Builds a select filter from the fields of the filter search form. Returns the filter and the values it
+# rejected. Rejected values are left out, so a filter made of them alone selects every host.
+def filter_from_form(form):
+    filtr = Scanner.select_filter()
+    invalid_values = []
+
+    onion_routing = form.get('tor')
+    filtr.set_onion_routing_filter(onion_routing == 'on')
+
+    ip = form.get('ipAddressHidden', '')
+    port = form.get('portHidden', '')
+    country = form.get('countryHidden', '')
+    network = form.get('networkHidden', '')
+    asn = form.get('asnHidden', '')
+
+    for element in port.split(','):
+        if element and not (element.strip().isdigit() and filtr.add_port_to_filter(int(element))):
+            invalid_values.append(element)
+    
+    for element in ip.split(','):
+        if element and not filtr.add_ip_to_filter(element):
+            invalid_values.append(element)
+
+    # A network is given either in CIDR notation or as a 'first-last' range of addresses
+    for element in network.split(','):
+        if '-' in element:
+            first, _, last = element.partition('-')
+            added = filtr.add_range_to_filter(first, last)
+        elif element:
+            added = filtr.add_network_to_filter(element)
+        else:
+            continue
+        if not added:
+            invalid_values.append(element)
+
+    for element in country.split(','):
+        if element and not filtr.add_country_to_filter(element):
+            invalid_values.append(element)
+
+    for element in asn.split(','):
+        if element and not filtr.add_asn_to_filter(element):
+            invalid_values.append(element)
+
+    return filtr, invalid_values
+
+
+# Moment of a history query, from a 'datetime-local' field or an ISO 8601 argument. None when not given.
+def as_of_from_form(form, field):
+    value = form.get(field, '').strip()
+    if not value:
+        return None
+
+    return datetime.fromisoformat(value)
+
+
+# Splits raw strings into unique valid IP-addresses and rejected ones, keeping the order.
+def parse_ip_list(raw_addrs):
+    ip_addrs = dict()
+    invalid_addrs = []
+    for raw_addr in raw_addrs:
+        raw_addr = str(raw_addr).strip()
+        if not raw_addr:
+            continue
+        try:
+            ip_addrs[str(ipaddress.ip_address(raw_addr))] = None
+        except ValueError:
+            invalid_addrs.append(raw_addr)
+
+    return list(ip_addrs), invalid_addrs
+
+
 # Main page
 @app.route('/', endpoint='index')
 @check_db_exists
 def index():
-    data = scanner.get_all_summary()
+    after = request.args.get('after')
+    data, next_after = scanner.get_filtered_summary_page(Scanner.select_filter(), after)
     if data is None:
         data = []
 
-    return render_template('index.html', data=data)
+    return render_template('index.html', data=data, after=after, next_after=next_after)
 
 
 # Database creation page.
@@ -59,6 +187,8 @@ def delete_db():
     if request.method == 'GET':
         return render_template('delete_db.html')
     if request.method == 'POST':
+        # The session holding the job locks would keep the database from being dropped
+        jobs.close()
         status = scanner.drop_database()
         #status = True
         if status:
@@ -85,20 +215,98 @@ def ip_search():
     return render_template('ip_search.html', message=message)
 
 
+# Bulk search by IP-addresses page. Addresses come from the form, an uploaded text file or a JSON list.
+@app.route('/bulk_ip_search', methods=['GET', 'POST'], endpoint='bulk_ip_search')
+@check_db_exists
+def bulk_ip_search():
+    message = None
+    job_id = None
+    if request.method == 'POST':
+        if request.is_json:
+            raw_addrs = request.json.get('ip_addrs', [])
+        else:
+            raw_text = request.form.get('ipAddresses', '')
+            ip_file = request.files.get('ipFile')
+            if ip_file:
+                raw_text += '\n' + ip_file.read().decode('utf-8', errors='ignore')
+            raw_addrs = re.split(r'[\s,;]+', raw_text)
+
+        ip_addrs, invalid_addrs = parse_ip_list(raw_addrs)
+
+        # The lookups run as a job, its result is polled from '/jobs/<id>'
+        def search(progress):
+            return {"addresses": len(ip_addrs), "relays": scanner.fetch_hosts_info_from_tor(ip_addrs, progress)}
+        job_id = jobs.submit('bulk_ip_search', search, len(ip_addrs))
+
+        if request.is_json:
+            return jsonify({"status": True, "addresses": len(ip_addrs), "invalid": invalid_addrs, "job_id": job_id})
+
+        message = f"Проверка {len(ip_addrs)} адресов запущена."
+        if invalid_addrs:
+            message += f" Пропущены некорректные адреса: {', '.join(invalid_addrs[:10])}"
+
+    return render_template('bulk_ip_search.html', message=message, job_id=job_id)
+
+
 # Search by IP-address page.
 @app.route('/mass_search', methods=['GET', 'POST'], endpoint='mass_search')
 @check_db_exists
 def mass_search():
     message = None
+    job_id = None
+    if request.method == 'POST' and request.form.get('source') == 'exit_list':
+        def refresh_exits(progress):
+            exits_count = scanner.refresh_exit_list(progress)
+            return {"exits": exits_count, "skipped": exits_count is None}
+        job_id = jobs.submit('exit_list_fetch', refresh_exits)
+
+        message = f"Загрузка списка выходных узлов запущена."
+
+    elif request.method == 'POST':
+        # A refresh already running in the scheduler or another job makes this one a no-op
+        def refresh(progress):
+            relays_count = scanner.refresh_onions(progress)
+            result = {"relays": relays_count, "skipped": relays_count is None}
+            if relays_count:
+                result["touched"] = scanner.last_ingest_stats['onion_routing_hosts']['touched']
+                result["unchanged"] = scanner.last_ingest_stats['onion_routing_hosts']['unchanged']
+            return result
+        job_id = jobs.submit('tor_fetch', refresh)
+
+        message = f"Обновление запущено."
+
+    return render_template('mass_search.html', message=message, job_id=job_id)
+
+
+# Point lookup for the abuse team: is the address a Tor exit? GET /is_tor_exit?ip=<address>
+@app.route('/is_tor_exit', methods=['GET'], endpoint='is_tor_exit')
+@check_db_exists
+def is_tor_exit():
+    raw_addr = request.args.get('ip', '').strip()
+    try:
+        ip_addr = str(ipaddress.ip_address(raw_addr))
+    except ValueError:
+        return jsonify({"status": False, "message": f"Некорректный IP-адрес '{raw_addr}'."}), 400
+
+    info = scanner.tor_exit_info(ip_addr)
+
+    return jsonify({"status": True, "ip_addr": ip_addr, "is_tor_exit": info is not None, "exit": info})
+
+
+# Shodan enrichment page. Looks up hosts that were never enriched before.
+@app.route('/shodan_search', methods=['GET', 'POST'], endpoint='shodan_search')
+@check_db_exists
+def shodan_search():
+    message = None
+    job_id = None
     if request.method == 'POST':
-        entries_updated = scanner.fetch_onions()
+        def enrich(progress):
+            return {"hosts": scanner.enrich_from_shodan(progress=progress)}
+        job_id = jobs.submit('shodan_fetch', enrich)
 
-        if entries_updated > 0:
-            message = f"Обновлено {entries_updated} вхождений."
-        else:
-            message = f"Информация не найдена."
+        message = f"Обновление запущено."
 
-    return render_template('mass_search.html', message=message)
+    return render_template('shodan_search.html', message=message, job_id=job_id)
 
 
 # Search by filters page.
@@ -106,31 +314,79 @@ def mass_search():
 @check_db_exists
 def filter_search():
     results = None
+    next_after = None
     if request.method == 'POST':
-        filtr = Scanner.select_filter()
+        filtr, _ = filter_from_form(request.form)
+        after = request.form.get('after') or None
+
+        try:
+            as_of = as_of_from_form(request.form, 'asOf')
+        except ValueError:
+            as_of = None
 
-        onion_routing = request.form.get('tor')
-        filtr.set_onion_routing_filter(onion_routing == 'on')
+        if as_of is None:
+            results, next_after = scanner.get_filtered_summary_page(filtr, after)
+        else:
+            results, next_after = scanner.get_filtered_summary_page_as_of(filtr, as_of, after)
 
-        ip = request.form.get('ipAddressHidden')
-        port = request.form.get('portHidden')
-        country = request.form.get('countryHidden')
+    return render_template('filter_search.html', results=results, next_after=next_after, form=request.form)
 
-        for element in port.split(','):
-            if element:
-                filtr.add_port_to_filter(int(element))
-        
-        for element in ip.split(','):
-            if element:
-                filtr.add_ip_to_filter(element)
 
-        for element in country.split(','):
-            if element:
-                filtr.add_country_to_filter(element)
+# Starts a job deleting the hosts passing the filter in one transaction.
+def submit_delete_hosts(filtr):
+    def delete(progress):
+        return {"hosts": scanner.delete_hosts(filtr)}
 
-        results = scanner.get_filtered_summary(filtr)
+    return jobs.submit('delete_hosts', delete)
+
+
+# Deletes every host found by the filter search form, not only the shown page. Only current hosts are deleted:
+# a search as of a past moment is refused, as its hosts are not the ones the filter would delete now.
+@app.route('/delete_filtered', methods=['POST'], endpoint='delete_filtered')
+@check_db_exists
+def delete_filtered():
+    if request.form.get('asOf', '').strip():
+        return jsonify({"status": False, "message": "Записи на прошедший момент времени не удаляются"})
+
+    # Without the rejected values the filter would select more hosts than asked for
+    filtr, invalid_values = filter_from_form(request.form)
+    if invalid_values:
+        return jsonify({"status": False, "message": f"Неверные значения фильтра: {', '.join(invalid_values)}"})
+
+    try:
+        job_id = submit_delete_hosts(filtr)
+    except Exception:
+        return jsonify({"status": False, "message": "Записи не удалены"})
+
+    return jsonify({"status": True, "message": "Удаление найденных записей запущено", "job_id": job_id})
+
+
+# Streams every host passing the filter as CSV, NDJSON or Parquet. Takes the fields of the filter search form
+# as query arguments, e.g. /export?format=ndjson&networkHidden=185.146.0.0/16&tor=on. Without 'tor'
+# both onion-routing hosts and the others are exported. With 'as_of' hosts are exported as they were then.
+@app.route('/export', methods=['GET'], endpoint='export')
+@check_db_exists
+def export():
+    format_ = request.args.get('format', 'csv')
+    if format_ not in CONTENT_TYPES:
+        return jsonify({"status": False, "message": f"Неизвестный формат '{format_}'"}), 400
 
-    return render_template('filter_search.html', results=results)
+    # Without the rejected values the filter would select more hosts than asked for, up to all of them
+    filtr, invalid_values = filter_from_form(request.args)
+    if invalid_values:
+        return jsonify({"status": False, "message": f"Неверные значения фильтра: {', '.join(invalid_values)}",
+                        "invalid": invalid_values}), 400
+
+    try:
+        filtr.set_onion_routing_filter({'on': True, 'off': False}.get(request.args.get('tor')))
+        chunks = iter_export(filtr, format_, as_of_from_form(request.args, 'as_of'))
+    except (ValueError, RuntimeError) as e:
+        return jsonify({"status": False, "message": str(e)}), 400
+
+    # Without a length the response is sent chunked. The request context, and with it the database
+    # connection of the request, is kept until the last chunk is sent.
+    headers = {'Content-Disposition': f'attachment; filename=hosts.{format_}'}
+    return Response(stream_with_context(chunks), content_type=CONTENT_TYPES[format_], headers=headers)
 
 
 # Function for deleting rows in filter_search page.
@@ -154,13 +410,29 @@ def clear_tables():
     if request.method == 'GET':
         return render_template('clear_tables.html')
     if request.method == 'POST':
-        status = scanner.clear_tables()
-
-        if status:
-            return jsonify({"status": True, "message": "Таблицы удалены"})
-        else:
+        def clear(progress):
+            if not scanner.clear_tables():
+                raise RuntimeError("Tables were not cleared")
+            return {"status": True}
+
+        try:
+            job_id = jobs.submit('clear_tables', clear)
+        except Exception:
             return jsonify({"status": False, "message": "Таблицы не удалены"})
 
+        return jsonify({"status": True, "message": "Удаление таблиц запущено", "job_id": job_id})
+
+
+# State of a background job, polled by the pages that started it.
+@app.route('/jobs/<int:job_id>', methods=['GET'], endpoint='job_status')
+@check_db_exists
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": False, "message": "Задача не найдена"}), 404
+
+    return jsonify(job)
+
 
 # Clear IP-address page.
 @app.route('/clear_ip', methods=['GET', 'POST'], endpoint='clear_ip')
@@ -169,12 +441,29 @@ def clear_ip():
     if request.method == 'GET':
         return render_template('clear_ip.html')
     if request.method == 'POST':
-        ip_address = request.json.get('ipAddress')
-        status = scanner.delete_host(ip_address)
-        if status:
-            return jsonify({"status": True, "message": "IP-адрес удален"})
-        else:
-            return jsonify({"status": False, "message": "IP-адрес не удален"})
+        # IP-addresses and CIDR networks, as a JSON list or as one string of them
+        raw_addrs = request.json.get('ip_addrs')
+        if raw_addrs is None:
+            raw_addrs = re.split(r'[\s,;]+', request.json.get('ipAddress', ''))
+
+        filtr, invalid_addrs = Scanner.filter_from_addresses(raw_addrs)
+        if invalid_addrs:
+            return jsonify({"status": False, "message": f"Некорректные адреса: {', '.join(invalid_addrs[:10])}"})
+        if filtr.is_empty():
+            return jsonify({"status": False, "message": "Не указаны адреса"})
+
+        try:
+            job_id = submit_delete_hosts(filtr)
+        except Exception:
+            return jsonify({"status": False, "message": "IP-адреса не удалены"})
+
+        return jsonify({"status": True, "message": "Удаление IP-адресов запущено", "job_id": job_id})
+
+
+# Metrics in the Prometheus text format.
+@app.route('/metrics', methods=['GET'], endpoint='metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+# Compares per-relay and bulk ingestion of Onionoo relays.
+# WARNING: clears all tables of the configured database. Point SCANNER_CONFIG to a throwaway one:
+#
+#     SCANNER_CONFIG=bench_config.json python -m benchmarks.bench_ingest --relays 10000 --exit-fanout 2
+
+import argparse
+import json
+import time
+
+from scanner import scanner
+from benchmarks.synthetic import generate_relays
+
+
+def _ingest(relays, bulk):
+    event_id = scanner._create_tor_fetch_event()
+
+    start = time.perf_counter()
+    if bulk:
+        scanner._bulk_update_onion_routing(relays, event_id)
+    else:
+        for relay in relays:
+            scanner._update_onion_routing(relay, event_id)
+    scanner.conn.commit()
+
+    return time.perf_counter() - start
+
+
+def run(relays_count, exit_fanout, seed=0):
+    relays = generate_relays(relays_count, exit_fanout, seed)
+    results = {'relays': relays_count, 'exit_fanout': exit_fanout}
+
+    for mode, bulk in (('per_row', False), ('bulk', True)):
+        scanner.clear_tables()
+        # First pass fills empty tables, second one rewrites the same relays like an hourly refresh does
+        results[mode] = {
+            'cold': _ingest(relays, bulk),
+            'warm': _ingest(relays, bulk),
+        }
+
+    scanner.clear_tables()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-relay vs bulk ingestion benchmark.")
+    parser.add_argument('--relays', type=int, default=10000)
+    parser.add_argument('--exit-fanout', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not scanner.db_connect():
+        print("Fail!")
+        exit(1)
+
+    results = run(args.relays, args.exit_fanout, args.seed)
+    for mode in ('per_row', 'bulk'):
+        for phase in ('cold', 'warm'):
+            seconds = results[mode][phase]
+            print(f"{mode:8} {phase}: {seconds:8.3f} s  ({args.relays / seconds:10.1f} relays/s)")
+    print(json.dumps(results))
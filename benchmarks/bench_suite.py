@@ -0,0 +1,203 @@
+# Ingestion and query benchmarks against synthetic Onionoo and Shodan data served by a local fake server.
+# For every dataset size the relays are fetched through 'fetch_onions' and then queried, enriched and deleted.
+# Results are written as JSON, one file per run, so they can be compared across commits.
+# WARNING: clears all tables of the configured database. Point SCANNER_CONFIG to a throwaway one:
+#
+#     SCANNER_CONFIG=bench_config.json python -m benchmarks.bench_suite --relays 1000 10000 100000 --exit-fanout 2
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from scanner import scanner, Scanner
+from providers.shodan import TokenBucket
+from benchmarks.fake_server import FakeProviderServer
+from benchmarks.synthetic import generate_relays
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def _measure(func, repeat=1, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return {'runs': repeat, 'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)}
+
+
+def _filter_shapes(relays):
+    shapes = dict()
+    shapes['all'] = Scanner.select_filter()
+
+    shapes['ip_list'] = Scanner.select_filter()
+    for relay in relays[:20]:
+        shapes['ip_list'].add_ip_to_filter(str(relay.or_addr))
+
+    shapes['network'] = Scanner.select_filter()
+    shapes['network'].add_network_to_filter(f"{relays[0].or_addr}/8")
+
+    shapes['network_list'] = Scanner.select_filter()
+    for relay in relays:
+        shapes['network_list'].add_network_to_filter(f"{relay.or_addr}/24")
+
+    shapes['asn'] = Scanner.select_filter()
+    shapes['asn'].add_asn_to_filter(relays[0].as_number)
+
+    shapes['port'] = Scanner.select_filter()
+    shapes['port'].add_port_to_filter(relays[0].or_port)
+
+    shapes['country'] = Scanner.select_filter()
+    shapes['country'].add_country_to_filter(relays[0].country)
+
+    shapes['onion_routing'] = Scanner.select_filter()
+    shapes['onion_routing'].set_onion_routing_filter(True)
+
+    shapes['not_onion_routing'] = Scanner.select_filter()
+    shapes['not_onion_routing'].set_onion_routing_filter(False)
+
+    shapes['combined'] = Scanner.select_filter()
+    shapes['combined'].add_port_to_filter(relays[1].or_port)
+    shapes['combined'].add_country_to_filter(relays[1].country)
+    shapes['combined'].set_onion_routing_filter(True)
+
+    return shapes
+
+
+def _fetch():
+    if scanner.fetch_onions() == 0:
+        raise RuntimeError("Nothing was fetched from the fake server")
+
+
+def run_dataset(server, relays_count, exit_fanout, seed, repeat):
+    results = {'relays': relays_count, 'exit_fanout': exit_fanout}
+    # The first relays of the served document, to build filters and pick hosts to delete
+    relays = generate_relays(min(relays_count, 500), exit_fanout, seed)
+
+    scanner.clear_tables()
+    results['fetch_onions_cold'] = _measure(_fetch)
+    # Summaries as of this moment are read back from the history
+    cold_fetched = datetime.now(timezone.utc)
+
+    # The same consensus an hour later: running relays only have a new 'last_seen', written in place
+    results['fetch_onions_warm'] = _measure(_fetch, repeat, setup=server.publish)
+
+    # Nothing new published: answered by the conditional request alone
+    results['fetch_onions_not_modified'] = _measure(scanner.fetch_onions, repeat)
+
+    results['fetch_exit_list'] = _measure(scanner.fetch_exit_list)
+
+    with scanner.conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    scanner.conn.commit()
+
+    results['get_filtered_summary'] = dict()
+    results['get_filtered_summary_page'] = dict()
+    results['get_filtered_summary_as_of'] = dict()
+    for name, filter_ in _filter_shapes(relays).items():
+        results['get_filtered_summary'][name] = _measure(lambda: scanner.get_filtered_summary(filter_), repeat)
+        results['get_filtered_summary_page'][name] = _measure(lambda: scanner.get_filtered_summary_page(filter_), repeat)
+        results['get_filtered_summary_as_of'][name] = _measure(lambda: scanner.get_filtered_summary_as_of(filter_, cold_fetched), repeat)
+
+    shodan_addrs = [str(relay.or_addr) for relay in relays[:100]]
+    results['enrich_from_shodan'] = _measure(lambda: scanner.enrich_from_shodan(shodan_addrs))
+
+    deleted = iter(relays[-repeat:])
+    results['delete_host'] = _measure(lambda: scanner.delete_host(str(next(deleted).or_addr)), repeat)
+
+    # A /8 holds about 1/223 of the synthetic addresses
+    deleted_networks = iter(relays[-2 * repeat:-repeat])
+    results['delete_hosts_network'] = _measure(
+        lambda: scanner.delete_hosts(Scanner.filter_from_addresses([f"{next(deleted_networks).or_addr}/8"])[0]), repeat)
+
+    results['clear_tables'] = _measure(scanner.clear_tables)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def run(relays_counts, exit_fanout, seed=0, repeat=5):
+    with scanner.conn.cursor() as cur:
+        cur.execute("SELECT version()")
+        postgres_version = cur.fetchone()[0]
+    scanner.conn.commit()
+
+    results = {
+        'started': datetime.now(timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'postgres': postgres_version,
+        'seed': seed,
+        'repeat': repeat,
+        'datasets': [],
+    }
+
+    # Provider responses are neither cached nor throttled and summaries are always read from the database,
+    # so only Scanner itself is measured
+    scanner.summary_cache = None
+    scanner.onionoo.cache = None
+    scanner.shodan.cache = None
+    scanner.shodan.rate_limiter = TokenBucket(10 ** 6, 10 ** 6)
+
+    for relays_count in relays_counts:
+        server = FakeProviderServer(relays_count, exit_fanout, seed).start()
+        scanner.onionoo.api_url = server.onionoo_url
+        scanner.shodan.api_url = server.shodan_url
+        scanner.exit_list.api_url = server.exit_list_url
+        try:
+            results['datasets'].append(run_dataset(server, relays_count, exit_fanout, seed, repeat))
+        finally:
+            server.stop()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scanner ingestion and query benchmarks on synthetic data.")
+    parser.add_argument('--relays', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--exit-fanout', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="Result file. Defaults to a new file in benchmarks/results.")
+    args = parser.parse_args()
+
+    if not scanner.db_connect():
+        print("Fail!")
+        exit(1)
+
+    results = run(args.relays, args.exit_fanout, args.seed, args.repeat)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{(results['commit'] or 'unknown')[:8]}.json")
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for dataset in results['datasets']:
+        print(f"{dataset['relays']} relays:")
+        for case, timing in dataset.items():
+            if isinstance(timing, dict) and 'median' in timing:
+                print(f"    {case:28} {timing['median']:8.3f} s")
+            elif isinstance(timing, dict):
+                for shape, shape_timing in timing.items():
+                    print(f"    {case + '/' + shape:28} {shape_timing['median']:8.3f} s")
+    print(f"Results written to {output}")
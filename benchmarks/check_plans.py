@@ -0,0 +1,218 @@
+# Query plan regression check. Loads synthetic relays, runs the read and write paths of Scanner
+# and EXPLAIN (ANALYZE, BUFFERS)-es every statement they issue right before it is executed.
+# Exits with status 1 if any of them reads one of the data tables with a sequential scan.
+#
+# Full reads by design (get_all_summary streaming, the purge of vanished relays, whole as-of reads filtered
+# by anything but addresses) are not part of the workload. Exit list and Shodan data come from a local fake server.
+# WARNING: clears all tables of the configured database. Point SCANNER_CONFIG to a throwaway one:
+#
+#     SCANNER_CONFIG=bench_config.json python -m benchmarks.check_plans --relays 50000
+
+import argparse
+import copy
+import json
+from datetime import datetime, timezone
+
+import psycopg2.extensions
+
+from scanner import scanner, Scanner
+from providers.shodan import TokenBucket
+from benchmarks.fake_server import FakeProviderServer
+from benchmarks.synthetic import generate_raw_relays, generate_relays, to_relays
+
+
+CHECKED_TABLES = {"hosts", "open_ports", "onion_routing_hosts", "relay_addresses", "tor_exit_hosts", "host_summary",
+                  "host_summary_history"}
+# Scans of the history name the monthly partition, e.g. 'host_summary_history_y2024m01'
+PARTITIONED_TABLES = ("host_summary_history",)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "EXECUTE")
+
+violations = []
+checked = []
+
+
+def _checked_table(relation):
+    for table in PARTITIONED_TABLES:
+        if relation.startswith(f"{table}_y"):
+            return table
+
+    return relation
+
+
+def _seq_scans(plan):
+    if plan.get('Node Type') == 'Seq Scan' and _checked_table(plan.get('Relation Name', '')) in CHECKED_TABLES:
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', []):
+        yield from _seq_scans(subplan)
+
+
+def _check_plan(conn, query):
+    # Statements are really executed by EXPLAIN ANALYZE, so their effects are rolled back
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("SAVEPOINT plan_check")
+        cur.execute(b"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+        plan = cur.fetchone()[0][0]['Plan']
+        cur.execute("ROLLBACK TO SAVEPOINT plan_check")
+
+    query_str = query.decode('utf-8')
+    checked.append(query_str)
+    tables = sorted(set(_seq_scans(plan)))
+    if tables:
+        violations.append({'query': query_str, 'seq_scans': tables, 'plan': plan})
+
+
+class PlanCheckingCursor(psycopg2.extensions.cursor):
+
+    def execute(self, sql, args=None):
+        query = self.mogrify(sql, args)
+        if query.lstrip().upper().startswith(tuple(k.encode() for k in EXPLAINABLE)):
+            _check_plan(self.connection, query)
+
+        return super().execute(sql, args)
+
+
+def _load_dataset(relays):
+    scanner.clear_tables()
+    event_id = scanner._create_tor_fetch_event()
+    for chunk in Scanner._chunked(relays, Scanner.INGEST_CHUNK_SIZE):
+        scanner._bulk_update_onion_routing(chunk, event_id)
+    scanner.conn.commit()
+
+    with scanner.conn.cursor() as cur:
+        cur.execute("ANALYZE")
+    scanner.conn.commit()
+
+
+def _filters(relays):
+    filters = [Scanner.select_filter()]
+
+    ip_filter = Scanner.select_filter()
+    for relay in relays[:20]:
+        ip_filter.add_ip_to_filter(str(relay.or_addr))
+    filters.append(ip_filter)
+
+    port_filter = Scanner.select_filter()
+    port_filter.add_port_to_filter(relays[0].or_port)
+    filters.append(port_filter)
+
+    country_filter = Scanner.select_filter()
+    country_filter.add_country_to_filter(relays[0].country)
+    filters.append(country_filter)
+
+    # Thousands of prefixes must stay a single join against the array
+    network_filter = Scanner.select_filter()
+    for relay in relays[:2000]:
+        network_filter.add_network_to_filter(f"{relay.or_addr}/24")
+    filters.append(network_filter)
+
+    asn_filter = Scanner.select_filter()
+    asn_filter.add_asn_to_filter(relays[0].as_number)
+    filters.append(asn_filter)
+
+    for onion_routing in (True, False):
+        onion_filter = Scanner.select_filter()
+        onion_filter.set_onion_routing_filter(onion_routing)
+        filters.append(onion_filter)
+
+    combined_filter = Scanner.select_filter()
+    combined_filter.add_port_to_filter(relays[1].or_port)
+    combined_filter.add_country_to_filter(relays[1].country)
+    combined_filter.set_onion_routing_filter(True)
+    filters.append(combined_filter)
+
+    return filters
+
+
+def run(relays_count, seed=0):
+    # Ports are spread widely, so port filters are as selective as they are on scanned hosts
+    raw_relays = generate_raw_relays(relays_count, exit_fanout=2, seed=seed, ports=range(1024, 65536))
+    relays = to_relays(raw_relays)
+
+    # The exit list of the served relays and their Shodan data, neither cached nor throttled
+    server = FakeProviderServer(relays_count, exit_fanout=2, seed=seed, ports=range(1024, 65536)).start()
+    scanner.exit_list.api_url = server.exit_list_url
+    scanner.shodan.api_url = server.shodan_url
+    scanner.shodan.cache = None
+    scanner.shodan.rate_limiter = TokenBucket(10 ** 6, 10 ** 6)
+    try:
+        _run_workload(raw_relays, relays, seed)
+    finally:
+        server.stop()
+
+    scanner.clear_tables()
+
+
+def _run_workload(raw_relays, relays, seed):
+    _load_dataset(relays)
+    # Summaries as of this moment are read back from the history after the refresh below
+    loaded = datetime.now(timezone.utc)
+
+    # Every summary has to come from the database to get its plan checked
+    scanner.summary_cache = None
+    cursor_factory = scanner.conn.cursor_factory
+    scanner.conn.cursor_factory = PlanCheckingCursor
+    try:
+        for filter_ in _filters(relays):
+            _, next_after = scanner.get_filtered_summary_page(filter_)
+            if next_after is not None:
+                scanner.get_filtered_summary_page(filter_, next_after)
+        scanner.conn.rollback()
+
+        # An hourly refresh: some relays changed, some are new, most are untouched
+        refreshed_raw = copy.deepcopy(raw_relays[:200])
+        for raw_relay in refreshed_raw[:50]:
+            raw_relay['running'] = not raw_relay['running']
+        refreshed = to_relays(refreshed_raw) + generate_relays(50, exit_fanout=2, seed=seed + 1, ports=range(1024, 65536))
+        event_id = scanner._create_tor_fetch_event()
+        scanner._bulk_update_onion_routing(refreshed, event_id)
+        scanner.conn.commit()
+
+        # A changed relay goes through the per-relay upserts, an unchanged one stops at the lookup
+        changed_raw = dict(raw_relays[300], running=not raw_relays[300]['running'])
+        scanner._update_onion_routing(to_relays([changed_raw])[0], event_id)
+        scanner._update_onion_routing(relays[301], event_id)
+
+        # The exit list binds listed exits to their relays, '/is_tor_exit' looks them up
+        scanner.fetch_exit_list()
+        exit_addr = next(addr for raw_relay in raw_relays for addr in raw_relay.get('exit_addresses', []))
+        scanner.tor_exit_info(exit_addr)
+        scanner.tor_exit_info(str(relays[0].or_addr))
+
+        scanner.enrich_from_shodan([str(relay.or_addr) for relay in relays[:100]])
+        # Hosts never enriched are picked by the database
+        scanner.enrich_from_shodan(limit=100)
+
+        # The history has rows before and after 'loaded'
+        for filter_ in _filters(relays):
+            _, next_after = scanner.get_filtered_summary_page_as_of(filter_, loaded)
+            if next_after is not None:
+                scanner.get_filtered_summary_page_as_of(filter_, loaded, next_after)
+        # Whole as-of reads are checked when the filter narrows the history down by address
+        for addresses in ([str(relay.or_addr) for relay in relays[:20]], [f"{relays[0].or_addr}/24", str(relays[1].or_addr)]):
+            scanner.get_filtered_summary_as_of(Scanner.filter_from_addresses(addresses)[0], loaded)
+        scanner.conn.rollback()
+
+        # 'delete_host' swallows errors, so the set-based deletes are checked directly
+        scanner.delete_hosts(Scanner.filter_from_addresses([str(relays[400].or_addr), f"{relays[401].or_addr}/24"])[0])
+    finally:
+        scanner.conn.cursor_factory = cursor_factory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fails if a Scanner query plan contains a sequential scan.")
+    parser.add_argument('--relays', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not scanner.db_connect():
+        print("Fail!")
+        exit(1)
+
+    run(args.relays, args.seed)
+
+    for violation in violations:
+        print(f"Sequential scan on {', '.join(violation['seq_scans'])}:\n{violation['query']}")
+        print(json.dumps(violation['plan'], indent=2))
+    print(f"{len(checked)} statements checked, {len(violations)} with sequential scans.")
+
+    exit(1 if violations else 0)
@@ -0,0 +1,203 @@
+# Local stand-in for the Onionoo and Shodan InternetDB APIs, serving synthetic data:
+#
+#     GET /onionoo/details?offset=&limit=    a page of the details document
+#     GET /onionoo/details?search=<ip>       relays with the address among their OR or exit addresses
+#     GET /shodan/<ip>                       InternetDB data of the address, 404 if it is unknown
+#     GET /exit-addresses                    exit addresses of all relays in the TorDNSEL format
+#
+# Run it on its own and point 'onionoo_api_url' and 'shodan_api_url' of the config to it:
+#
+#     python -m benchmarks.fake_server --relays 100000 --port 8000
+
+import argparse
+import json
+import threading
+from datetime import timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from benchmarks.synthetic import OR_PORTS, PUBLISHED, FMT, generate_details_document, generate_raw_relay, generate_shodan_info
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _send_status(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        fake = self.server.fake
+
+        if url.path == '/onionoo/details':
+            if 'search' in query:
+                self._send_json(fake.search(query['search']))
+                return
+
+            last_modified = format_datetime(fake.published)
+            since = self.headers.get('If-Modified-Since')
+            if since is not None and parsedate_to_datetime(since) >= parsedate_to_datetime(last_modified):
+                self._send_status(304)
+                return
+
+            offset = int(query.get('offset', 0))
+            limit = int(query['limit']) if 'limit' in query else None
+            self._send_json(fake.details(offset, limit), headers={'Last-Modified': last_modified})
+            return
+
+        if url.path == '/exit-addresses':
+            last_modified = format_datetime(fake.published)
+            since = self.headers.get('If-Modified-Since')
+            if since is not None and parsedate_to_datetime(since) >= parsedate_to_datetime(last_modified):
+                self._send_status(304)
+                return
+
+            body = fake.exit_addresses().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if url.path.startswith('/shodan/'):
+            info = generate_shodan_info(url.path[len('/shodan/'):], fake.seed)
+            if info is None:
+                self._send_json({"detail": "No information available"}, status=404)
+            else:
+                self._send_json(info)
+            return
+
+        self._send_status(404)
+
+
+class FakeProviderServer:
+
+    def __init__(self, relays_count: int, exit_fanout: int = 0, seed: int = 0, ports=OR_PORTS,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.relays_count = relays_count
+        self.exit_fanout = exit_fanout
+        self.seed = seed
+        self.ports = ports
+        self.published = PUBLISHED
+
+        self._search_index = None
+        self._search_lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    @property
+    def onionoo_url(self):
+        return f"{self.url}/onionoo"
+
+
+    @property
+    def shodan_url(self):
+        return f"{self.url}/shodan"
+
+
+    @property
+    def exit_list_url(self):
+        return f"{self.url}/exit-addresses"
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-provider-server', daemon=True)
+        self._thread.start()
+
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    # Publishes the same relays once more, an hour later. The next walk is not answered with 304 and,
+    # as with a new consensus, running relays come with a new 'last_seen'.
+    def publish(self):
+        self.published += timedelta(hours=1)
+
+
+    def details(self, offset=0, limit=None):
+        document = generate_details_document(self.relays_count, self.exit_fanout, self.seed, self.ports, offset, limit, self.published)
+
+        return document
+
+
+    def exit_addresses(self):
+        lines = []
+        published = self.published.strftime(FMT)
+        for index in range(self.relays_count):
+            relay = generate_raw_relay(index, self.exit_fanout, self.seed, self.ports, self.published)
+            if not relay.get('exit_addresses'):
+                continue
+            lines += [f"ExitNode {relay['fingerprint']}", f"Published {published}", f"LastStatus {published}"]
+            lines += [f"ExitAddress {addr} {published}" for addr in relay['exit_addresses']]
+
+        return '\n'.join(lines) + '\n'
+
+
+    def search(self, ip_addr):
+        # The index of every address is built on the first search only
+        with self._search_lock:
+            if self._search_index is None:
+                self._search_index = dict()
+                for index in range(self.relays_count):
+                    relay = generate_raw_relay(index, self.exit_fanout, self.seed, self.ports, self.published)
+                    addrs = [addr.rpartition(':')[0].strip('[]') for addr in relay['or_addresses']]
+                    for addr in addrs + relay.get('exit_addresses', []):
+                        self._search_index.setdefault(addr, []).append(index)
+
+        document = self.details(0, 0)
+        document['relays'] = [generate_raw_relay(index, self.exit_fanout, self.seed, self.ports, self.published)
+                              for index in self._search_index.get(ip_addr, [])]
+
+        return document
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Onionoo and Shodan InternetDB server with synthetic data.")
+    parser.add_argument('--relays', type=int, default=10000)
+    parser.add_argument('--exit-fanout', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    server = FakeProviderServer(args.relays, args.exit_fanout, args.seed, host=args.host, port=args.port)
+    print(f"Onionoo: {server.onionoo_url}\nShodan: {server.shodan_url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,101 @@
+import ipaddress
+import random
+from datetime import datetime, timedelta
+
+from providers.onionoo import Onionoo
+from providers.relay import Relay
+
+
+COUNTRIES = ["us", "de", "fr", "nl", "ro", "ru", "se", "ch", "ca", "fi", "gb", "at", "pl", "ua", "jp", "sg"]
+AS_NUMBERS = [24940, 16276, 60729, 197540, 51167, 14061, 53667, 4224, 12876, 200052]
+OR_PORTS = [443, 9001, 9002, 9003, 9010, 9050, 9100, 8080, 8443]
+PUBLISHED = datetime(2024, 1, 1)
+FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def _random_ipv4(rnd):
+    return f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+
+
+def _random_ipv6(rnd):
+    return str(ipaddress.IPv6Address((0x2001 << 112) | rnd.getrandbits(112)))
+
+
+# Relay number 'index' in the raw Onionoo 'details' format. Every relay has a generator of its own,
+# so any page of a document can be produced without generating the relays before it. Like in Onionoo,
+# running relays were last seen when the document was published, the others some time before.
+def generate_raw_relay(index, exit_fanout=0, seed=0, ports=OR_PORTS, published=PUBLISHED):
+    rnd = random.Random(f"{seed}:{index}")
+    first_seen = PUBLISHED - timedelta(days=rnd.randint(1, 2000))
+    relay = {
+        "nickname": f"relay{index}"[:19],
+        "fingerprint": f"{rnd.getrandbits(160):040X}",
+        "or_addresses": [f"{_random_ipv4(rnd)}:{rnd.choice(ports)}"],
+        "last_seen": None,    # known once 'running' is
+        "last_changed_address_or_port": (first_seen + timedelta(days=1)).strftime(FMT),
+        "first_seen": first_seen.strftime(FMT),
+        "running": rnd.random() < 0.9,
+        "country": rnd.choice(COUNTRIES),
+        "contact": f"operator{index} <op{index} AT example dot org>",
+    }
+    if exit_fanout:
+        relay["exit_addresses"] = [_random_ipv4(rnd) for _ in range(rnd.randint(0, exit_fanout))]
+    relay["as"] = f"AS{rnd.choice(AS_NUMBERS)}"
+    # Some relays listen on an IPv6 address too
+    if rnd.random() < 0.3:
+        relay["or_addresses"].append(f"[{_random_ipv6(rnd)}]:{rnd.choice(ports)}")
+    if relay["running"]:
+        relay["last_seen"] = published.strftime(FMT)
+    else:
+        relay["last_seen"] = (PUBLISHED - timedelta(hours=rnd.randint(1, 72))).strftime(FMT)
+
+    return relay
+
+
+# Relays in the raw Onionoo 'details' format.
+def generate_raw_relays(count, exit_fanout=0, seed=0, ports=OR_PORTS, offset=0, published=PUBLISHED):
+    return [generate_raw_relay(index, exit_fanout, seed, ports, published) for index in range(offset, offset + count)]
+
+
+# A whole Onionoo 'details' document of 'count' relays, or its page of at most 'limit' relays starting at 'offset'.
+def generate_details_document(count, exit_fanout=0, seed=0, ports=OR_PORTS, offset=0, limit=None, published=PUBLISHED):
+    if limit is None:
+        limit = count
+    limit = max(0, min(limit, count - offset))
+
+    return {
+        "version": "8.0",
+        "relays_published": published.strftime(FMT),
+        "relays": generate_raw_relays(limit, exit_fanout, seed, ports, offset, published),
+        "bridges_published": published.strftime(FMT),
+        "bridges": [],
+    }
+
+
+# Turns raw relays into relays as yielded by 'Onionoo.iter_details()'. Exit addresses are kept even though
+# they are currently not part of 'Onionoo.VITAL_FIELDS', so the exit path gets exercised too.
+def to_relays(raw_relays):
+    fields = Onionoo.VITAL_FIELDS + ["exit_addresses"]
+
+    return [Relay.from_details({field: raw_relay[field] for field in fields if field in raw_relay})
+            for raw_relay in raw_relays]
+
+
+def generate_relays(count, exit_fanout=0, seed=0, ports=OR_PORTS):
+    return to_relays(generate_raw_relays(count, exit_fanout, seed, ports))
+
+
+# Shodan InternetDB data of an address, always the same for the same address. About a third are unknown.
+def generate_shodan_info(ip_addr, seed=0):
+    rnd = random.Random(f"{seed}:{ip_addr}")
+    if rnd.random() < 0.3:
+        return None
+
+    return {
+        "ip": ip_addr,
+        "ports": sorted(rnd.sample(range(1, 65536), rnd.randint(1, 5))),
+        "hostnames": [f"host{rnd.randint(0, 10 ** 6)}.example.org" for _ in range(rnd.randint(0, 2))],
+        "cpes": ["cpe:/a:openbsd:openssh"] if rnd.random() < 0.5 else [],
+        "tags": ["tor"] if rnd.random() < 0.3 else [],
+        "vulns": [f"CVE-2023-{rnd.randint(1000, 9999)}" for _ in range(rnd.randint(0, 3))],
+    }
@@ -0,0 +1,205 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+from scanner import scanner, Scanner
+
+
+# Streams filtered host summaries as CSV, NDJSON or Parquet. Rows come from the server-side cursor of
+# 'Scanner.iter_filtered_summary' and are encoded 'EXPORT_CHUNK_ROWS' at a time, so memory stays the same
+# whatever the number of hosts. Used by the '/export' page and from the command line:
+#
+#     python -m export --format csv --network 185.146.0.0/16 --tor on > hosts.csv
+
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_COLUMNS = ("ip_addr", "ports", "or_port", "contact", "running", "country", "nickname", "exit_addr", "as_number",
+                  "is_exit", "is_onion_routing")
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+FORMATS = tuple(CONTENT_TYPES)
+
+
+def _chunks(summaries):
+    chunk = []
+    for summary in summaries:
+        chunk.append(summary)
+        if len(chunk) == EXPORT_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv(summaries):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+
+    for chunk in _chunks(summaries):
+        for summary in chunk:
+            # Ports are one field, separated by spaces
+            row = dict(summary, ports=' '.join(str(port) for port in summary['ports'] or ()))
+            writer.writerow([row[column] for column in EXPORT_COLUMNS])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    # Header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(summaries):
+    for chunk in _chunks(summaries):
+        lines = [json.dumps({column: summary[column] for column in EXPORT_COLUMNS}, ensure_ascii=False, default=str)
+                 for summary in chunk]
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+# Collects what the Parquet writer wrote since the last chunk was taken
+class _ChunkSink:
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+
+    def tell(self):
+        return self._position
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        self.closed = True
+
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# One row group per chunk. Needs 'pyarrow', which is imported only when Parquet is asked for. A missing
+# 'pyarrow' is reported here rather than once streaming has started.
+def iter_parquet(summaries):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export needs 'pyarrow' to be installed.") from e
+
+    return _iter_parquet(summaries, pa, pq)
+
+
+def _iter_parquet(summaries, pa, pq):
+    schema = pa.schema([
+        ("ip_addr", pa.string()),
+        ("ports", pa.list_(pa.int32())),
+        ("or_port", pa.int32()),
+        ("contact", pa.string()),
+        ("running", pa.bool_()),
+        ("country", pa.string()),
+        ("nickname", pa.string()),
+        ("exit_addr", pa.string()),
+        ("as_number", pa.string()),
+        ("is_exit", pa.bool_()),
+        ("is_onion_routing", pa.bool_()),
+    ])
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for chunk in _chunks(summaries):
+            columns = {column: [summary[column] for summary in chunk] for column in EXPORT_COLUMNS}
+            for column in ("ip_addr", "exit_addr"):
+                columns[column] = [None if value is None else str(value) for value in columns[column]]
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+
+    # Footer
+    yield sink.take()
+
+
+_ENCODERS = {
+    'csv': iter_csv,
+    'ndjson': iter_ndjson,
+    'parquet': iter_parquet,
+}
+
+
+# Encoded chunks of the summaries of the hosts passing the filter, as they are or as they were at 'as_of'
+def iter_export(filter_, format_='csv', as_of=None):
+    if format_ not in _ENCODERS:
+        raise ValueError(f"Unknown export format '{format_}'. Expected one of {', '.join(FORMATS)}.")
+
+    if as_of is None:
+        summaries = scanner.iter_filtered_summary(filter_)
+    else:
+        summaries = scanner.iter_filtered_summary_as_of(filter_, as_of)
+
+    return _ENCODERS[format_](summaries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports filtered host summaries.")
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', help="Output file. Defaults to the standard output.")
+    parser.add_argument('--ip', action='append', default=[])
+    parser.add_argument('--network', action='append', default=[], help="CIDR network or 'first-last' range.")
+    parser.add_argument('--port', type=int, action='append', default=[])
+    parser.add_argument('--country', action='append', default=[])
+    parser.add_argument('--asn', action='append', default=[])
+    parser.add_argument('--tor', choices=('on', 'off'), help="Only onion-routing hosts, or only the others.")
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help="Hosts as they were at this time, e.g. 2024-01-01T12:00.")
+    args = parser.parse_args()
+
+    filtr = Scanner.select_filter()
+    for ip_addr in args.ip:
+        if not filtr.add_ip_to_filter(ip_addr):
+            parser.error(f"invalid IP-address '{ip_addr}'")
+    for network in args.network:
+        first, _, last = network.partition('-')
+        added = filtr.add_range_to_filter(first, last) if last else filtr.add_network_to_filter(network)
+        if not added:
+            parser.error(f"invalid network '{network}'")
+    for port in args.port:
+        if not filtr.add_port_to_filter(port):
+            parser.error(f"invalid port '{port}'")
+    for country in args.country:
+        if not filtr.add_country_to_filter(country):
+            parser.error(f"invalid country '{country}'")
+    for asn in args.asn:
+        if not filtr.add_asn_to_filter(asn):
+            parser.error(f"invalid autonomous system '{asn}'")
+    if args.tor is not None:
+        filtr.set_onion_routing_filter(args.tor == 'on')
+
+    if not scanner.db_connect():
+        print("Fail!")
+        exit(1)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for data in iter_export(filtr, args.format, args.as_of):
+            output.write(data)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,33 @@
+-- Indexes backing the lookups Scanner runs. The file is applied on connect whenever the digest of
+-- setup.sql and indexes.sql differs from the one in 'schema_version'. Every statement is idempotent,
+-- so it also brings databases created before it up to date.
+
+-- Exit hosts are looked up by their relay on every refresh
+CREATE INDEX IF NOT EXISTS tor_exit_hosts_fingerprint_idx ON tor_exit_hosts (fingerprint);
+
+-- Relays listening on an address, for summaries and host deletion
+CREATE INDEX IF NOT EXISTS relay_addresses_ip_addr_idx ON relay_addresses (ip_addr, port);
+
+-- Filter search by country and by port
+CREATE INDEX IF NOT EXISTS onion_routing_hosts_country_idx ON onion_routing_hosts (country);
+CREATE INDEX IF NOT EXISTS open_ports_port_idx ON open_ports (port);
+
+-- Onion-routing ports are deleted and reinserted separately from the scanned ones
+CREATE INDEX IF NOT EXISTS open_ports_onion_routing_idx ON open_ports (ip_addr) WHERE onion_routing IS TRUE;
+
+-- Hosts touched by a given event
+CREATE INDEX IF NOT EXISTS hosts_last_modified_event_idx ON hosts (last_modified_event);
+
+-- Subnet containment (<<, <<=, &&) on host addresses
+CREATE INDEX IF NOT EXISTS hosts_ip_addr_gist_idx ON hosts USING gist (ip_addr inet_ops);
+
+-- Summary filters by country and by any of the open ports
+CREATE INDEX IF NOT EXISTS host_summary_country_idx ON host_summary (country);
+CREATE INDEX IF NOT EXISTS host_summary_ports_idx ON host_summary USING gin (ports);
+
+-- Summary filters by networks and by autonomous system
+CREATE INDEX IF NOT EXISTS host_summary_ip_addr_gist_idx ON host_summary USING gist (ip_addr inet_ops);
+CREATE INDEX IF NOT EXISTS host_summary_as_number_idx ON host_summary (as_number);
+
+-- Latest summary of a host up to a moment, within one month of history
+CREATE INDEX IF NOT EXISTS host_summary_history_ip_addr_ts_idx ON host_summary_history (ip_addr, ts DESC, id DESC);
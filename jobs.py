@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import Json
+from error import raise_error
+from scanner import Scanner
+
+
+# Runs long Scanner operations out of the request in a small pool of worker threads.
+# Every job is a row of the 'jobs' table, so its state can be polled from any web worker process.
+# A job is a function taking a 'progress(done, total=None)' callback and returning a JSON-serializable result.
+#
+# While a job is queued or running, its process holds an advisory lock on '(JOB_LOCK_CLASS, id)' in a session of
+# its own. Jobs left 'queued' or 'running' without the lock were owned by a process that exited, and are failed.
+class JobManager:
+
+    WORKERS = 2
+    PROGRESS_INT = 0.5
+    ORPHANS_INT = 30
+    JOB_LOCK_CLASS = 0x4A4F4253
+
+    def __init__(self, scanner: Scanner, workers: int = WORKERS):
+        self.logger = logging.getLogger('JobManager')
+        self.logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()  # Output logs to console
+        handler.setLevel(logging.DEBUG)  # Set the desired logging level for this handler
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        self.logger.addHandler(handler)
+
+        self.scanner = scanner
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._owner_conn = None
+        self._owner_lock = threading.Lock()
+        self._locked_jobs = set()
+        self._orphans_checked = None
+
+
+    # Job state is written and job locks are held on a session of this process, outside the pool: it is visible
+    # while the job's transaction is still open, and a job thread holding a pooled connection never waits for another.
+    # A lost session lost its locks too, so they are taken again on the new one.
+    def _owner_cursor(self):
+        if self._owner_conn is None or self._owner_conn.closed:
+            self._owner_conn = self.scanner.session_connection()
+            with self._owner_conn.cursor() as cur:
+                for job_id in self._locked_jobs:
+                    cur.execute("SELECT pg_advisory_lock(%s, %s)", (JobManager.JOB_LOCK_CLASS, job_id))
+
+        return self._owner_conn.cursor()
+
+
+    def _execute(self, sql, params, fetch=False):
+        with self._owner_lock:
+            with self._owner_cursor() as cur:
+                cur.execute(sql, params)
+                row = cur.fetchone() if fetch else None
+
+        return row
+
+
+    def _lock(self, job_id):
+        with self._owner_lock:
+            with self._owner_cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s, %s)", (JobManager.JOB_LOCK_CLASS, job_id))
+            self._locked_jobs.add(job_id)
+
+
+    def _unlock(self, job_id):
+        with self._owner_lock:
+            self._locked_jobs.discard(job_id)
+            try:
+                with self._owner_cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s, %s)", (JobManager.JOB_LOCK_CLASS, job_id))
+            except Exception as e:
+                self.logger.error(f"Could not unlock job {job_id}. Details: {str(e)}")
+
+
+    # Closes the session of this process, e.g. before the database is dropped
+    def close(self):
+        with self._owner_lock:
+            if self._owner_conn is not None:
+                self._owner_conn.close()
+                self._owner_conn = None
+
+
+    # Fails the jobs of processes that exited before finishing them. Checked at most every 'ORPHANS_INT'
+    # seconds, as jobs are submitted and polled.
+    def _fail_orphans(self):
+        now = time.monotonic()
+        if self._orphans_checked is not None and now - self._orphans_checked < JobManager.ORPHANS_INT:
+            return
+        self._orphans_checked = now
+
+        try:
+            self._execute("""UPDATE jobs j SET status = 'failed', error = 'Interrupted: the process running the job exited.',
+                                finished = now()
+                            WHERE j.status IN ('queued', 'running')
+                                AND NOT EXISTS (SELECT 1 FROM pg_locks l JOIN pg_database d ON d.oid = l.database
+                                                WHERE d.datname = current_database() AND l.locktype = 'advisory'
+                                                    AND l.classid = %s AND l.objid = j.id AND l.objsubid = 2)""",
+                          (JobManager.JOB_LOCK_CLASS,))
+        except Exception as e:
+            self.logger.error(f"Could not fail interrupted jobs. Details: {str(e)}")
+
+
+    # Queues 'func' and returns the id of its job right away
+    def submit(self, kind: str, func, total: int = None) -> int:
+        self._fail_orphans()
+
+        # The job is locked before its row exists, so it is never taken for an orphan
+        try:
+            job_id = self._execute("SELECT nextval(pg_get_serial_sequence('jobs', 'id'))", None, fetch=True)[0]
+            self._lock(job_id)
+        except Exception as e:
+            raise_error(self.logger,f"Could not create '{kind}' job.",e)
+
+        try:
+            self._execute("""INSERT INTO jobs (id, kind, status, progress, total, created)
+                            VALUES (%s, %s, 'queued', 0, %s, now())""", (job_id, kind, total))
+        except Exception as e:
+            self._unlock(job_id)
+            raise_error(self.logger,f"Could not create '{kind}' job.",e)
+
+        self.executor.submit(self._run, job_id, func)
+
+        return job_id
+
+
+    def _run(self, job_id, func):
+        lock = threading.Lock()
+        state = {'done': 0, 'total': None, 'reported': 0.0}
+
+        # Progress is written at most every 'PROGRESS_INT' seconds, the last value is always kept for the final update
+        def progress(done, total=None):
+            with lock:
+                state['done'] = done
+                if total is not None:
+                    state['total'] = total
+
+                now = time.monotonic()
+                if now - state['reported'] < JobManager.PROGRESS_INT:
+                    return
+                state['reported'] = now
+
+            try:
+                self._execute("UPDATE jobs SET progress = %s, total = COALESCE(%s, total) WHERE id = %s",
+                              (done, total, job_id))
+            except Exception as e:
+                self.logger.error(f"Could not update progress of job {job_id}. Details: {str(e)}")
+
+        try:
+            self._execute("UPDATE jobs SET status = 'running', started = now() WHERE id = %s", (job_id,))
+
+            try:
+                result = func(progress)
+            finally:
+                self.scanner.release_connection()
+
+            # Totals are often estimates, a finished job has done all of its work
+            self._execute("""UPDATE jobs SET status = 'done', progress = %(done)s, total = %(done)s,
+                                result = %(result)s, finished = now() WHERE id = %(id)s""",
+                          {'done': state['done'], 'result': Json(result), 'id': job_id})
+            self.logger.debug(f"Job {job_id} done.")
+
+        except Exception as e:
+            self.logger.error(f"Job {job_id} failed. Details: {str(e)}")
+            try:
+                self._execute("UPDATE jobs SET status = 'failed', error = %s, finished = now() WHERE id = %s",
+                              (str(e), job_id))
+            except Exception as e:
+                self.logger.error(f"Could not mark job {job_id} as failed. Details: {str(e)}")
+
+        finally:
+            self._unlock(job_id)
+
+
+    # Returns the state of the job or None if there is no such job
+    def get(self, job_id: int):
+        self._fail_orphans()
+
+        try:
+            row = self._execute("""SELECT id, kind, status, progress, total, result, error, created, started, finished
+                                    FROM jobs WHERE id = %s""", (job_id,), fetch=True)
+        except Exception as e:
+            raise_error(self.logger,f"Could not get job {job_id}.",e)
+
+        if row is None:
+            return None
+
+        job_id, kind, status, done, total, result, error, created, started, finished = row
+        return {
+            'id': job_id,
+            'kind': kind,
+            'status': status,
+            'progress': done,
+            'total': total,
+            'result': result,
+            'error': error,
+            'created': created.isoformat() if created else None,
+            'started': started.isoformat() if started else None,
+            'finished': finished.isoformat() if finished else None
+        }
@@ -0,0 +1,261 @@
+import functools
+import math
+import threading
+import time
+
+
+# Minimal Prometheus client. Metrics are kept in process memory and rendered in the text exposition format.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:
+
+    TYPE = None
+
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+    def _labels(self, key, extra=()):
+        return tuple(zip(self.labelnames, key)) + tuple(extra)
+
+
+    def samples(self):
+        raise NotImplementedError
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+
+    TYPE = 'counter'
+
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = dict()
+
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+
+    TYPE = 'histogram'
+
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = dict()
+
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+
+    # Times the block, or the decorated function, and observes its duration in seconds
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", self._labels(key, [('le', _format_value(bound))]), count))
+                samples.append((f"{self.name}_count", self._labels(key), counts[-1]))
+                samples.append((f"{self.name}_sum", self._labels(key), total))
+        return samples
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+# Value read at scrape time, such as the size of a cache
+class CallbackMetric(_Metric):
+
+    def __init__(self, name: str, documentation: str, type_: str, func):
+        super().__init__(name, documentation)
+        self.TYPE = type_
+        self.func = func
+
+
+    def samples(self):
+        return [(self.name, (), self.func())]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+
+    def callback(self, name, documentation, type_, func):
+        return self.register(CallbackMetric(name, documentation, type_, func))
+
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+PROVIDER_REQUEST_SECONDS = REGISTRY.histogram('scanner_provider_request_seconds',
+                                              "Duration of HTTP requests to data providers.",
+                                              ('provider', 'endpoint', 'status'))
+PROVIDER_PARSE_SECONDS = REGISTRY.histogram('scanner_provider_parse_seconds',
+                                            "Time spent turning provider responses into records.",
+                                            ('provider', 'stage'))
+METHOD_SECONDS = REGISTRY.histogram('scanner_method_seconds',
+                                    "Duration of Scanner database methods.",
+                                    ('method',))
+METHOD_ERRORS = REGISTRY.counter('scanner_method_errors_total',
+                                 "Scanner database methods that raised.",
+                                 ('method',))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('scanner_http_request_seconds',
+                                          "Duration of web requests.",
+                                          ('endpoint', 'method', 'status'))
+DB_QUERIES = REGISTRY.counter('scanner_db_queries_total',
+                              "SQL statements executed. Only counted with 'query_metrics' enabled.")
+DB_QUERY_SECONDS = REGISTRY.counter('scanner_db_query_seconds_total',
+                                    "Time spent executing SQL statements. Only counted with 'query_metrics' enabled.")
+HTTP_REQUEST_DB_QUERIES = REGISTRY.histogram('scanner_http_request_db_queries',
+                                             "SQL statements executed per web request.",
+                                             ('endpoint',),
+                                             (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+HTTP_REQUEST_DB_SECONDS = REGISTRY.histogram('scanner_http_request_db_seconds',
+                                             "Time spent executing SQL statements per web request.",
+                                             ('endpoint',))
+
+
+# Decorator timing a Scanner method and counting the times it raised
+def timed_method(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            METHOD_ERRORS.inc(method=func.__name__)
+            raise
+        finally:
+            METHOD_SECONDS.observe(time.perf_counter() - start, method=func.__name__)
+    return wrapper
+
+
+# SQL statements of the current thread are tallied between 'start_query_tracking' and 'finish_query_tracking'
+_query_tracking = threading.local()
+
+
+def start_query_tracking():
+    _query_tracking.stats = [0, 0.0]
+
+
+def record_query(seconds: float):
+    DB_QUERIES.inc()
+    DB_QUERY_SECONDS.inc(seconds)
+
+    stats = getattr(_query_tracking, 'stats', None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += seconds
+
+
+# Returns the number of statements and the time they took, or None if tracking was not started
+def finish_query_tracking():
+    stats = getattr(_query_tracking, 'stats', None)
+    _query_tracking.stats = None
+
+    return tuple(stats) if stats is not None else None
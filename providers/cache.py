@@ -0,0 +1,142 @@
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache with per-entry expiry. The total size of the stored values is bounded
+# by 'max_bytes'; least recently used entries are evicted first.
+class LRUCache:
+
+    def __init__(self, max_bytes: int, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value, size = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+
+    def set(self, key, value, ttl: float = None):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._bytes}
+
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+
+# Cache of provider responses keyed by URL. Every endpoint has its own TTL.
+# With 'path' set, responses are also kept zlib-compressed in an SQLite file and survive restarts.
+class ResponseCache:
+
+    DEFAULT_TTLS = {
+        'onionoo_details': 300,
+        'shodan_internetdb': 24 * 3600,
+    }
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes: int = None, ttls: dict = None, path: str = None):
+        self.logger = logging.getLogger('ResponseCache')
+
+        self.ttls = dict(ResponseCache.DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+
+        self.memory = LRUCache(max_bytes or ResponseCache.DEFAULT_MAX_BYTES)
+        self.disk_hits = 0
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db_lock, self._db:
+                self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                    url TEXT PRIMARY KEY,
+                                    endpoint TEXT NOT NULL,
+                                    expires REAL NOT NULL,
+                                    body BLOB NOT NULL)""")
+                self._db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+
+
+    def get(self, endpoint: str, url: str):
+        body = self.memory.get(url)
+        if body is not None or self._db is None:
+            return body
+
+        with self._db_lock:
+            row = self._db.execute("SELECT expires, body FROM responses WHERE url = ? AND expires > ?",
+                                   (url, time.time())).fetchone()
+        if row is None:
+            return None
+
+        expires, compressed = row
+        body = zlib.decompress(compressed)
+        self.memory.set(url, body, expires - time.time())
+        self.disk_hits += 1
+
+        return body
+
+
+    def set(self, endpoint: str, url: str, body: bytes):
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return
+
+        self.memory.set(url, body, ttl)
+
+        if self._db is not None:
+            try:
+                with self._db_lock, self._db:
+                    self._db.execute("INSERT OR REPLACE INTO responses (url, endpoint, expires, body) VALUES (?, ?, ?, ?)",
+                                     (url, endpoint, time.time() + ttl, zlib.compress(body)))
+            except sqlite3.Error as e:
+                self.logger.error(f"Could not persist cached response for '{url}'. Details: {str(e)}")
+
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+
+        return stats
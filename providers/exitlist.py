@@ -0,0 +1,108 @@
+import ipaddress
+import logging
+import time
+import requests
+import metrics
+from datetime import datetime
+from typing import NamedTuple, Union
+from error import raise_error
+
+
+# One exit address of the list. The TorDNSEL format tells the relay and when the address was last
+# seen exiting, the plain bulk exit list has addresses only.
+class ExitAddress(NamedTuple):
+    exit_addr: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+    fingerprint: str = None
+    seen: datetime = None
+
+
+# Tor exit lists, either in the TorDNSEL 'exit-addresses' format:
+#
+#     ExitNode 0011BD2485AD45D984EC4159C88FC066E5E3300E
+#     Published 2024-01-01 10:13:27
+#     LastStatus 2024-01-01 11:00:00
+#     ExitAddress 162.247.74.201 2024-01-01 11:09:44
+#
+# or as the bulk exit list of one address per line.
+class ExitList:
+
+    API_URL = "https://check.torproject.org/exit-addresses"
+    TIMEOUT = 60
+    FMT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, api_url: str = None):
+        self.logger = logging.getLogger('ExitList')
+        self.logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()  # Output logs to console
+        handler.setLevel(logging.DEBUG)  # Set the desired logging level for this handler
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        self.logger.addHandler(handler)
+
+        self.api_url = api_url or ExitList.API_URL
+        self.last_modified = None
+        self.not_modified = False
+        self._walked_list = None
+
+        self.session = requests.Session()
+
+
+    # Parses the lines as they come. Malformed lines are skipped.
+    @staticmethod
+    def parse_lines(lines):
+        fingerprint = None
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', errors='ignore')
+            fields = line.split()
+            if not fields or fields[0].startswith('@') or fields[0].startswith('#'):
+                continue
+
+            try:
+                if fields[0] == 'ExitNode':
+                    fingerprint = fields[1].upper() if len(fields) > 1 else None
+                elif fields[0] == 'ExitAddress':
+                    seen = datetime.strptime(' '.join(fields[2:4]), ExitList.FMT) if len(fields) >= 4 else None
+                    yield ExitAddress(ipaddress.ip_address(fields[1]), fingerprint, seen)
+                elif len(fields) == 1:
+                    yield ExitAddress(ipaddress.ip_address(fields[0]))
+            except (ValueError, IndexError):
+                continue
+
+
+    # Streams the list. It is requested conditionally: if nothing changed since the last complete
+    # walk, nothing is yielded and 'not_modified' is set.
+    def iter_exits(self):
+        self.not_modified = False
+        self._walked_list = None
+
+        headers = None
+        if self.last_modified is not None:
+            headers = {'If-Modified-Since': self.last_modified}
+
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            resp = self.session.get(self.api_url, headers=headers, stream=True, timeout=ExitList.TIMEOUT)
+            status = resp.status_code
+        finally:
+            metrics.PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - start, provider='exitlist', endpoint='exit_addresses', status=status)
+
+        with resp:
+            if resp.status_code == 304:
+                self.logger.debug(f"Exit list was not modified since {self.last_modified}.")
+                self.not_modified = True
+                return
+            if resp.status_code != 200:
+                raise_error(self.logger,f"Failed to retrieve exit list. Status code: {resp.status_code}")
+
+            yield from ExitList.parse_lines(resp.iter_lines())
+
+            self._walked_list = resp.headers.get('Last-Modified')
+
+
+    def mark_exits_fetched(self):
+        # Called once the walk is complete. The scanner stores the state together with the walked exits.
+        if self._walked_list is not None:
+            self.last_modified = self._walked_list
+            self._walked_list = None
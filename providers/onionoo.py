@@ -1,11 +1,19 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import time
+import metrics
 from error import raise_error
+from providers.relay import Relay
 
 class Onionoo:
 
     API_URL = "https://onionoo.torproject.org"
+    DETAILS_PAGE_SIZE = 1000
+    TIMEOUT = 60
+    LOOKUP_WORKERS = 16
     VITAL_FIELDS = ["nickname",
         "fingerprint",
         "or_addresses",
@@ -18,10 +26,11 @@ class Onionoo:
         "country",
         "verified_host_names",
         "unverified_host_names",
-        "contact"
+        "contact",
+        "as"
     ]
 
-    def __init__(self):
+    def __init__(self, cache=None, api_url: str = None):
         self.logger = logging.getLogger('Onionoo')
         self.logger.setLevel(logging.DEBUG)
         handler = logging.StreamHandler()  # Output logs to console
@@ -30,6 +39,18 @@ class Onionoo:
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
+        self.api_url = (api_url or Onionoo.API_URL).rstrip('/')
+        self.last_modified = None
+        self.relays_published = None
+        self.not_modified = False
+        self._walked_document = None
+        self.cache = cache
+
+        # Keep-alive connections shared by all lookups, one per concurrent worker
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=Onionoo.LOOKUP_WORKERS))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=Onionoo.LOOKUP_WORKERS))
+
     @staticmethod
     def _sanitize_relays(relays):
         sanitized_relays = []
@@ -38,38 +59,131 @@ class Onionoo:
             for vit_field in Onionoo.VITAL_FIELDS:
                 if vit_field in relay:
                     vital_data[vit_field] = relay[vit_field]
-            or_addr_split = [addr.split(':') for addr in vital_data['or_addresses']]
-            vital_data['or_addr'] = or_addr_split[0][0]
-            vital_data['or_port'] = int(or_addr_split[0][1])
-            vital_data.pop('or_addresses')
-            sanitized_relays.append(vital_data)
+            sanitized_relays.append(Relay.from_details(vital_data))
         
         return sanitized_relays
     
 
+    def _get(self, url: str, headers: dict = None, endpoint: str = 'details'):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            resp = self.session.get(url, headers=headers, timeout=Onionoo.TIMEOUT)
+            status = resp.status_code
+        finally:
+            metrics.PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - start, provider='onionoo', endpoint=endpoint, status=status)
+
+        if resp.status_code not in (200, 304):
+            raise_error(self.logger,f"Failed to retrieve data. Status code: {resp.status_code}")
+
+        return resp
+
+
     @staticmethod
-    def _relays_by_url(url: str):
-        resp = requests.get(url)
+    def _parse_details(content: bytes):
+        with metrics.PROVIDER_PARSE_SECONDS.time(provider='onionoo', stage='json'):
+            details = json.loads(content.decode('utf-8'))
 
-        if resp.status_code != 200:
-            raise_error(logger,f"Failed to retrieve data. Status code: {resp.status_code}")
+        with metrics.PROVIDER_PARSE_SECONDS.time(provider='onionoo', stage='sanitize'):
+            relays = Onionoo._sanitize_relays(details['relays'])
 
-        relays = json.loads(resp.content.decode('utf-8'))['relays']
-        relays = Onionoo._sanitize_relays(relays)
+        return details.get('relays_published'), relays
+
+
+    def _relays_by_url(self, url: str):
+        content = None
+        if self.cache is not None:
+            content = self.cache.get('onionoo_details', url)
+
+        if content is None:
+            content = self._get(url, endpoint='search').content
+            if self.cache is not None:
+                self.cache.set('onionoo_details', url, content)
+
+        _, relays = Onionoo._parse_details(content)
 
         return relays
         
 
-    @staticmethod
-    def ip_details(ip_addr: str):
-        rq_str = f"{Onionoo.API_URL}/details?search={ip_addr}"
+    def ip_details(self, ip_addr: str):
+        rq_str = f"{self.api_url}/details?search={ip_addr}"
         
-        return Onionoo._relays_by_url(rq_str)
+        return self._relays_by_url(rq_str)
     
 
-    @staticmethod
-    def details():
-        rq_str = f"{Onionoo.API_URL}/details?limit=50"
+    def ip_details_many(self, ip_addrs, max_workers: int = None, progress=None):
+        # Looks the addresses up concurrently. A relay found through several of its addresses is returned once.
+        # 'progress(done, total)' is called after every address.
+        if max_workers is None:
+            max_workers = Onionoo.LOOKUP_WORKERS
+
+        def lookup(ip_addr):
+            try:
+                return self.ip_details(ip_addr)
+            except Exception as e:
+                self.logger.error(f"Lookup of '{ip_addr}' failed. Details: {str(e)}")
+                return []
+
+        relays = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for done, ip_relays in enumerate(executor.map(lookup, ip_addrs), 1):
+                if progress:
+                    progress(done, len(ip_addrs))
+                for relay in ip_relays:
+                    relays[relay.fingerprint] = relay
+
+        return list(relays.values())
+    
+
+    def iter_details(self, page_size: int = None):
+        # Walks the whole details document page by page, so only one page is held in memory at a time.
+        # Relays are ordered by first_seen, which keeps the pages stable while new relays join.
+        # The first page is requested conditionally. If Onionoo has not published anything new since
+        # the last complete walk, nothing is yielded and 'not_modified' is set.
+        # A document republished during the walk shifts the offsets, so relays would be skipped. Every page
+        # has to come from the document of the first one, otherwise the walk is aborted with an error.
+        if page_size is None:
+            page_size = Onionoo.DETAILS_PAGE_SIZE
+
+        self.not_modified = False
+        self._walked_document = None
+        last_modified = None
+        relays_published = None
+        offset = 0
+        while True:
+            rq_str = f"{self.api_url}/details?order=first_seen&offset={offset}&limit={page_size}"
+
+            headers = None
+            if offset == 0 and self.last_modified is not None:
+                headers = {'If-Modified-Since': self.last_modified}
+
+            resp = self._get(rq_str, headers)
+            if resp.status_code == 304:
+                self.logger.debug(f"Details were not modified since {self.last_modified}.")
+                self.not_modified = True
+                return
+
+            published, relays = Onionoo._parse_details(resp.content)
+            if offset == 0:
+                last_modified = resp.headers.get('Last-Modified')
+                relays_published = published
+                if relays_published is not None and relays_published == self.relays_published:
+                    self.logger.debug(f"Details published at {relays_published} were already fetched.")
+                    self.not_modified = True
+                    return
+            elif published != relays_published:
+                raise_error(self.logger,f"Details were republished at {published} while walking the ones published at {relays_published}.")
+
+            yield from relays
+
+            if len(relays) < page_size:
+                self._walked_document = (last_modified, relays_published)
+                return
+            offset += page_size
 
-        return Onionoo._relays_by_url(rq_str)
 
+    def mark_details_fetched(self):
+        # Called once the walk is complete. The scanner stores the state together with the walked relays.
+        if self._walked_document is not None:
+            self.last_modified, self.relays_published = self._walked_document
+            self._walked_document = None
@@ -0,0 +1,68 @@
+import hashlib
+import ipaddress
+import json
+from typing import NamedTuple, Union
+
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+# Onionoo moves 'last_seen' of every running relay forward with each consensus. It is left out of the
+# content hash and written on its own, so relays differing in it alone are only touched, not rewritten.
+UNHASHED_FIELDS = ('last_seen',)
+
+
+# One relay of an Onionoo 'details' document. The fields up to 'content_hash' are columns
+# of 'onion_routing_hosts', so a relay is a ready row for 'execute_values'. 'or_addr' and 'or_port'
+# are the primary OR address, 'or_addresses' holds every address and port, IPv6 ones included.
+# Relays are immutable; build a new one with 'from_details' when the source data changes.
+class Relay(NamedTuple):
+    or_addr: IPAddress
+    or_port: int
+    nickname: str = None
+    fingerprint: str = None
+    last_seen: str = None
+    last_changed_address_or_port: str = None
+    first_seen: str = None
+    running: bool = None
+    country: str = None
+    verified_host_names: list = None
+    unverified_host_names: list = None
+    contact: str = None
+    as_number: str = None
+    content_hash: str = None
+    exit_addresses: tuple = ()
+    or_addresses: tuple = ()
+
+    @staticmethod
+    def _parse_address(address: str):
+        # 'addr:port' for IPv4, '[addr]:port' for IPv6
+        addr, _, port = address.rpartition(':')
+
+        return ipaddress.ip_address(addr.strip('[]')), int(port)
+
+
+    # Builds a relay from its fields in an Onionoo 'details' document. The first OR address is the primary one.
+    # Addresses are parsed and the content hash is taken once here, so ingestion works on ready values.
+    @classmethod
+    def from_details(cls, details: dict):
+        or_addresses = tuple(dict.fromkeys(Relay._parse_address(address) for address in details['or_addresses']))
+        or_addr, or_port = or_addresses[0]
+        hashed = {field: value for field, value in details.items() if field not in UNHASHED_FIELDS}
+        details_str = json.dumps(hashed, sort_keys=True, default=str)
+
+        return cls(or_addr,
+                   or_port,
+                   details.get('nickname'),
+                   details.get('fingerprint'),
+                   details.get('last_seen'),
+                   details.get('last_changed_address_or_port'),
+                   details.get('first_seen'),
+                   details.get('running'),
+                   details.get('country'),
+                   details.get('verified_host_names'),
+                   details.get('unverified_host_names'),
+                   details.get('contact'),
+                   details.get('as'),
+                   hashlib.md5(details_str.encode('utf-8')).hexdigest(),
+                   tuple(ipaddress.ip_address(addr) for addr in details.get('exit_addresses') or ()),
+                   or_addresses)
@@ -1,10 +1,53 @@
 import json
 import logging
+import random
+import threading
+import time
 import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from error import raise_error
+
+
+# Token bucket shared by all workers. 'rate' tokens are added per second, at most 'burst' are kept.
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
 
 class Shodan:
 
-    def __init__(self):
+    API_URL = "https://internetdb.shodan.io"
+    RATE = 1.0
+    BURST = 1
+    WORKERS = 4
+    MAX_RETRIES = 3
+    BACKOFF = 1.0
+    TIMEOUT = 10
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_url: str = None, rate: float = None, burst: int = None, workers: int = None, cache=None):
         self.logger = logging.getLogger('Shodan')
         self.logger.setLevel(logging.DEBUG)
         handler = logging.StreamHandler()  # Output logs to console
@@ -13,11 +56,85 @@ class Shodan:
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
+        self.api_url = (api_url or Shodan.API_URL).rstrip('/')
+        self.workers = workers or Shodan.WORKERS
+        self.rate_limiter = TokenBucket(rate or Shodan.RATE, burst or Shodan.BURST)
+        self.cache = cache
 
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+
+
+    # Returns InternetDB data of the address or None if Shodan knows nothing about it.
+    # Throttled and transient failures are retried with exponential backoff.
     def ip_info(self, ip_addr: str):
-        return requests.get(f"https://internetdb.shodan.io/{ip_addr}").json()
+        url = f"{self.api_url}/{ip_addr}"
+
+        # Answers are cached as JSON, 'null' included, so cached lookups skip the rate limiter as well
+        if self.cache is not None:
+            content = self.cache.get('shodan_internetdb', url)
+            if content is not None:
+                return json.loads(content)
+
+        info = self._fetch_ip_info(url, ip_addr)
+        if self.cache is not None:
+            self.cache.set('shodan_internetdb', url, json.dumps(info).encode('utf-8'))
+
+        return info
+
+
+    def _fetch_ip_info(self, url: str, ip_addr: str):
+        error = None
+        for attempt in range(Shodan.MAX_RETRIES + 1):
+            if attempt > 0:
+                delay = Shodan.BACKOFF * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay))
+
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(url, timeout=Shodan.TIMEOUT)
+            except requests.RequestException as e:
+                metrics.PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - start, provider='shodan', endpoint='internetdb', status='error')
+                error = e
+                continue
+            metrics.PROVIDER_REQUEST_SECONDS.observe(time.perf_counter() - start, provider='shodan', endpoint='internetdb', status=resp.status_code)
+
+            if resp.status_code == 200:
+                with metrics.PROVIDER_PARSE_SECONDS.time(provider='shodan', stage='json'):
+                    return resp.json()
+            if resp.status_code == 404:
+                return None
+            if resp.status_code not in Shodan.RETRY_STATUSES:
+                raise_error(self.logger,f"Failed to retrieve '{ip_addr}'. Status code: {resp.status_code}")
+            error = RuntimeError(f"Status code: {resp.status_code}")
+
+        raise_error(self.logger,f"Gave up on '{ip_addr}' after {Shodan.MAX_RETRIES + 1} attempts",error)
+
+
+    # Queries the addresses concurrently under the shared rate limit.
+    # Maps every address to its data (None if unknown). Addresses that failed are left out.
+    # 'progress(done, total)' is called after every address.
+    def ip_info_many(self, ip_addrs, progress=None):
+        def lookup(ip_addr):
+            try:
+                return ip_addr, True, self.ip_info(ip_addr)
+            except Exception as e:
+                self.logger.error(f"Lookup of '{ip_addr}' failed. Details: {str(e)}")
+                return ip_addr, False, None
+
+        infos = dict()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for done, (ip_addr, ok, info) in enumerate(executor.map(lookup, ip_addrs), 1):
+                if progress:
+                    progress(done, len(ip_addrs))
+                if ok:
+                    infos[ip_addr] = info
+
+        return infos
 
 
 if __name__ == "__main__":
-    sh = SShodan()
-    print(sh.ip_info("185.146.232.243"))
\ No newline at end of file
+    sh = Shodan()
+    print(sh.ip_info("185.146.232.243"))
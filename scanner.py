@@ -1,51 +1,135 @@
 import requests
 import time
+import ipaddress
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, QuotedString, register_adapter
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values, Json
 import os
 import json
 import logging
 import re
-from datetime import datetime
+import hashlib
+import select
+import threading
+import uuid
+import metrics
+from datetime import datetime, timedelta, timezone
 from error import raise_error
 from providers.onionoo import Onionoo
 from providers.shodan import Shodan
+from providers.exitlist import ExitList
+from providers.cache import ResponseCache, LRUCache
+from providers.relay import Relay
+
+
+# Relay addresses are parsed into 'ipaddress' objects once and passed to queries as they are.
+# Only the adapters are registered, addresses read back from the database stay strings.
+for _ip_type in (ipaddress.IPv4Address, ipaddress.IPv6Address):
+    register_adapter(_ip_type, lambda ip: QuotedString(str(ip)))
+
+
+# Connection which remembers the statements prepared in its session.
+class _ScannerConnection(psycopg2.extensions.connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+# Cursor counting and timing every statement it executes. Used with 'query_metrics' enabled.
+class _TimedCursor(psycopg2.extensions.cursor):
+
+    def execute(self, sql, args=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, args)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
 
 
 class Scanner:
 
     UPDATE_INT = 3600
-    CONFIG_PATH = 'config.json'
-    ALL_TABLES = {"event_types","events","edit_labels","hosts","open_ports","onion_routing_hosts","tor_exit_hosts"}
+    REFRESH_LOCK_ID = 0x5343414E
+    EXIT_LIST_LOCK_ID = 0x53434558
+    SCHEMA_LOCK_ID = 0x53434553
+    SCHEMA_FILES = ('setup.sql', 'indexes.sql')
+    SUMMARY_CHANNEL = 'scanner_summary'
+    LISTEN_POLL_INT = 1.0
+    LISTEN_RETRY_INT = 5.0
+    CONFIG_PATH = os.environ.get('SCANNER_CONFIG', 'config.json')
+    ALL_TABLES = {"event_types","events","edit_labels","hosts","open_ports","onion_routing_hosts","relay_addresses","tor_exit_hosts","shodan_hosts","host_summary"}
+    # Tables emptied by 'clear_tables'. Lookup tables and jobs are kept.
+    DATA_TABLES = ("events","hosts","open_ports","onion_routing_hosts","relay_addresses","tor_exit_hosts","shodan_hosts","host_summary",
+                   "host_summary_history","host_summary_history_months","fetch_state")
+    INGEST_CHUNK_SIZE = 5000
+    SUMMARY_PAGE_SIZE = 100
+    SUMMARY_ITERSIZE = 2000
+    SUMMARY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    SHODAN_BATCH_SIZE = 1000
+    INGEST_TABLES = ("hosts","open_ports","onion_routing_hosts","relay_addresses","tor_exit_hosts")
+    # Columns of 'onion_routing_hosts' filled from Onionoo, in the order of the 'Relay' fields
+    ONION_ROUTING_COLUMNS = Relay._fields[:Relay._fields.index('content_hash')]
+    ONION_ROUTING_ROW_SIZE = len(ONION_ROUTING_COLUMNS) + 1
 
     class select_filter:
 
-        _FILTRED_ENTRY_QUERY = """SELECT h.ip_addr, p.port, o.or_port, o.contact, o.running, o.country, o.nickname, t.exit_addr FROM hosts h
-                        LEFT JOIN onion_routing_hosts o ON h.ip_addr = o.or_addr
-                        LEFT JOIN open_ports p ON h.ip_addr = p.ip_addr
-                        LEFT JOIN tor_exit_hosts t ON t.exit_addr = h.ip_addr
+        # Summaries are read from 'host_summary', which holds one ready row per host
+        _FILTRED_ENTRY_QUERY = """SELECT s.ip_addr, s.ports, s.or_port, s.contact, s.running, s.country, s.nickname, s.exit_addr, s.as_number
+                        FROM host_summary s
                         """
+        _FILTRED_ENTRY_ORDER_BY = " ORDER BY s.ip_addr"
 
         def __init__(self):
             self._ip_addrs = None
+            self._networks = None
             self._ports = set([])
             self._onion_routing = None
             self._countries = None
+            self._asns = None
         
         
+        # IPv4 or IPv6 address. Hosts matching any of the addresses or networks pass the filter.
         def add_ip_to_filter(self, ip_addr: str) -> bool:
-            def is_valid_ipv4():
-                ipv4_pattern = r'^(\d{1,3}\.){3}\d{1,3}$'
-                return bool(re.match(ipv4_pattern, ip_addr))
+            try:
+                ip_addr = str(ipaddress.ip_address(ip_addr.strip()))
+            except ValueError:
+                return False
 
-            if is_valid_ipv4():
-                if self._ip_addrs is None:
-                    self._ip_addrs = set([ip_addr])
-                else:
-                    self._ip_addrs.add(ip_addr)
-                return True
-    
-            return False
+            if self._ip_addrs is None:
+                self._ip_addrs = set([ip_addr])
+            else:
+                self._ip_addrs.add(ip_addr)
+            return True
+
+
+        # Network in CIDR notation, e.g. '185.146.0.0/16' or '2a0b:f4c0::/32'. Host bits are ignored.
+        def add_network_to_filter(self, network: str) -> bool:
+            try:
+                network = ipaddress.ip_network(network.strip(), strict=False)
+            except ValueError:
+                return False
+
+            if self._networks is None:
+                self._networks = set([network])
+            else:
+                self._networks.add(network)
+            return True
+
+
+        # Inclusive range of addresses of the same version. Stored as the networks covering it.
+        def add_range_to_filter(self, first: str, last: str) -> bool:
+            try:
+                networks = list(ipaddress.summarize_address_range(ipaddress.ip_address(first.strip()),
+                                                                  ipaddress.ip_address(last.strip())))
+            except (ValueError, TypeError):
+                return False
+
+            for network in networks:
+                self.add_network_to_filter(str(network))
+            return True
+        
         
         def add_port_to_filter(self, port: int) -> bool:
             def is_valid_port():
@@ -77,40 +161,157 @@ class Scanner:
                 return True
             
             return False
+
+
+        # Autonomous system of the relay, as 'AS1234' or just the number
+        def add_asn_to_filter(self, asn) -> bool:
+            asn = str(asn).strip().upper()
+            if asn.startswith('AS'):
+                asn = asn[2:]
+            if not asn.isdigit() or int(asn) >= 2 ** 32:
+                return False
+
+            asn = f"AS{int(asn)}"
+            if self._asns is None:
+                self._asns = set([asn])
+            else:
+                self._asns.add(asn)
+            return True
+
+
+        # Overlapping and adjacent networks merged into as few as possible. With 'with_ips' single addresses
+        # are folded in as /32 and /128 networks.
+        def _collapsed_networks(self, with_ips=False):
+            networks = list(self._networks or ())
+            if with_ips:
+                networks += [ipaddress.ip_network(ip_addr) for ip_addr in self._ip_addrs or ()]
+
+            collapsed = []
+            for version in (4, 6):
+                collapsed += ipaddress.collapse_addresses(n for n in networks if n.version == version)
+            return [str(network) for network in collapsed]
         
         
-        def render_select_query(self):
-            sql = Scanner.select_filter._FILTRED_ENTRY_QUERY
-            
-            filters = []
+        # Filters selecting the same hosts have the same key, whatever order they were built in
+        def cache_key(self):
+            return (None if self._ip_addrs is None else tuple(sorted(self._ip_addrs)),
+                    None if self._networks is None else tuple(self._collapsed_networks()),
+                    tuple(sorted(self._ports or ())),
+                    self._onion_routing,
+                    None if self._countries is None else tuple(sorted(self._countries)),
+                    None if self._asns is None else tuple(sorted(self._asns)))
+
 
-            if self._ip_addrs is not None:
-                ip_filters = [f"h.ip_addr = '{ip}'" for ip in self._ip_addrs]
-                ip_filters_str = '(' + ' OR '.join(ip_filters) + ')'
-                filters.append(ip_filters_str)
+        # A filter without criteria selects every host
+        def is_empty(self):
+            return (self._ip_addrs is None and self._networks is None and not self._ports
+                    and self._onion_routing is None and self._countries is None and self._asns is None)
+
+
+        # Every filter becomes one parameterized clause. Values never end up in the SQL text,
+        # so the number of distinct statements stays small and their plans can be reused.
+        def _render_filters(self):
+            filters = []
+            params = dict()
+
+            # Any number of networks is one semi-join against the array, backed by the GiST index on 'ip_addr'.
+            # Addresses alone are looked up by the primary key. Next to networks they go into the same array,
+            # an OR of the two would keep the planner from using either index.
+            if self._networks is not None:
+                filters.append("EXISTS (SELECT 1 FROM unnest(%(networks)s::cidr[]) n WHERE s.ip_addr <<= n)")
+                params['networks'] = self._collapsed_networks(with_ips=True)
+            elif self._ip_addrs is not None:
+                filters.append("s.ip_addr = ANY(%(ip_addrs)s::inet[])")
+                params['ip_addrs'] = sorted(self._ip_addrs)
             if self._ports:
-                ports_filters = [f"p.port = {str(p)}" for p in self._ports]
-                ports_filters_str = '(' + ' OR '.join(ports_filters) + ')'
-                filters.append(ports_filters_str)
+                filters.append("s.ports && %(ports)s::integer[]")
+                params['ports'] = sorted(self._ports)
             if self._onion_routing is not None:
-                onion_routing_filter_str = "o.or_port IS "
+                onion_routing_filter_str = "s.or_port IS "
                 onion_routing_filter_str += "NOT " if self._onion_routing else ""
                 onion_routing_filter_str += "NULL"
                 filters.append(onion_routing_filter_str)
             if self._countries is not None:
-                country_filters = [f"o.country = '{c}'" for c in self._countries]
-                country_filters_str = '(' + ' OR '.join(country_filters) + ')'
-                filters.append(country_filters_str)
+                filters.append("s.country = ANY(%(countries)s::bpchar[])")
+                params['countries'] = sorted(self._countries)
+            if self._asns is not None:
+                filters.append("s.as_number = ANY(%(asns)s::varchar[])")
+                params['asns'] = sorted(self._asns)
+            
+            return filters, params
+
+
+        def render_select_query(self):
+            sql = Scanner.select_filter._FILTRED_ENTRY_QUERY
+            
+            filters, params = self._render_filters()
             
             if filters:
                 sql += "WHERE " + ' AND '.join(filters)
+            sql += Scanner.select_filter._FILTRED_ENTRY_ORDER_BY
             
-            return sql
+            return sql, params
 
 
-        
+        # Keyset pagination on 'ip_addr'
+        def render_page_query(self, after=None, limit=None):
+            sql = Scanner.select_filter._FILTRED_ENTRY_QUERY
+
+            filters, params = self._render_filters()
+            params['limit'] = limit
+
+            if after is not None:
+                filters.append("s.ip_addr > %(after)s::inet")
+                params['after'] = after
+
+            if filters:
+                sql += "WHERE " + ' AND '.join(filters)
+            sql += Scanner.select_filter._FILTRED_ENTRY_ORDER_BY + " LIMIT %(limit)s::integer"
+
+            return sql, params
+
+
+        # Summaries as they were at 'as_of', read from the history on from 'month', the latest seeded month
+        # 'as_of' falls in or after. Keyset pagination on 'ip_addr' as in 'render_page_query'.
+        def render_as_of_query(self, month, as_of, after=None, limit=None):
+            filters, params = self._render_filters()
+            params['month'] = month
+            params['as_of'] = as_of
+
+            # The latest row of every host, taken in the order of the index on '(ip_addr, ts, id)'
+            latest_sql = """SELECT DISTINCT ON (l.ip_addr) l.*
+                            FROM host_summary_history l
+                            WHERE l.ts >= %(month)s::timestamptz AND l.ts <= %(as_of)s::timestamptz"""
+            if after is not None:
+                latest_sql += " AND l.ip_addr > %(after)s::inet"
+                params['after'] = after
+            latest_sql += " ORDER BY l.ip_addr, l.ts DESC, l.id DESC"
+
+            sql = f"""SELECT s.ip_addr, s.ports, s.or_port, s.contact, s.running, s.country, s.nickname, s.exit_addr, s.as_number
+                    FROM ({latest_sql}) s
+                    WHERE """ + ' AND '.join(["NOT s.deleted"] + filters)
+            sql += Scanner.select_filter._FILTRED_ENTRY_ORDER_BY
+            if limit is not None:
+                sql += " LIMIT %(limit)s::integer"
+                params['limit'] = limit
+
+            return sql, params
+
+
+        # Addresses of the hosts passing the filter, for set-based writes
+        def render_addresses_query(self):
+            sql = "SELECT s.ip_addr FROM host_summary s "
+
+            filters, params = self._render_filters()
+
+            if filters:
+                sql += "WHERE " + ' AND '.join(filters)
+
+            return sql, params
 
 
+        
+
     def __init__(self):
         self.logger = logging.getLogger('Scanner')
         self.logger.setLevel(logging.DEBUG)
@@ -120,15 +321,131 @@ class Scanner:
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
-        self.onionoo = Onionoo()
-        self.shodan = Shodan()
-
         self._read_config()
 
-        self.conn = None
+        self.response_cache = ResponseCache(self.cache_max_bytes, self.cache_ttls, self.cache_path)
+        self.onionoo = Onionoo(self.response_cache, self.onionoo_api_url)
+        self.shodan = Shodan(self.shodan_api_url, self.shodan_rate, self.shodan_burst, self.shodan_workers, self.response_cache)
+        self.exit_list = ExitList(self.exit_list_url)
+
+        self.pool = None
+        self._pool_slots = threading.BoundedSemaphore(self.pool_max_size)
+        self._local = threading.local()
+        self._connect_lock = threading.Lock()
+        self._db_exists = None
+        self.last_ingest_stats = None
+
+        # Summaries are cached under the generation they were read in. Every write starts a new one.
+        self.summary_cache = None
+        if self.summary_cache_max_bytes:
+            self.summary_cache = LRUCache(self.summary_cache_max_bytes, Scanner._summaries_size)
+        self._summary_generation = 0
+        self._summary_lock = threading.Lock()
+        self._summary_listener = None
+        self._summary_listener_stop = threading.Event()
+
+
+    # Connection of the current thread. It is checked out of the pool on first use
+    # and stays with the thread until 'release_connection' is called. 'ThreadedConnectionPool'
+    # raises once all of its connections are out, so threads past 'pool_max_size' wait for one instead.
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.closed:
+            self._local.conn = None
+            self._release_pool_slot(conn)
+            conn = None
+
+        if conn is None and self.pool is not None:
+            self._pool_slots.acquire()
+            try:
+                conn = self.pool.getconn()
+            except Exception:
+                self._pool_slots.release()
+                raise
+            self._local.conn = conn
+
+        return conn
+
+
+    def _release_pool_slot(self, conn):
+        pool = self.pool
+        try:
+            if pool is not None:
+                pool.putconn(conn, close=True)
+        except Exception as e:
+            self.logger.error(f"Failed to return connection to the pool. Details: {str(e)}")
+        finally:
+            self._pool_slots.release()
+
+
+    def release_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+
+        pool = self.pool
+        try:
+            if not conn.closed:
+                conn.rollback()
+            if pool is not None:
+                pool.putconn(conn, close=bool(conn.closed))
+        except Exception as e:
+            self.logger.error(f"Failed to return connection to the pool. Details: {str(e)}")
+        finally:
+            self._pool_slots.release()
     
 
+    # Digest of the schema files, stored in 'schema_version' once they were applied
+    @staticmethod
+    def _schema_version():
+        digest = hashlib.md5()
+        for path in Scanner.SCHEMA_FILES:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+
+    def _schema_applied(self, version):
+
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                return False
+            cur.execute("SELECT version FROM schema_version")
+            row = cur.fetchone()
+        self.conn.commit()
+
+        return row is not None and row[0] == version
+
+
+    # Brings the schema up to date. ALTER TABLE and CREATE INDEX lock their tables before finding out
+    # there is nothing to do, which would queue every reader behind a running refresh. So the schema
+    # files only run when they differ from the applied ones, and one worker at a time runs them.
+    @metrics.timed_method
     def _setup_db(self):
+        version = Scanner._schema_version()
+        if self._schema_applied(version):
+            return
+
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (Scanner.SCHEMA_LOCK_ID,))
+        self.conn.commit()
+        try:
+            # Another worker may have applied it while this one waited
+            if not self._schema_applied(version):
+                self._apply_schema(version)
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (Scanner.SCHEMA_LOCK_ID,))
+            self.conn.commit()
+
+
+    def _apply_schema(self, version):
 
         with self.conn.cursor() as cur:
             with open('setup.sql', 'r') as f:
@@ -141,6 +458,41 @@ class Scanner:
 
 
         self.conn.commit()
+
+        self._ensure_indexes()
+
+        # Databases created before 'host_summary' existed get it filled once
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT NOT EXISTS (SELECT 1 FROM host_summary) AND EXISTS (SELECT 1 FROM hosts)")
+            backfill = cur.fetchone()[0]
+        if backfill:
+            self.rebuild_host_summary()
+        self.conn.commit()
+
+        # History of summaries starts on the first connect
+        with self.conn.cursor() as cur:
+            self._ensure_history_month(cur)
+            self._seed_history_months(cur)
+            cur.execute("""INSERT INTO schema_version (id, version, applied) VALUES (TRUE, %(version)s, now())
+                            ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, applied = EXCLUDED.applied""",
+                        {'version': version})
+        self.conn.commit()
+        self.logger.debug(f"Applied schema {version}.")
+
+
+    def _ensure_indexes(self):
+
+        with self.conn.cursor() as cur:
+            with open('indexes.sql', 'r') as f:
+                indexes_sql = f.read()
+
+            try:
+                cur.execute(indexes_sql)
+            except Exception as e:
+                raise_error(self.logger,f"Could not create indexes.",e)
+
+
+        self.conn.commit()
     
 
     def _check_db_clean(self):
@@ -154,7 +506,9 @@ class Scanner:
         if not any(tables_present_flags):
             self.logger.debug("No tables were found. Database is clean.")
             return True
-        raise_error(self.logger,f"Database is partially populated. Some tables are missing or corrupted.")
+        # Schema setup is idempotent and creates whatever tables are missing
+        self.logger.warning("Database is partially populated. Missing tables will be created.")
+        return False
 
     
 
@@ -180,18 +534,48 @@ class Scanner:
         self.db_port = int(config_json['port'])
         self.superuser_name = config_json['superuser_name']
         self.superuser_password = config_json['superuser_password']
+        # Each thread holds one pooled connection until it releases it: web server threads, 'JobManager'
+        # workers and the scheduler. Threads past 'pool_max_size' wait for a free connection, so it should be
+        # at least their sum. The summary listener and job state writes have connections outside the pool.
+        self.pool_min_size = int(config_json.get('pool_min_size', 1))
+        self.pool_max_size = int(config_json.get('pool_max_size', 10))
+        self.onionoo_api_url = config_json.get('onionoo_api_url')
+        self.shodan_api_url = config_json.get('shodan_api_url')
+        self.exit_list_url = config_json.get('exit_list_url')
+        self.shodan_rate = config_json.get('shodan_rate')
+        self.shodan_burst = config_json.get('shodan_burst')
+        self.shodan_workers = config_json.get('shodan_workers')
+        self.refresh_in_app = bool(config_json.get('refresh_in_app', True))
+        self.query_metrics = bool(config_json.get('query_metrics', False))
+        self.summary_cache_max_bytes = int(config_json.get('summary_cache_max_bytes', Scanner.SUMMARY_CACHE_MAX_BYTES))
+        self.cache_max_bytes = config_json.get('cache_max_bytes')
+        self.cache_ttls = config_json.get('cache_ttls')
+        self.cache_path = config_json.get('cache_path')
     
 
     def _create_tor_fetch_event(self):
+        return self._create_event("tor_fetch")
+
+
+    def _create_event(self, event_name):
 
         with self.conn.cursor() as cur:
             ts = datetime.now()
-            event_values = {'ts': ts, 'event_name': "tor_fetch", 'user_name': self.db_user}
+            event_values = {'ts': ts, 'event_name': event_name, 'user_name': self.db_user}
             event_sql = "INSERT INTO events (ts, event_name, user_name) VALUES (%(ts)s, %(event_name)s, %(user_name)s) RETURNING id"
             cur.execute(event_sql,event_values)
             event_id = cur.fetchone()[0]
 
         return event_id
+
+
+    # Records how long the run behind an event took and how many rows it went through
+    def _finish_event(self, event_id, started, row_count, stats=None):
+
+        with self.conn.cursor() as cur:
+            duration = timedelta(seconds=time.monotonic() - started)
+            sql = "UPDATE events SET duration = %s, row_count = %s, stats = %s WHERE id = %s"
+            cur.execute(sql,(duration, row_count, Json(stats) if stats is not None else None, event_id))
     
     def _touch_host_addr(self, ip_addr, event_id, edit_label):
 
@@ -206,144 +590,1128 @@ class Scanner:
                 raise_error(self.logger,f"Could not touch host addr '{ip_addr}' for event id '{event_id}'.",e)
     
 
-    def _touch_open_port(self, ip_addr, port, banner=""):
+    # Every column but the key is taken from the incoming relay, but only if any of them differs.
+    # The column list never changes, so neither do the statements.
+    _ONION_ROUTING_DATA_COLUMNS = tuple(column for column in ONION_ROUTING_COLUMNS + ('content_hash',) if column != 'fingerprint')
+    _UPSERT_ONION_ROUTING_CONFLICT = f"""ON CONFLICT (fingerprint) DO UPDATE SET
+                {', '.join(f'{column} = EXCLUDED.{column}' for column in _ONION_ROUTING_DATA_COLUMNS)}
+                WHERE ({', '.join(f'onion_routing_hosts.{column}' for column in _ONION_ROUTING_DATA_COLUMNS)})
+                    IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in _ONION_ROUTING_DATA_COLUMNS)})"""
+    _UPSERT_ONION_ROUTING_SQL = f"""INSERT INTO onion_routing_hosts
+                ({', '.join(ONION_ROUTING_COLUMNS + ('content_hash',))})
+                VALUES ({', '.join(['%s'] * ONION_ROUTING_ROW_SIZE)})
+                {_UPSERT_ONION_ROUTING_CONFLICT}
+                RETURNING (xmax = 0)"""
+
+    @staticmethod
+    def _tally_upsert(cur, counts):
+        # A one-row upsert returns whether its row was inserted, or nothing if the row was left as it was
+        row = cur.fetchone()
+        if row is None:
+            counts['unchanged'] += 1
+        elif row[0]:
+            counts['inserted'] += 1
+        else:
+            counts['updated'] += 1
+
+
+    def _upsert_onion_routing(self, relay: Relay, stats):
 
         with self.conn.cursor() as cur:
-            data = {'ip_addr': ip_addr, 'port': port, 'banner': banner}
-            sql = """INSERT INTO open_ports (ip_addr, port, banner) VALUES (%(ip_addr)s, %(port)s, %(banner)s)
-                    ON CONFLICT (ip_addr,port) DO UPDATE SET banner = EXCLUDED.banner"""
-            
             try:
-                cur.execute(sql,data)
-            except Exception as e:
-                raise_error(self.logger,f"Could not touch open ports entry for {ip_addr}:{port}.",e)
-    
-
-    def _insert_onion_routing(self, relay):
-
-        with self.conn.cursor() as cur:
-            relay_keys = list(relay.keys())
-            columns_str = ', '.join(relay_keys)
-            relay_keys_f = list(map(lambda x: f"%({x})s", relay_keys))
-            columns_vals_str = ', '.join(relay_keys_f)
-
-            sql = f"""INSERT INTO onion_routing_hosts 
-                ({columns_str})
-                VALUES ({columns_vals_str})"""
-            
-            
-            try:
-                cur.execute(sql,relay)
+                cur.execute(Scanner._UPSERT_ONION_ROUTING_SQL,relay[:Scanner.ONION_ROUTING_ROW_SIZE])
+                Scanner._tally_upsert(cur, stats['onion_routing_hosts'])
             except Exception as e:
                 raise_error(self.logger,f"Couldn't update database from Onionoo.",e)
     
 
-    def _update_onion_routing(self, relay, event_id):
-        or_addr = relay['or_addr']
-        or_port = relay['or_port']
-        exit_addresses = relay.pop('exit_addresses',None)
+    # Per-relay counterpart of '_bulk_update_onion_routing'. Rows are upserted, and only the addresses
+    # and exits the relay no longer has are deleted, so an unchanged relay costs a single lookup.
+    @metrics.timed_method
+    def _update_onion_routing(self, relay: Relay, event_id, stats=None):
+        if stats is None:
+            stats = Scanner._new_ingest_stats()
+
+        fingerprint = relay.fingerprint
+        or_addresses = relay.or_addresses
+        exit_addresses = relay.exit_addresses
+        params = {'fingerprint': fingerprint,
+                  'ip_addrs': [ip_addr for ip_addr, _ in or_addresses],
+                  'ports': [port for _, port in or_addresses],
+                  'exit_addrs': list(exit_addresses)}
 
-        self._touch_host_addr(relay['or_addr'],event_id,'OR')
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT content_hash FROM onion_routing_hosts WHERE fingerprint = %s", (fingerprint,))
+            row = cur.fetchone()
+            if row is not None and row[0] == relay.content_hash:
+                # Only 'last_seen' may have moved. It is not indexed, so the update stays on the same page.
+                cur.execute("""UPDATE onion_routing_hosts SET last_seen = %(last_seen)s
+                                WHERE fingerprint = %(fingerprint)s AND last_seen IS DISTINCT FROM %(last_seen)s::timestamp""",
+                            {'fingerprint': fingerprint, 'last_seen': relay.last_seen})
+                stats['onion_routing_hosts']['touched' if cur.rowcount else 'unchanged'] += 1
+                return stats
+
+        for ip_addr in dict.fromkeys(params['ip_addrs']):
+            self._touch_host_addr(ip_addr,event_id,'OR')
 
         with self.conn.cursor() as cur:
             cur.execute("BEGIN")
 
-            # Delete exit host with corresponding or address
-            sql = """DELETE FROM tor_exit_hosts WHERE or_addr = %s"""
+            # The relay's former addresses and exits and its new ones all get their summaries rebuilt
+            self._mark_hosts_dirty(cur, """SELECT ip_addr FROM relay_addresses WHERE fingerprint = %(fingerprint)s
+                            UNION SELECT exit_addr FROM tor_exit_hosts WHERE fingerprint = %(fingerprint)s""", params)
+            self._mark_hosts_dirty(cur, "SELECT unnest(%s::inet[])", (params['ip_addrs'] + params['exit_addrs'],))
 
-            try:
-                cur.execute(sql,(or_addr,))
-            except:
-                raise_error(self.logger,f"Could not delete tor exit hosts bound to {or_addr}.",e)
-
-            
-            # Delete onion-routing entry itself
-            sql = """DELETE FROM onion_routing_hosts WHERE or_addr = %s"""
+            # Delete exits the relay no longer has. Those on the exit list are managed by 'fetch_exit_list'.
+            sql = """DELETE FROM tor_exit_hosts WHERE fingerprint = %(fingerprint)s AND exit_addr <> ALL(%(exit_addrs)s::inet[])
+                    AND NOT exit_listed"""
 
             try:
-                cur.execute(sql,(or_addr,))
-            except:
-                raise_error(self.logger,f"Could not delete onion-routing hosts with address '{or_addr}' for reinsertion.",e)
-            
+                cur.execute(sql,params)
+                stats['tor_exit_hosts']['deleted'] += cur.rowcount
+            except Exception as e:
+                raise_error(self.logger,f"Could not delete tor exit hosts bound to {fingerprint}.",e)
 
-            # Finally, delete corresponding open_ports entry. All this for further reinsertion
-            sql = """DELETE FROM open_ports WHERE ip_addr = %s AND onion_routing IS TRUE"""
-            
+
+            # Then addresses it no longer listens on, closing the ports no other relay uses
             try:
-                cur.execute(sql,(or_addr,))
+                addresses_deleted, ports_deleted = Scanner._delete_relay_addresses(cur, """a.fingerprint = %(fingerprint)s
+                                AND (a.ip_addr, a.port) NOT IN (SELECT * FROM unnest(%(ip_addrs)s::inet[], %(ports)s::integer[]))""", params)
+                stats['relay_addresses']['deleted'] += addresses_deleted
+                stats['open_ports']['deleted'] += ports_deleted
             except Exception as e:
-                raise_error(self.logger,f"Could not delete onion-routing open ports for {or_addr}.",e)
+                raise_error(self.logger,f"Could not delete addresses of relay {fingerprint}.",e)
         
             
-            # Commence insertion in reverse order. Ports first.
-            sql = """INSERT INTO open_ports (ip_addr, port, onion_routing) VALUES (%s, %s, TRUE)"""
-
-            try:
-                cur.execute(sql,(or_addr,or_port))
-            except Exception as e:
-                raise_error(self.logger,f"Could not insert onion-routing open port '{ip_addr}:{port}'.",e)
+            # Upserts go in reverse order. Ports first.
+            sql = """INSERT INTO open_ports (ip_addr, port, onion_routing) VALUES (%s, %s, TRUE)
+                    ON CONFLICT (ip_addr, port) DO UPDATE SET onion_routing = TRUE WHERE open_ports.onion_routing IS NOT TRUE
+                    RETURNING (xmax = 0)"""
+
+            for ip_addr, port in or_addresses:
+                try:
+                    cur.execute(sql,(ip_addr,port))
+                    Scanner._tally_upsert(cur, stats['open_ports'])
+                except Exception as e:
+                    raise_error(self.logger,f"Could not insert onion-routing open port '{ip_addr}:{port}'.",e)
 
             
-            # Then onion-routing info
-            self._insert_onion_routing(relay)
+            # Then onion-routing info and its addresses
+            self._upsert_onion_routing(relay, stats)
+
+            sql = """INSERT INTO relay_addresses (fingerprint, ip_addr, port) VALUES (%s, %s, %s)
+                    ON CONFLICT (fingerprint, ip_addr, port) DO NOTHING"""
 
-            # At last, reinsert exit addresses
-            if exit_addresses is not None:
-                for exit_addr in exit_addresses:
-                    self._insert_tor_exit_host(exit_addr,or_addr,event_id)
+            for ip_addr, port in or_addresses:
+                try:
+                    cur.execute(sql,(fingerprint,ip_addr,port))
+                    stats['relay_addresses']['inserted' if cur.rowcount else 'unchanged'] += 1
+                except Exception as e:
+                    raise_error(self.logger,f"Could not insert address '{ip_addr}:{port}' of relay {fingerprint}.",e)
+
+            # At last, exit addresses
+            for exit_addr in exit_addresses:
+                self._upsert_tor_exit_host(exit_addr,fingerprint,event_id,stats)
+
+            self._refresh_host_summary(cur)
             
 
             cur.execute('COMMIT')
+
+        return stats
     
 
-    def _insert_tor_exit_host(self, exit_addr, or_addr, event_id):
+    def _upsert_tor_exit_host(self, exit_addr, fingerprint, event_id, stats):
 
         with self.conn.cursor() as cur:
             self._touch_host_addr(exit_addr,event_id,'TE')
 
-            sql = """INSERT INTO tor_exit_hosts (exit_addr, or_addr) VALUES (%s, %s)"""
+            sql = """INSERT INTO tor_exit_hosts (exit_addr, fingerprint) VALUES (%s, %s)
+                    ON CONFLICT (exit_addr) DO UPDATE SET fingerprint = EXCLUDED.fingerprint
+                    WHERE tor_exit_hosts.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+                    RETURNING (xmax = 0)"""
 
             try:
-                cur.execute(sql,(exit_addr, or_addr))
+                cur.execute(sql,(exit_addr, fingerprint))
+                Scanner._tally_upsert(cur, stats['tor_exit_hosts'])
             except Exception as e:
                 raise_error(self.logger,f"Could not touch tor exit information for '{exit_addr}'.",e)
 
 
-    def fetch_onions(self) -> int:
-        relays = self.onionoo.details()
-        event_id = self._create_tor_fetch_event()
+    # Deletes the relay addresses matching 'where', with 'a' standing for 'relay_addresses', and closes
+    # the onion-routing ports no other relay listens on. Returns the numbers of deleted addresses and ports.
+    @staticmethod
+    def _delete_relay_addresses(cur, where, params=None):
+        # Sub-statements see the addresses as they were, so the deleted ones are told apart by 'addresses'
+        cur.execute(f"""WITH addresses AS (
+                            DELETE FROM relay_addresses a WHERE {where}
+                            RETURNING a.fingerprint, a.ip_addr, a.port
+                        ), ports AS (
+                            DELETE FROM open_ports p USING addresses a
+                            WHERE p.ip_addr = a.ip_addr AND p.port = a.port AND p.onion_routing IS TRUE
+                                AND NOT EXISTS (SELECT 1 FROM relay_addresses r
+                                                WHERE r.ip_addr = p.ip_addr AND r.port = p.port
+                                                    AND NOT EXISTS (SELECT 1 FROM addresses d WHERE d.fingerprint = r.fingerprint
+                                                                        AND d.ip_addr = r.ip_addr AND d.port = r.port))
+                            RETURNING 1
+                        )
+                        SELECT (SELECT count(*) FROM addresses), (SELECT count(*) FROM ports)""", params)
+
+        return cur.fetchone()
+
+
+    # Deletes the relays whose fingerprints 'sql' selects, together with their addresses and exits.
+    # Addresses of the relays stay as hosts, just no longer bound to them. Runs in the caller's transaction.
+    def _delete_relays(self, cur, sql, params=None, stats=None):
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS doomed_relays (
+                        fingerprint CHAR(40) PRIMARY KEY
+                    ) ON COMMIT DELETE ROWS""")
+        cur.execute("TRUNCATE doomed_relays")
+        cur.execute(f"INSERT INTO doomed_relays (fingerprint) {sql} ON CONFLICT (fingerprint) DO NOTHING", params)
+
+        self._mark_hosts_dirty(cur, """SELECT a.ip_addr FROM relay_addresses a JOIN doomed_relays d ON a.fingerprint = d.fingerprint
+                        UNION SELECT t.exit_addr FROM tor_exit_hosts t JOIN doomed_relays d ON t.fingerprint = d.fingerprint""")
+
+        cur.execute("""DELETE FROM tor_exit_hosts t USING doomed_relays d WHERE t.fingerprint = d.fingerprint AND NOT t.exit_listed""")
+        exits_deleted = cur.rowcount
+        # Exits on the exit list stay, just no longer bound to a relay
+        cur.execute("""UPDATE tor_exit_hosts t SET fingerprint = NULL FROM doomed_relays d WHERE t.fingerprint = d.fingerprint""")
+
+        addresses_deleted, ports_deleted = Scanner._delete_relay_addresses(cur, "a.fingerprint IN (SELECT fingerprint FROM doomed_relays)")
+
+        cur.execute("""DELETE FROM onion_routing_hosts o USING doomed_relays d WHERE o.fingerprint = d.fingerprint""")
+        relays_deleted = cur.rowcount
+
+        if stats is not None:
+            stats['tor_exit_hosts']['deleted'] += exits_deleted
+            stats['relay_addresses']['deleted'] += addresses_deleted
+            stats['open_ports']['deleted'] += ports_deleted
+            stats['onion_routing_hosts']['deleted'] += relays_deleted
+
+        return relays_deleted
+
+
+    # One row of 'host_summary' per host. Ports are aggregated by the database. Several relays may
+    # listen on one address, the summary shows the running one seen last. 't' is joined by its
+    # primary key and has at most one row per host.
+    _HOST_SUMMARY_COLUMNS = "ip_addr, ports, or_port, contact, running, country, nickname, exit_addr, as_number"
+    _HOST_SUMMARY_QUERY = """SELECT h.ip_addr, ARRAY(SELECT p.port FROM open_ports p WHERE p.ip_addr = h.ip_addr ORDER BY p.port),
+                        o.or_port, o.contact, o.running, o.country, o.nickname, t.exit_addr, o.as_number
+                    FROM hosts h
+                    LEFT JOIN LATERAL (
+                        SELECT a.port AS or_port, r.contact, r.running, r.country, r.nickname, r.as_number
+                        FROM relay_addresses a JOIN onion_routing_hosts r ON r.fingerprint = a.fingerprint
+                        WHERE a.ip_addr = h.ip_addr
+                        ORDER BY r.running DESC, r.last_seen DESC, a.port
+                        LIMIT 1
+                    ) o ON TRUE
+                    LEFT JOIN tor_exit_hosts t ON t.exit_addr = h.ip_addr
+                    """
+
+    def _mark_hosts_dirty(self, cur, sql, params=None):
+        # 'sql' selects addresses whose summaries are out of date. They are rebuilt by '_refresh_host_summary'.
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS dirty_hosts (
+                        ip_addr INET PRIMARY KEY
+                    ) ON COMMIT DELETE ROWS""")
+        cur.execute(f"INSERT INTO dirty_hosts (ip_addr) {sql} ON CONFLICT (ip_addr) DO NOTHING", params)
+
+
+    def _refresh_host_summary(self, cur):
+        # Rebuilds the summaries of the dirty hosts. Summaries of deleted hosts go away with them.
+        # Changed summaries and deleted hosts are appended to the history.
+        month = self._ensure_history_month(cur)
+        cur.execute("ANALYZE dirty_hosts")
+        cur.execute(f"""WITH changed AS (
+                        INSERT INTO host_summary ({Scanner._HOST_SUMMARY_COLUMNS})
+                        {Scanner._HOST_SUMMARY_QUERY}
+                        WHERE h.ip_addr IN (SELECT ip_addr FROM dirty_hosts)
+                        ON CONFLICT (ip_addr) DO UPDATE SET ports = EXCLUDED.ports, or_port = EXCLUDED.or_port,
+                            contact = EXCLUDED.contact, running = EXCLUDED.running, country = EXCLUDED.country,
+                            nickname = EXCLUDED.nickname, exit_addr = EXCLUDED.exit_addr, as_number = EXCLUDED.as_number
+                        WHERE (host_summary.ports, host_summary.or_port, host_summary.contact, host_summary.running,
+                               host_summary.country, host_summary.nickname, host_summary.exit_addr, host_summary.as_number)
+                            IS DISTINCT FROM (EXCLUDED.ports, EXCLUDED.or_port, EXCLUDED.contact, EXCLUDED.running,
+                                              EXCLUDED.country, EXCLUDED.nickname, EXCLUDED.exit_addr, EXCLUDED.as_number)
+                        RETURNING {Scanner._HOST_SUMMARY_COLUMNS}
+                        )
+                        INSERT INTO host_summary_history (ts, {Scanner._HOST_SUMMARY_COLUMNS})
+                        SELECT now(), {Scanner._HOST_SUMMARY_COLUMNS} FROM changed""")
+        # A dirty address that is no longer a host was deleted, unless its last row in the month says so already
+        cur.execute("""INSERT INTO host_summary_history (ts, ip_addr, deleted)
+                        SELECT now(), d.ip_addr, TRUE FROM dirty_hosts d
+                        WHERE NOT EXISTS (SELECT 1 FROM hosts h WHERE h.ip_addr = d.ip_addr)
+                            AND (SELECT NOT l.deleted FROM host_summary_history l
+                                 WHERE l.ip_addr = d.ip_addr AND l.ts >= %s
+                                 ORDER BY l.ts DESC, l.id DESC LIMIT 1)""", (month,))
+        cur.execute("TRUNCATE dirty_hosts")
+
+
+    @staticmethod
+    def _month_start(cur, months=0):
+        cur.execute("SELECT date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => %s)", (months,))
+        return cur.fetchone()[0].replace(tzinfo=timezone.utc)
+
+
+    # Makes sure writes of the current month have a partition to go to. Partitions are normally created ahead
+    # by 'open_history_months', so this is a lookup. Returns the start of the latest seeded month: the state
+    # of every host is read from its rows on.
+    def _ensure_history_month(self, cur):
+        month = Scanner._month_start(cur)
+        self._create_history_month(cur, month)
+
+        cur.execute("SELECT max(month) FROM host_summary_history_months WHERE seeded AND month <= %s", (month,))
+        seeded = cur.fetchone()[0]
+
+        return seeded if seeded is not None else month
+
+
+    # Creates the empty partition of the month. Its summaries at the start of the month are added by
+    # '_seed_history_months'.
+    def _create_history_month(self, cur, month):
+        # Concurrent writers wait here for the one creating the month
+        cur.execute("""INSERT INTO host_summary_history_months (month, seeded) VALUES (%s, FALSE)
+                        ON CONFLICT (month) DO NOTHING""", (month,))
+        if cur.rowcount == 0:
+            return
+
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS host_summary_history_{month:y%Ym%m} PARTITION OF host_summary_history
+                        FOR VALUES FROM (%s) TO (%s)""", (month, next_month))
+        self.logger.debug(f"Created summary history partition of {month:%Y-%m}.")
+
+
+    # Every begun month starts with the summaries of all hosts at its first instant, read from the month
+    # before it, so queries need no more than one partition once the month is seeded. Until then they read
+    # on from the month before. Copies every host, so it runs out of requests: from the scheduler, on
+    # connect and when the tables are cleared.
+    def _seed_history_months(self, cur):
+        cur.execute("""SELECT month FROM host_summary_history_months WHERE NOT seeded AND month <= now()
+                        ORDER BY month FOR UPDATE""")
+        for (month,) in cur.fetchall():
+            cur.execute("SELECT max(month) FROM host_summary_history_months WHERE seeded AND month < %s", (month,))
+            previous = cur.fetchone()[0]
+            if previous is None:
+                # History starts with the summaries as they are now
+                cur.execute(f"""INSERT INTO host_summary_history (ts, {Scanner._HOST_SUMMARY_COLUMNS})
+                                SELECT now(), {Scanner._HOST_SUMMARY_COLUMNS} FROM host_summary""")
+            else:
+                cur.execute(f"""INSERT INTO host_summary_history (ts, {Scanner._HOST_SUMMARY_COLUMNS})
+                                SELECT %(month)s, {Scanner._HOST_SUMMARY_COLUMNS} FROM (
+                                    SELECT DISTINCT ON (l.ip_addr) l.* FROM host_summary_history l
+                                    WHERE l.ts >= %(previous)s AND l.ts < %(month)s
+                                    ORDER BY l.ip_addr, l.ts DESC, l.id DESC
+                                ) l
+                                WHERE NOT l.deleted""", {'month': month, 'previous': previous})
+            cur.execute("UPDATE host_summary_history_months SET seeded = TRUE WHERE month = %s", (month,))
+            self.logger.debug(f"Seeded summary history of {month:%Y-%m}.")
+
+
+    # Creates the history partitions of this month and the next one before anything is written in them,
+    # and seeds the months that have begun. Run by the refresh scheduler.
+    @metrics.timed_method
+    def open_history_months(self):
+
+        try:
+            with self.conn.cursor() as cur:
+                self._create_history_month(cur, Scanner._month_start(cur))
+                self._create_history_month(cur, Scanner._month_start(cur, 1))
+                self._seed_history_months(cur)
+            self.conn.commit()
+
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not open summary history months.",e)
+
+
+    # Recomputes the summaries of all hosts. Runs in the caller's transaction.
+    @metrics.timed_method
+    def rebuild_host_summary(self):
+
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("TRUNCATE host_summary")
+                cur.execute(f"""INSERT INTO host_summary ({Scanner._HOST_SUMMARY_COLUMNS})
+                                {Scanner._HOST_SUMMARY_QUERY}""")
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not rebuild host summaries.",e)
+
+
+    @staticmethod
+    def _new_ingest_stats():
+        # 'touched' rows only had 'last_seen' of a relay written, which is left out of its content hash
+        return {table: {'inserted': 0, 'updated': 0, 'deleted': 0, 'touched': 0, 'unchanged': 0} for table in Scanner.INGEST_TABLES}
+
+
+    # Turns named placeholders, with optional casts, into positional ones of a prepared statement
+    _PREPARED_PARAM_PATTERN = re.compile(r"%\((\w+)\)s(::[\w\[\]]+)?")
+
+    @staticmethod
+    def _execute_prepared(cur, sql, params):
+        # Runs 'sql' as a server-side prepared statement. It is prepared once per connection
+        # and every later execution reuses the cached plan.
+        positions = dict()
+        casts = dict()
+
+        def to_positional(match):
+            name, cast = match.group(1), match.group(2) or ''
+            if name not in positions:
+                positions[name] = len(positions) + 1
+                casts[name] = cast
+            return f"${positions[name]}{cast}"
+
+        prepared_sql = Scanner._PREPARED_PARAM_PATTERN.sub(to_positional, sql)
+        statement = 'stmt_' + hashlib.md5(prepared_sql.encode('utf-8')).hexdigest()[:16]
+
+        prepared_statements = cur.connection.prepared_statements
+        if statement not in prepared_statements:
+            cur.execute(f"PREPARE {statement} AS {prepared_sql}")
+            prepared_statements.add(statement)
+
+        if positions:
+            args_str = ', '.join(f"%({name})s{casts[name]}" for name in positions)
+            cur.execute(f"EXECUTE {statement} ({args_str})", params)
+        else:
+            cur.execute(f"EXECUTE {statement}")
+
+
+    def _log_ingest_stats(self, stats):
+        for table, counts in stats.items():
+            self.logger.debug(f"{table}: {counts['inserted']} inserted, {counts['updated']} updated, "
+                              f"{counts['deleted']} deleted, {counts['touched']} touched, {counts['unchanged']} unchanged.")
+
+
+    @staticmethod
+    def _execute_upsert(cur, sql, params=None):
+        # Wraps 'INSERT ... ON CONFLICT DO UPDATE' and tells inserted rows from updated ones by xmax.
+        cur.execute(f"""WITH rows AS ({sql} RETURNING (xmax = 0) AS inserted)
+                        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM rows""", params)
+
+        return cur.fetchone()
+
+
+    @metrics.timed_method
+    def _stage_relays(self, cur, relays):
+        # Temporary tables live for the whole session and are emptied on every commit
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS relays_stage (
+                        ord INTEGER NOT NULL,
+                        or_addr INET NOT NULL,
+                        or_port INTEGER NOT NULL,
+                        nickname VARCHAR(19),
+                        fingerprint CHAR(40),
+                        last_seen TIMESTAMP,
+                        last_changed_address_or_port TIMESTAMP,
+                        first_seen TIMESTAMP,
+                        running BOOLEAN,
+                        country CHAR(2),
+                        verified_host_names VARCHAR(255)[],
+                        unverified_host_names VARCHAR(255)[],
+                        contact TEXT,
+                        as_number VARCHAR(12),
+                        content_hash CHAR(32) NOT NULL
+                    ) ON COMMIT DELETE ROWS""")
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS addresses_stage (
+                        ord INTEGER NOT NULL,
+                        fingerprint CHAR(40) NOT NULL,
+                        ip_addr INET NOT NULL,
+                        port INTEGER NOT NULL
+                    ) ON COMMIT DELETE ROWS""")
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS exits_stage (
+                        ord INTEGER NOT NULL,
+                        exit_addr INET NOT NULL,
+                        fingerprint CHAR(40) NOT NULL
+                    ) ON COMMIT DELETE ROWS""")
+        # Fingerprints of every relay staged during the current transaction
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS seen_relays (
+                        fingerprint CHAR(40) PRIMARY KEY
+                    ) ON COMMIT DELETE ROWS""")
+        cur.execute("TRUNCATE relays_stage, addresses_stage, exits_stage")
+
+        # Relays already are rows in column order, only their position in the batch is added
+        row_size = Scanner.ONION_ROUTING_ROW_SIZE
+        relay_rows = []
+        address_rows = []
+        exit_rows = []
+        for ord_, relay in enumerate(relays):
+            relay_rows.append((ord_, *relay[:row_size]))
+            for ip_addr, port in relay.or_addresses:
+                address_rows.append((ord_, relay.fingerprint, ip_addr, port))
+            for exit_addr in relay.exit_addresses:
+                exit_rows.append((ord_, exit_addr, relay.fingerprint))
+
+        columns_str = ', '.join(('ord',) + Scanner.ONION_ROUTING_COLUMNS + ('content_hash',))
+        execute_values(cur, f"INSERT INTO relays_stage ({columns_str}) VALUES %s", relay_rows, page_size=1000)
+        execute_values(cur, "INSERT INTO addresses_stage (ord, fingerprint, ip_addr, port) VALUES %s", address_rows, page_size=1000)
+        execute_values(cur, "INSERT INTO exits_stage (ord, exit_addr, fingerprint) VALUES %s", exit_rows, page_size=1000)
+
+        # A relay may come twice within a batch. The last one wins, just like with per-relay updates.
+        # Temporary tables are never analyzed automatically. Without statistics the planner
+        # can't tell a handful of changed relays from a whole consensus.
+        cur.execute("ANALYZE relays_stage, addresses_stage, exits_stage")
+
+        cur.execute("""DELETE FROM relays_stage s USING relays_stage d
+                        WHERE s.fingerprint = d.fingerprint AND (s.ord, s.ctid) < (d.ord, d.ctid)""")
+        cur.execute("""INSERT INTO seen_relays (fingerprint) SELECT fingerprint FROM relays_stage
+                        ON CONFLICT (fingerprint) DO NOTHING""")
+
+        # Relays stored with the same content need no writes but for 'last_seen', which is left out of the hash.
+        # It is not indexed, so the update stays on the same page and touches no index. Such relays are
+        # counted as touched, the others with the same content as unchanged.
+        cur.execute("""UPDATE onion_routing_hosts o SET last_seen = s.last_seen FROM relays_stage s
+                        WHERE o.fingerprint = s.fingerprint AND o.content_hash = s.content_hash
+                            AND o.last_seen IS DISTINCT FROM s.last_seen""")
+        touched = cur.rowcount
+        cur.execute("""DELETE FROM relays_stage s USING onion_routing_hosts o
+                        WHERE o.fingerprint = s.fingerprint AND o.content_hash = s.content_hash""")
+        unchanged = cur.rowcount - touched
+
+        cur.execute("""DELETE FROM addresses_stage a WHERE NOT EXISTS (SELECT 1 FROM relays_stage s WHERE s.ord = a.ord)""")
+        cur.execute("""DELETE FROM exits_stage e WHERE NOT EXISTS (SELECT 1 FROM relays_stage s WHERE s.ord = e.ord)""")
+        cur.execute("""DELETE FROM exits_stage e USING exits_stage d
+                        WHERE e.exit_addr = d.exit_addr AND (e.ord, e.ctid) < (d.ord, d.ctid)""")
+
+        return touched, unchanged
+
+
+    @metrics.timed_method
+    def _bulk_update_onion_routing(self, relays, event_id, stats=None):
+        # Set-based counterpart of '_update_onion_routing' for a whole batch of relays.
+        # Relays are merged by fingerprint. Runs in the caller's transaction, so the caller has to commit.
+        if stats is None:
+            stats = Scanner._new_ingest_stats()
+
+        columns_str = ', '.join(Scanner.ONION_ROUTING_COLUMNS + ('content_hash',))
+
+        try:
+            with self.conn.cursor() as cur:
+                touched, unchanged = self._stage_relays(cur, relays)
+                stats['onion_routing_hosts']['touched'] += touched
+                stats['onion_routing_hosts']['unchanged'] += unchanged
+                params = {'event_id': event_id}
+
+                # Staged rows an upsert neither inserts nor updates were left untouched
+                cur.execute("""SELECT (SELECT count(*) FROM relays_stage),
+                                      (SELECT count(*) FROM (SELECT DISTINCT ip_addr, port FROM addresses_stage) p),
+                                      (SELECT count(*) FROM addresses_stage),
+                                      (SELECT count(*) FROM exits_stage)""")
+                relays_staged, ports_staged, addresses_staged, exits_staged = cur.fetchone()
+
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO hosts (ip_addr, last_modified_event, last_modified_label)
+                                SELECT DISTINCT ip_addr, %(event_id)s, 'OR' FROM addresses_stage
+                                ON CONFLICT (ip_addr) DO UPDATE SET last_modified_event = EXCLUDED.last_modified_event, last_modified_label = EXCLUDED.last_modified_label""", params)
+                stats['hosts']['inserted'] += inserted
+                stats['hosts']['updated'] += updated
+
+                self._mark_hosts_dirty(cur, """SELECT ip_addr FROM addresses_stage
+                                UNION SELECT exit_addr FROM exits_stage
+                                UNION SELECT a.ip_addr FROM relay_addresses a JOIN relays_stage s ON a.fingerprint = s.fingerprint
+                                UNION SELECT t.exit_addr FROM tor_exit_hosts t JOIN relays_stage s ON t.fingerprint = s.fingerprint""")
+
+                # Exits the staged relays no longer have. Exits moving to another relay are rebound by the upsert below,
+                # those on the exit list are managed by 'fetch_exit_list'.
+                cur.execute("""DELETE FROM tor_exit_hosts t USING relays_stage s
+                                WHERE t.fingerprint = s.fingerprint AND NOT t.exit_listed
+                                    AND NOT EXISTS (SELECT 1 FROM exits_stage e WHERE e.exit_addr = t.exit_addr)""")
+                stats['tor_exit_hosts']['deleted'] += cur.rowcount
+
+                # Addresses the staged relays no longer listen on
+                addresses_deleted, ports_deleted = Scanner._delete_relay_addresses(cur, """EXISTS (SELECT 1 FROM relays_stage s WHERE s.fingerprint = a.fingerprint)
+                                AND NOT EXISTS (SELECT 1 FROM addresses_stage s
+                                                WHERE s.fingerprint = a.fingerprint AND s.ip_addr = a.ip_addr AND s.port = a.port)""")
+                stats['relay_addresses']['deleted'] += addresses_deleted
+                stats['open_ports']['deleted'] += ports_deleted
+
+                # Ports first, then relays, then the addresses referencing both. Rows equal to the stored ones are not written.
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO open_ports (ip_addr, port, onion_routing)
+                                SELECT DISTINCT ip_addr, port, TRUE FROM addresses_stage
+                                ON CONFLICT (ip_addr, port) DO UPDATE SET onion_routing = TRUE WHERE open_ports.onion_routing IS NOT TRUE""")
+                stats['open_ports']['inserted'] += inserted
+                stats['open_ports']['updated'] += updated
+                stats['open_ports']['unchanged'] += ports_staged - inserted - updated
+
+                inserted, updated = Scanner._execute_upsert(cur, f"""INSERT INTO onion_routing_hosts ({columns_str})
+                                SELECT {columns_str} FROM relays_stage
+                                {Scanner._UPSERT_ONION_ROUTING_CONFLICT}""")
+                stats['onion_routing_hosts']['inserted'] += inserted
+                stats['onion_routing_hosts']['updated'] += updated
+                stats['onion_routing_hosts']['unchanged'] += relays_staged - inserted - updated
+
+                cur.execute("""INSERT INTO relay_addresses (fingerprint, ip_addr, port)
+                                SELECT fingerprint, ip_addr, port FROM addresses_stage
+                                ON CONFLICT (fingerprint, ip_addr, port) DO NOTHING""")
+                stats['relay_addresses']['inserted'] += cur.rowcount
+                stats['relay_addresses']['unchanged'] += addresses_staged - cur.rowcount
+
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO hosts (ip_addr, last_modified_event, last_modified_label)
+                                SELECT exit_addr, %(event_id)s, 'TE' FROM exits_stage
+                                ON CONFLICT (ip_addr) DO UPDATE SET last_modified_event = EXCLUDED.last_modified_event, last_modified_label = EXCLUDED.last_modified_label""", params)
+                stats['hosts']['inserted'] += inserted
+                stats['hosts']['updated'] += updated
+
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO tor_exit_hosts (exit_addr, fingerprint)
+                                SELECT exit_addr, fingerprint FROM exits_stage
+                                ON CONFLICT (exit_addr) DO UPDATE SET fingerprint = EXCLUDED.fingerprint
+                                WHERE tor_exit_hosts.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint""")
+                stats['tor_exit_hosts']['inserted'] += inserted
+                stats['tor_exit_hosts']['updated'] += updated
+                stats['tor_exit_hosts']['unchanged'] += exits_staged - inserted - updated
+
+                self._refresh_host_summary(cur)
+
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not merge {len(relays)} relays from Onionoo.",e)
+
+        return stats
+
+
+    @metrics.timed_method
+    def _purge_vanished_relays(self, stats):
+        # Removes onion-routing data of relays that were not staged during the current transaction.
+        # Only makes sense after the complete consensus was merged.
+        try:
+            with self.conn.cursor() as cur:
+                self._delete_relays(cur, """SELECT o.fingerprint FROM onion_routing_hosts o
+                                WHERE NOT EXISTS (SELECT 1 FROM seen_relays r WHERE r.fingerprint = o.fingerprint)""", stats=stats)
+
+                self._refresh_host_summary(cur)
+
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not purge relays missing from Onionoo.",e)
+
+
+    @staticmethod
+    def _chunked(iterable, size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+    # Relay count of the last finished refresh; the best guess of how many relays the next one brings
+    def _last_relays_count(self):
+
+        with self.conn.cursor() as cur:
+            cur.execute("""SELECT row_count FROM events WHERE event_name = 'tor_fetch' AND row_count IS NOT NULL
+                            ORDER BY id DESC LIMIT 1""")
+            row = cur.fetchone()
+
+        return row[0] if row else None
+
+
+    # Conditional fetch state of 'source'. It is kept in the database, so every process sees the last
+    # stored fetch, and clearing the tables makes every process fetch everything again.
+    def _load_fetch_state(self, source):
+
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT last_modified, published FROM fetch_state WHERE source = %s", (source,))
+            row = cur.fetchone()
+
+        return row if row else (None, None)
+
+
+    # Stored in the transaction of the fetched data, so a failed run is retried next time
+    @staticmethod
+    def _store_fetch_state(cur, source, last_modified, published=None):
+        cur.execute("""INSERT INTO fetch_state (source, last_modified, published) VALUES (%s, %s, %s)
+                        ON CONFLICT (source) DO UPDATE SET last_modified = EXCLUDED.last_modified, published = EXCLUDED.published""",
+                    (source, last_modified, published))
+
+
+    # 'progress(done, total)' is called after every chunk, 'total' being an estimate
+    @metrics.timed_method
+    def fetch_onions(self, bulk=True, progress=None) -> int:
+        started = time.monotonic()
+        event_id = None
+        stats = Scanner._new_ingest_stats()
+        relays_count = 0
+        relays_total = self._last_relays_count() if progress else None
+
+        # Relays are streamed from Onionoo and merged chunk by chunk within one transaction
+        try:
+            self.onionoo.last_modified, self.onionoo.relays_published = self._load_fetch_state('onionoo')
+
+            for relays in Scanner._chunked(self.onionoo.iter_details(), Scanner.INGEST_CHUNK_SIZE):
+                if event_id is None:
+                    event_id = self._create_tor_fetch_event()
+
+                if bulk:
+                    self._bulk_update_onion_routing(relays,event_id,stats)
+                else:
+                    for relay in relays:
+                        self._update_onion_routing(relay,event_id,stats)
+                relays_count += len(relays)
+
+                if progress:
+                    progress(relays_count, max(relays_total or 0, relays_count))
+
+            if self.onionoo.not_modified:
+                self.conn.rollback()
+                self.logger.debug("Onionoo has nothing new. Skipping update.")
+                return 0
+
+            if bulk and relays_count > 0:
+                self._purge_vanished_relays(stats)
 
-        for relay in relays:
-            self._update_onion_routing(relay,event_id)
+            if event_id is not None:
+                self._finish_event(event_id, started, relays_count, stats)
 
+            self.onionoo.mark_details_fetched()
+            with self.conn.cursor() as cur:
+                Scanner._store_fetch_state(cur, 'onionoo', self.onionoo.last_modified, self.onionoo.relays_published)
+
+            self._commit_write()
+
+        except Exception:
+            # A walk that failed half way, in Onionoo or in the database, leaves nothing behind
+            self.conn.rollback()
+            raise
+
+        self.last_ingest_stats = stats
+        self._log_ingest_stats(stats)
+
+        return relays_count
+
+
+    # Runs 'func' unless another process, or thread, holds the advisory lock 'lock_id'.
+    # Returns what 'func' returned or None if it was skipped.
+    def _run_exclusive(self, lock_id, func):
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))
+            locked = cur.fetchone()[0]
         self.conn.commit()
 
-        return len(relays)
-    
+        if not locked:
+            self.logger.debug("Refresh is already running elsewhere. Skipping.")
+            return None
+
+        try:
+            return func()
+        except Exception:
+            # Whatever 'func' left uncommitted must not be committed together with the unlock
+            self.conn.rollback()
+            raise
+        finally:
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+                self.conn.commit()
+            except Exception as e:
+                # The lock is held by the session, so the connection must not go back to the pool with it.
+                # A closed connection is dropped by the pool and its slot freed.
+                self.logger.error(f"Failed to release refresh lock. Closing the connection. Details: {str(e)}")
+                conn = getattr(self._local, 'conn', None)
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+
+    # Runs 'fetch_onions' unless another process, or thread, is already doing it.
+    # Returns the number of fetched relays or None if the refresh was skipped.
+    @metrics.timed_method
+    def refresh_onions(self, progress=None):
+        return self._run_exclusive(Scanner.REFRESH_LOCK_ID, lambda: self.fetch_onions(progress=progress))
+
+
+    # Loads the whole Tor exit list under one 'exit_list_fetch' event. Listed exits are bound to their
+    # relay if it is known, exits no longer listed are dropped. Returns the number of listed addresses.
+    # 'progress(done, total)' is called after every chunk, 'total' being an estimate.
+    @metrics.timed_method
+    def fetch_exit_list(self, progress=None) -> int:
+        started = time.monotonic()
+        stats = Scanner._new_ingest_stats()
+        exits_count = 0
+        exits_total = self._last_exits_count() if progress else None
+
+        try:
+            self.exit_list.last_modified, _ = self._load_fetch_state('exit_list')
+
+            with self.conn.cursor() as cur:
+                cur.execute("""CREATE TEMP TABLE IF NOT EXISTS exit_list_stage (
+                                exit_addr INET NOT NULL,
+                                fingerprint CHAR(40),
+                                seen TIMESTAMP
+                            ) ON COMMIT DELETE ROWS""")
+                cur.execute("TRUNCATE exit_list_stage")
+
+                # The list is parsed as it is downloaded and staged chunk by chunk
+                for exits in Scanner._chunked(self.exit_list.iter_exits(), Scanner.INGEST_CHUNK_SIZE):
+                    execute_values(cur, "INSERT INTO exit_list_stage (exit_addr, fingerprint, seen) VALUES %s", exits, page_size=1000)
+                    exits_count += len(exits)
+
+                    if progress:
+                        progress(exits_count, max(exits_total or 0, exits_count))
+
+                # An empty list is taken for a broken download rather than for Tor having no exits
+                if self.exit_list.not_modified or exits_count == 0:
+                    self.conn.rollback()
+                    self.logger.debug("Exit list has nothing new. Skipping update.")
+                    return 0
+
+                event_id = self._create_event("exit_list_fetch")
+                params = {'event_id': event_id}
+                cur.execute("ANALYZE exit_list_stage")
+
+                # An address used by several relays is kept once, with the relay that used it last.
+                # Relays never fetched from Onionoo are not referenced.
+                cur.execute("""DELETE FROM exit_list_stage s USING exit_list_stage d
+                                WHERE s.exit_addr = d.exit_addr
+                                    AND (COALESCE(s.seen, '-infinity'), s.ctid) < (COALESCE(d.seen, '-infinity'), d.ctid)""")
+                cur.execute("""UPDATE exit_list_stage s SET fingerprint = NULL
+                                WHERE s.fingerprint IS NOT NULL AND NOT EXISTS (SELECT 1 FROM onion_routing_hosts o WHERE o.fingerprint = s.fingerprint)""")
+
+                # Only exits joining or leaving the list change summaries
+                self._mark_hosts_dirty(cur, """SELECT s.exit_addr FROM exit_list_stage s
+                                WHERE NOT EXISTS (SELECT 1 FROM tor_exit_hosts t WHERE t.exit_addr = s.exit_addr)
+                                UNION SELECT t.exit_addr FROM tor_exit_hosts t
+                                WHERE t.exit_listed AND NOT EXISTS (SELECT 1 FROM exit_list_stage s WHERE s.exit_addr = t.exit_addr)""")
+
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO hosts (ip_addr, last_modified_event, last_modified_label)
+                                SELECT s.exit_addr, %(event_id)s, 'TE' FROM exit_list_stage s
+                                WHERE NOT EXISTS (SELECT 1 FROM tor_exit_hosts t WHERE t.exit_addr = s.exit_addr AND t.exit_listed)
+                                ON CONFLICT (ip_addr) DO UPDATE SET last_modified_event = EXCLUDED.last_modified_event, last_modified_label = EXCLUDED.last_modified_label""", params)
+                stats['hosts']['inserted'] += inserted
+                stats['hosts']['updated'] += updated
+
+                # Exits no longer listed. Their relays lose the content hash, so the next relay refresh rewrites them
+                # instead of skipping them as unchanged, and exits still reported by Onionoo come back with it.
+                cur.execute("""WITH delisted AS (
+                                    DELETE FROM tor_exit_hosts t
+                                    WHERE t.exit_listed AND NOT EXISTS (SELECT 1 FROM exit_list_stage s WHERE s.exit_addr = t.exit_addr)
+                                    RETURNING t.fingerprint
+                                ), rehashed AS (
+                                    UPDATE onion_routing_hosts o SET content_hash = NULL
+                                    WHERE o.fingerprint IN (SELECT d.fingerprint FROM delisted d) AND o.content_hash IS NOT NULL
+                                )
+                                SELECT count(*) FROM delisted""")
+                stats['tor_exit_hosts']['deleted'] += cur.fetchone()[0]
+
+                inserted, updated = Scanner._execute_upsert(cur, """INSERT INTO tor_exit_hosts (exit_addr, fingerprint, exit_listed, exit_seen)
+                                SELECT exit_addr, fingerprint, TRUE, seen FROM exit_list_stage
+                                ON CONFLICT (exit_addr) DO UPDATE SET fingerprint = COALESCE(EXCLUDED.fingerprint, tor_exit_hosts.fingerprint),
+                                    exit_listed = TRUE, exit_seen = EXCLUDED.exit_seen
+                                WHERE (tor_exit_hosts.fingerprint, tor_exit_hosts.exit_listed, tor_exit_hosts.exit_seen)
+                                    IS DISTINCT FROM (COALESCE(EXCLUDED.fingerprint, tor_exit_hosts.fingerprint), TRUE, EXCLUDED.exit_seen)""")
+                stats['tor_exit_hosts']['inserted'] += inserted
+                stats['tor_exit_hosts']['updated'] += updated
+
+                cur.execute("SELECT count(*) FROM exit_list_stage")
+                exits_count = cur.fetchone()[0]
+                stats['tor_exit_hosts']['unchanged'] += exits_count - inserted - updated
+
+                self._refresh_host_summary(cur)
+
+                self.exit_list.mark_exits_fetched()
+                Scanner._store_fetch_state(cur, 'exit_list', self.exit_list.last_modified)
+
+            self._finish_event(event_id, started, exits_count, stats)
+            self._commit_write()
+
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not store the Tor exit list.",e)
+        self.last_ingest_stats = stats
+        self._log_ingest_stats(stats)
+
+        return exits_count
+
+
+    # Exit address count of the last finished exit list fetch
+    def _last_exits_count(self):
+
+        with self.conn.cursor() as cur:
+            cur.execute("""SELECT row_count FROM events WHERE event_name = 'exit_list_fetch' AND row_count IS NOT NULL
+                            ORDER BY id DESC LIMIT 1""")
+            row = cur.fetchone()
+
+        return row[0] if row else None
+
+
+    # Runs 'fetch_exit_list' unless another process, or thread, is already doing it
+    @metrics.timed_method
+    def refresh_exit_list(self, progress=None):
+        return self._run_exclusive(Scanner.EXIT_LIST_LOCK_ID, lambda: self.fetch_exit_list(progress=progress))
+
+
+    # Tells whether the address is a known Tor exit, by a point lookup on the primary key of 'tor_exit_hosts'.
+    # Returns None for addresses that are not.
+    @metrics.timed_method
+    def tor_exit_info(self, ip_addr):
+
+        with self.conn.cursor() as cur:
+            Scanner._execute_prepared(cur, """SELECT t.exit_addr, t.fingerprint, t.exit_listed, t.exit_seen
+                            FROM tor_exit_hosts t WHERE t.exit_addr = %(ip_addr)s::inet""", {'ip_addr': ip_addr})
+            row = cur.fetchone()
+
+        self.conn.rollback()
+
+        if row is None:
+            return None
+
+        return {'ip_addr': row[0], 'fingerprint': row[1], 'exit_listed': row[2],
+                'exit_seen': row[3].isoformat() if row[3] is not None else None}
+
+
+    # Autocommit connection outside the pool, for sessions that live as long as the process
+    def session_connection(self):
+        conn = psycopg2.connect(user=self.db_user,
+                                password=self.db_password,
+                                database=self.db_name,
+                                host=self.db_host,
+                                port=self.db_port)
+        conn.autocommit = True
+
+        return conn
+
+
+    # Session connection listening to 'channel'
+    def listen_connection(self, channel):
+        try:
+            conn = self.session_connection()
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {channel}")
+        except Exception as e:
+            raise_error(self.logger,f"Could not listen to '{channel}'.",e)
+
+        return conn
+
+
+    # Rough size of cached summaries. Only has to be in proportion for the cache to keep its memory cap.
+    @staticmethod
+    def _summaries_size(summaries):
+        return 64 + sum(320 + 8 * len(summary['ports'] or ()) for summary in summaries)
+
+
+    def _invalidate_summaries(self):
+        with self._summary_lock:
+            self._summary_generation += 1
+        if self.summary_cache is not None:
+            self.summary_cache.clear()
+
+
+    # Commits a transaction that changed host data. Cached summaries are dropped here and,
+    # once the notification is delivered on commit, in every other process.
+    def _commit_write(self):
+        with self.conn.cursor() as cur:
+            cur.execute(f"NOTIFY {Scanner.SUMMARY_CHANNEL}")
+        self.conn.commit()
+        self._invalidate_summaries()
+
+
+    def _cached_summaries(self, key, load):
+        if self.summary_cache is None:
+            return load()
+
+        with self._summary_lock:
+            key = (self._summary_generation,) + key
+
+        # A result read during a write is stored under the generation before it and never served
+        value = self.summary_cache.get(key)
+        if value is None:
+            value = load()
+            if value is None:
+                return None
+            self.summary_cache.set(key, value)
+
+        # Cached rows are shared between threads, callers get rows of their own
+        return Scanner._copy_summaries(value)
+
 
+    @staticmethod
+    def _copy_summaries(summaries):
+        copies = []
+        for summary in summaries:
+            summary = dict(summary)
+            if summary['ports'] is not None:
+                summary['ports'] = list(summary['ports'])
+            copies.append(summary)
+
+        return copies
+
+
+    def _start_summary_listener(self):
+        if self.summary_cache is None or self._summary_listener is not None:
+            return
+
+        self._summary_listener_stop.clear()
+        self._summary_listener = threading.Thread(target=self._listen_for_summary_changes, name='summary-listener', daemon=True)
+        self._summary_listener.start()
+
+
+    def _stop_summary_listener(self):
+        if self._summary_listener is None:
+            return
+
+        self._summary_listener_stop.set()
+        self._summary_listener.join()
+        self._summary_listener = None
+
+
+    # Drops cached summaries whenever another process commits a write
+    def _listen_for_summary_changes(self):
+        while not self._summary_listener_stop.is_set():
+            conn = None
+            try:
+                conn = self.listen_connection(Scanner.SUMMARY_CHANNEL)
+                # Writes made while nobody was listening are unknown
+                self._invalidate_summaries()
+
+                while not self._summary_listener_stop.is_set():
+                    if select.select([conn], [], [], Scanner.LISTEN_POLL_INT) != ([], [], []):
+                        conn.poll()
+                        if conn.notifies:
+                            conn.notifies.clear()
+                            self._invalidate_summaries()
+
+            except Exception as e:
+                self.logger.error(f"Lost summary notification connection. Details: {str(e)}")
+                self._summary_listener_stop.wait(Scanner.LISTEN_RETRY_INT)
+
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+    @metrics.timed_method
     def fetch_host_info_from_tor(self, ip_addr: str) -> int:
         relays = self.onionoo.ip_details(ip_addr)
         if relays:
             event_id = self._create_tor_fetch_event()
 
-            for relay in relays:
-                self._update_onion_routing(relay,event_id)
+            self.last_ingest_stats = self._bulk_update_onion_routing(relays,event_id)
 
-            self.conn.commit()
+            self._commit_write()
 
         return len(relays)
     
 
+    # 'progress(done, total)' is called as the addresses are looked up
+    @metrics.timed_method
+    def fetch_hosts_info_from_tor(self, ip_addrs, progress=None) -> int:
+        relays = self.onionoo.ip_details_many(ip_addrs, progress=progress)
+        if relays:
+            event_id = self._create_tor_fetch_event()
+            stats = Scanner._new_ingest_stats()
+
+            for chunk in Scanner._chunked(relays, Scanner.INGEST_CHUNK_SIZE):
+                self._bulk_update_onion_routing(chunk,event_id,stats)
+
+            self._commit_write()
+            self.last_ingest_stats = stats
+
+        return len(relays)
+
+
     def fetch_host_info_from_shodan(self, ip_addr: str) -> bool:
-        data = self.shodan.ip_info(ip_addr)
-        if data.get("detail") == "No information available":
-            return False
+        return self.enrich_from_shodan([ip_addr]) > 0
+
+
+    def _unenriched_hosts(self, limit):
+
+        with self.conn.cursor() as cur:
+            cur.execute("""SELECT h.ip_addr FROM hosts h
+                            WHERE NOT EXISTS (SELECT 1 FROM shodan_hosts s WHERE s.ip_addr = h.ip_addr)
+                            ORDER BY h.ip_addr LIMIT %s""", (limit,))
+            ip_addrs = [row[0] for row in cur]
+
+        self.conn.rollback()
+
+        return ip_addrs
+
+
+    # Enriches the given hosts, or up to 'limit' hosts never looked up before, with Shodan InternetDB data.
+    # Everything found is written under one 'shodan_fetch' event. Returns the number of hosts Shodan knew.
+    # 'progress(done, total)' is called as the addresses are looked up.
+    @metrics.timed_method
+    def enrich_from_shodan(self, ip_addrs=None, limit=None, progress=None) -> int:
+        if ip_addrs is None:
+            ip_addrs = self._unenriched_hosts(limit or Scanner.SHODAN_BATCH_SIZE)
+        if not ip_addrs:
+            return 0
+
+        started = time.monotonic()
+        infos = self.shodan.ip_info_many(ip_addrs, progress)
+        if not infos:
+            return 0
+
+        # Hosts unknown to Shodan are stored too, with empty data, so they count as enriched
+        host_rows = []
+        port_rows = []
+        for ip_addr, info in infos.items():
+            info = info or dict()
+            host_rows.append((ip_addr, info.get('hostnames') or [], info.get('cpes') or [],
+                              info.get('tags') or [], info.get('vulns') or []))
+            for port in info.get('ports') or []:
+                port_rows.append((ip_addr, port))
+
+        try:
+            event_id = self._create_event("shodan_fetch")
+
+            with self.conn.cursor() as cur:
+                cur.execute("""CREATE TEMP TABLE IF NOT EXISTS shodan_stage (
+                                ip_addr INET NOT NULL,
+                                hostnames VARCHAR(255)[] NOT NULL,
+                                cpes TEXT[] NOT NULL,
+                                tags TEXT[] NOT NULL,
+                                vulns TEXT[] NOT NULL
+                            ) ON COMMIT DELETE ROWS""")
+                cur.execute("""CREATE TEMP TABLE IF NOT EXISTS shodan_ports_stage (
+                                ip_addr INET NOT NULL,
+                                port INTEGER NOT NULL
+                            ) ON COMMIT DELETE ROWS""")
+                cur.execute("TRUNCATE shodan_stage, shodan_ports_stage")
+
+                execute_values(cur, "INSERT INTO shodan_stage (ip_addr, hostnames, cpes, tags, vulns) VALUES %s", host_rows, page_size=1000)
+                execute_values(cur, "INSERT INTO shodan_ports_stage (ip_addr, port) VALUES %s", port_rows, page_size=1000)
+                cur.execute("ANALYZE shodan_stage, shodan_ports_stage")
+
+                cur.execute("""INSERT INTO hosts (ip_addr, last_modified_event, last_modified_label)
+                                SELECT ip_addr, %(event_id)s, 'SH' FROM shodan_stage
+                                ON CONFLICT (ip_addr) DO UPDATE SET last_modified_event = EXCLUDED.last_modified_event, last_modified_label = EXCLUDED.last_modified_label""",
+                            {'event_id': event_id})
+
+                cur.execute("""INSERT INTO shodan_hosts (ip_addr, hostnames, cpes, tags, vulns, last_modified_event)
+                                SELECT ip_addr, hostnames, cpes, tags, vulns, %(event_id)s FROM shodan_stage
+                                ON CONFLICT (ip_addr) DO UPDATE SET hostnames = EXCLUDED.hostnames, cpes = EXCLUDED.cpes,
+                                    tags = EXCLUDED.tags, vulns = EXCLUDED.vulns, last_modified_event = EXCLUDED.last_modified_event""",
+                            {'event_id': event_id})
+
+                # Scanned ports Shodan no longer reports are closed. Onion-routing ports are managed by Tor fetches.
+                cur.execute("""DELETE FROM open_ports p USING shodan_stage s
+                                WHERE p.ip_addr = s.ip_addr AND p.onion_routing IS FALSE
+                                    AND NOT EXISTS (SELECT 1 FROM shodan_ports_stage ps WHERE ps.ip_addr = p.ip_addr AND ps.port = p.port)""")
+                ports_deleted = cur.rowcount
+
+                cur.execute("""INSERT INTO open_ports (ip_addr, port, onion_routing)
+                                SELECT ip_addr, port, FALSE FROM shodan_ports_stage
+                                ON CONFLICT (ip_addr, port) DO NOTHING""")
+                ports_inserted = cur.rowcount
+
+                self._mark_hosts_dirty(cur, "SELECT ip_addr FROM shodan_stage")
+                self._refresh_host_summary(cur)
+
+            self._finish_event(event_id, started, len(infos))
+            self._commit_write()
+
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not store Shodan data for {len(infos)} hosts.",e)
+
+        self.logger.debug(f"Shodan: {len(infos)} hosts stored, {ports_inserted} ports opened, {ports_deleted} ports closed.")
+
+        return sum(1 for info in infos.values() if info)
     
 
     def _get_superuser_connection(self):
         try:
             super_conn = psycopg2.connect(user=self.superuser_name,
-                                        password=self.superuser_password)
+                                        password=self.superuser_password,
+                                        host=self.db_host,
+                                        port=self.db_port)
             super_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
             super_conn.autocommit = True
         except Exception as e:
@@ -353,45 +1721,69 @@ class Scanner:
 
 
     def db_initialized(self):
+        # The answer is cached for the life of the process. 'create_database' and 'drop_database' keep it up to date.
+        if self._db_exists is not None:
+            return self._db_exists
+
         try:
-            if self.conn is not None:
+            if self.pool is not None:
+                self._db_exists = True
                 return True
             
-            with self._get_superuser_connection() as super_conn:
+            super_conn = self._get_superuser_connection()
+            try:
                 with super_conn.cursor() as cur:
                     cur.execute("""SELECT datname FROM pg_database WHERE datname = %s""",(self.db_name,))
 
-                    return cur.fetchone() is not None
+                    self._db_exists = cur.fetchone() is not None
+            finally:
+                super_conn.close()
+
+            return self._db_exists
 
         except Exception as e:
             raise_error(self.logger,f"Failed to check for db existence.",e)
     
 
+    @metrics.timed_method
     def db_connect(self) -> bool:
         try:
-            if self.conn is not None:
+            if self.pool is not None:
                 return True
 
-            if not self.db_initialized():
-                msg = f"Database '{self.db_name}' does not exist. Details: {str(e)}"
-                return False
-    
-            try:
-                self.conn = psycopg2.connect(user=self.db_user,
-                                            password=self.db_password,
-                                            database=self.db_name)
-            except Exception as e:
-                msg = f"Database '{self.db_name}' exists but failed to connect. Details: {e}"
-                return False
-            
-            try:
-                is_db_clean = self._check_db_clean()
-            except:
-                msg = f"Connected to database but it is corrupted. Details: {str(e)}"
-                return False
-            
-            if is_db_clean:
-                self._setup_db()
+            with self._connect_lock:
+                if self.pool is not None:
+                    return True
+
+                if not self.db_initialized():
+                    msg = f"Database '{self.db_name}' does not exist."
+                    return False
+        
+                try:
+                    self.pool = ThreadedConnectionPool(self.pool_min_size,
+                                                    self.pool_max_size,
+                                                    user=self.db_user,
+                                                    password=self.db_password,
+                                                    database=self.db_name,
+                                                    host=self.db_host,
+                                                    port=self.db_port,
+                                                    connection_factory=_ScannerConnection,
+                                                    cursor_factory=_TimedCursor if self.query_metrics else None)
+                except Exception as e:
+                    msg = f"Database '{self.db_name}' exists but failed to connect. Details: {e}"
+                    return False
+                
+                try:
+                    self._check_db_clean()
+                    self._setup_db()
+                except Exception as e:
+                    msg = f"Connected to database but it is corrupted. Details: {str(e)}"
+                    self.release_connection()
+                    self.pool.closeall()
+                    self.pool = None
+                    return False
+
+                self._start_summary_listener()
             
         except Exception as e:
             msg = f"Failed to connect to database '{self.db_name}'. Details: {str(e)}"
@@ -400,18 +1792,23 @@ class Scanner:
         return True
     
 
+    @metrics.timed_method
     def drop_database(self):
         try:
-            if self.conn is None:
+            if self.pool is None:
                 print("Not connected")
                 return False
 
-            self.conn.close()
-            self.conn = None
+            self._stop_summary_listener()
+            self.release_connection()
+            self.pool.closeall()
+            self.pool = None
+            self._invalidate_summaries()
             super_conn = self._get_superuser_connection()
             with super_conn.cursor() as cur:
                 cur.execute(f"""DROP DATABASE {self.db_name};""")
             super_conn.close()
+            self._db_exists = False
 
 
         except Exception as e:
@@ -422,6 +1819,7 @@ class Scanner:
         return True
     
 
+    @metrics.timed_method
     def create_database(self):
         try:
             if self.db_initialized():
@@ -431,6 +1829,7 @@ class Scanner:
             with super_conn.cursor() as cur:
                 cur.execute(f"""CREATE DATABASE {self.db_name} OWNER {self.db_user};""")
             super_conn.close()
+            self._db_exists = True
             connection_status = self.db_connect()
             if not connection_status:
                 raise RuntimeError("Successfuly created database but failed to connect.")
@@ -443,94 +1842,240 @@ class Scanner:
         return True
     
 
+    @metrics.timed_method
     def get_all_summary(self):
         empty_filter = Scanner.select_filter()
         return self.get_filtered_summary(empty_filter)
     
 
-    def delete_host(self, ip_addr) -> bool:
+    # Filter selecting the given IP-addresses and CIDR networks. Returns the filter and the rejected entries.
+    @staticmethod
+    def filter_from_addresses(addrs):
+        filter_ = Scanner.select_filter()
+        invalid_addrs = []
+        for addr in addrs:
+            addr = str(addr).strip()
+            if not addr:
+                continue
+            added = filter_.add_network_to_filter(addr) if '/' in addr else filter_.add_ip_to_filter(addr)
+            if not added:
+                invalid_addrs.append(addr)
+
+        return filter_, invalid_addrs
+
+
+    # Deletes every host passing the filter in one transaction, with a fixed number of set-based statements
+    # whatever the number of hosts. Relays listening on the deleted addresses go too, their other addresses
+    # and exits stay as hosts. Returns the number of deleted hosts.
+    @metrics.timed_method
+    def delete_hosts(self, filter_) -> int:
+        # Deleting everything is what 'clear_tables' is for
+        if filter_.is_empty():
+            raise_error(self.logger,f"Refusing to delete hosts by an empty filter.")
 
         try:
             with self.conn.cursor() as cur:
-                sql = """DELETE FROM tor_exit_hosts WHERE exit_addr = %s OR or_addr = %s"""
-                cur.execute(sql,(ip_addr,ip_addr))
+                cur.execute("""CREATE TEMP TABLE IF NOT EXISTS doomed_hosts (
+                                ip_addr INET PRIMARY KEY
+                            ) ON COMMIT DELETE ROWS""")
+                cur.execute("TRUNCATE doomed_hosts")
+                sql, params = filter_.render_addresses_query()
+                cur.execute(f"INSERT INTO doomed_hosts (ip_addr) {sql}", params)
+                hosts_count = cur.rowcount
+                if hosts_count == 0:
+                    self.conn.rollback()
+                    return 0
+                cur.execute("ANALYZE doomed_hosts")
+                self._mark_hosts_dirty(cur, "SELECT ip_addr FROM doomed_hosts")
+
+                self._delete_relays(cur, "SELECT a.fingerprint FROM relay_addresses a JOIN doomed_hosts d ON a.ip_addr = d.ip_addr")
+
+                cur.execute("DELETE FROM tor_exit_hosts t USING doomed_hosts d WHERE t.exit_addr = d.ip_addr")
+                cur.execute("DELETE FROM shodan_hosts s USING doomed_hosts d WHERE s.ip_addr = d.ip_addr")
+                cur.execute("DELETE FROM open_ports p USING doomed_hosts d WHERE p.ip_addr = d.ip_addr")
+                # Summaries of the deleted hosts go away with them
+                cur.execute("DELETE FROM hosts h USING doomed_hosts d WHERE h.ip_addr = d.ip_addr")
+                hosts_count = cur.rowcount
+
+                self._refresh_host_summary(cur)
+
+            self._commit_write()
 
-                sql = """DELETE FROM onion_routing_hosts WHERE or_addr = %s"""
-                cur.execute(sql,(ip_addr,))
+        except Exception as e:
+            self.conn.rollback()
+            raise_error(self.logger,f"Could not delete hosts.",e)
 
-                sql = """DELETE FROM open_ports WHERE ip_addr = %s"""
-                cur.execute(sql,(ip_addr,))
+        self.logger.debug(f"Deleted {hosts_count} hosts.")
 
-                sql = """DELETE FROM hosts WHERE ip_addr = %s"""
-                cur.execute(sql,(ip_addr,))
-            
-            self.conn.commit()
+        return hosts_count
 
-        except Exception as e:
-            msg = f"Failed to delete '{ip_addr}'. Details: {str(e)}"
+
+    @metrics.timed_method
+    def delete_host(self, ip_addr) -> bool:
+        filter_, invalid_addrs = Scanner.filter_from_addresses([ip_addr])
+        if invalid_addrs or filter_.is_empty():
             return False
-        
+
+        try:
+            self.delete_hosts(filter_)
+        except Exception:
+            return False
+
         return True
     
 
+    # Empties the data tables in one statement. The schema and the lookup tables stay as they are.
+    # The conditional fetch state is one of the data tables, so no process skips the next fetches as 'not modified'.
+    @metrics.timed_method
     def clear_tables(self) -> bool:
 
         try:
             with self.conn.cursor() as cur:
-                tables_str = ', '.join(Scanner.ALL_TABLES)
-                cur.execute(f"DROP TABLE {tables_str} CASCADE")
-                
-                self._setup_db()
-            self.conn.commit()
+                tables_str = ', '.join(Scanner.DATA_TABLES)
+                cur.execute(f"TRUNCATE {tables_str} RESTART IDENTITY")
+                # History starts over from the empty tables, so seeding copies nothing
+                self._ensure_history_month(cur)
+                self._seed_history_months(cur)
+            self._commit_write()
 
         except Exception as e:
-            msg = f"Failed to delete '{ip_addr}'. Details: {str(e)}"
+            self.conn.rollback()
+            self.logger.error(f"Failed to clear tables. Details: {str(e)}")
             return False
         
         return True
     
 
+    @staticmethod
+    def _clean_summary(host):
+        clean_summary = dict()
+        clean_summary['ip_addr'] = host[0]
+        clean_summary['ports'] = host[1]
+        clean_summary['or_port'] = host[2]
+        clean_summary['contact'] = host[3]
+        clean_summary['running'] = host[4]
+        clean_summary['country'] = host[5]
+        clean_summary['nickname']= host[6]
+        clean_summary['exit_addr'] = host[7]
+        clean_summary['as_number'] = host[8]
+        clean_summary['is_exit'] = host[7] is not None
+        clean_summary['is_onion_routing'] = host[2] is not None
+
+        return clean_summary
+
+
+    # Streams summaries through a server-side cursor. Only 'SUMMARY_ITERSIZE' rows are held at a time.
+    def iter_filtered_summary(self, filter_):
+        with self.conn.cursor(name=f"summary_{uuid.uuid4().hex}") as cur:
+            cur.itersize = Scanner.SUMMARY_ITERSIZE
+            sql, params = filter_.render_select_query()
+            cur.execute(sql, params)
+
+            for host in cur:
+                yield Scanner._clean_summary(host)
+
+
+    @metrics.timed_method
     def get_filtered_summary(self, filter_):
         
         try:
-            with self.conn.cursor() as cur:
-                sql = filter_.render_select_query()
-                cur.execute(sql)
-                summaries = cur.fetchall()
-
-                host_ports = dict()
-
-                clean_summaries = []
-
-                for host in summaries:
-                    clean_summary = dict()
-                    clean_summary['ip_addr'] = ip_addr = host[0]
-                    clean_summary['or_port'] = host[2]
-                    port = host[1]
-                    clean_summary['contact'] = host[3]
-                    clean_summary['running'] = host[4]
-                    clean_summary['country'] = host[5]
-                    clean_summary['nickname']= host[6]
-                    clean_summary['exit_addr'] = host[7]
-
-                    if ip_addr not in host_ports:
-                        host_ports[ip_addr] = [port]
-                        clean_summaries.append(clean_summary)
-                    else:
-                        host_ports[ip_addr].append(port)
-                
-                for i,host in enumerate(clean_summaries):
-                    host['ports'] = host_ports[host['ip_addr']]
-                    host['is_exit'] = host['exit_addr'] is not None
-                    host['is_onion_routing'] = host['or_port'] is not None
-                
-                return clean_summaries
+            summaries = self._cached_summaries(('all', filter_.cache_key()),
+                                               lambda: list(self.iter_filtered_summary(filter_)))
 
         except Exception as e:
             msg = f"Failed to select filtered. Details: {str(e)}"
             print(msg)
             return None
 
+        return summaries
+
+
+    # Returns at most 'page_size' hosts with addresses greater than 'after' and the cursor of the next page.
+    # The cursor is None when there are no more pages.
+    @metrics.timed_method
+    def get_filtered_summary_page(self, filter_, after=None, page_size=None):
+        if page_size is None:
+            page_size = Scanner.SUMMARY_PAGE_SIZE
+
+        def load():
+            with self.conn.cursor() as cur:
+                sql, params = filter_.render_page_query(after, page_size)
+                self._execute_prepared(cur, sql, params)
+                return [Scanner._clean_summary(host) for host in cur]
+
+        try:
+            summaries = self._cached_summaries(('page', filter_.cache_key(), after, page_size), load)
+
+        except Exception as e:
+            msg = f"Failed to select filtered page. Details: {str(e)}"
+            print(msg)
+            return None, None
+
+        next_after = summaries[-1]['ip_addr'] if len(summaries) == page_size else None
+
+        return summaries, next_after
+
+
+    # Start of the history month holding 'as_of'. None if history does not reach back that far.
+    def _history_month_of(self, as_of):
+
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT max(month) FROM host_summary_history_months WHERE seeded AND month <= %s::timestamptz", (as_of,))
+            return cur.fetchone()[0]
+
+
+    # Streams summaries as they were at 'as_of' through a server-side cursor, like 'iter_filtered_summary'
+    def iter_filtered_summary_as_of(self, filter_, as_of):
+        month = self._history_month_of(as_of)
+        if month is None:
+            return
+
+        with self.conn.cursor(name=f"summary_{uuid.uuid4().hex}") as cur:
+            cur.itersize = Scanner.SUMMARY_ITERSIZE
+            sql, params = filter_.render_as_of_query(month, as_of)
+            cur.execute(sql, params)
+
+            for host in cur:
+                yield Scanner._clean_summary(host)
+
+
+    # Summaries as they were at 'as_of'. Past states never change, so they are not cached.
+    @metrics.timed_method
+    def get_filtered_summary_as_of(self, filter_, as_of):
+
+        try:
+            return list(self.iter_filtered_summary_as_of(filter_, as_of))
+
+        except Exception as e:
+            msg = f"Failed to select filtered as of {as_of}. Details: {str(e)}"
+            print(msg)
+            return None
+
+
+    @metrics.timed_method
+    def get_filtered_summary_page_as_of(self, filter_, as_of, after=None, page_size=None):
+        if page_size is None:
+            page_size = Scanner.SUMMARY_PAGE_SIZE
+
+        try:
+            month = self._history_month_of(as_of)
+            if month is None:
+                return [], None
+
+            with self.conn.cursor() as cur:
+                sql, params = filter_.render_as_of_query(month, as_of, after, page_size)
+                self._execute_prepared(cur, sql, params)
+                summaries = [Scanner._clean_summary(host) for host in cur]
+
+        except Exception as e:
+            msg = f"Failed to select filtered page as of {as_of}. Details: {str(e)}"
+            print(msg)
+            return None, None
+
+        next_after = summaries[-1]['ip_addr'] if len(summaries) == page_size else None
+
+        return summaries, next_after
+
 
 scanner = Scanner()
 
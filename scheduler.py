@@ -0,0 +1,108 @@
+import logging
+import random
+import threading
+import time
+from scanner import scanner, Scanner
+
+
+# Refreshes Tor relays and the exit list every 'Scanner.UPDATE_INT' seconds, give or take 'jitter'.
+# A refresh can also be requested early with 'trigger'. Refreshes requested from the web app run as jobs instead.
+# Runs in a background thread of the web app or, with 'refresh_in_app' disabled, as a separate worker:
+#
+#     python scheduler.py
+class RefreshScheduler:
+
+    JITTER = 0.1
+    POLL_INT = 1.0
+
+    def __init__(self, scanner: Scanner, interval: float = Scanner.UPDATE_INT, jitter: float = JITTER):
+        self.logger = logging.getLogger('RefreshScheduler')
+        self.logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()  # Output logs to console
+        handler.setLevel(logging.DEBUG)  # Set the desired logging level for this handler
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        self.logger.addHandler(handler)
+
+        self.scanner = scanner
+        self.interval = interval
+        self.jitter = jitter
+
+        self._triggered = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name='refresh-scheduler', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def trigger(self):
+        self._triggered.set()
+
+
+    def _next_delay(self):
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+    # Waits up to 'timeout' seconds for a trigger. True if one came.
+    def _wait(self, timeout):
+        return self._triggered.wait(timeout)
+
+
+    def _refresh(self):
+        self._triggered.clear()
+        try:
+            if not self.scanner.db_connect():
+                self.logger.debug("Database is not available. Skipping refresh.")
+                return
+
+            # Partitions are created and seeded here, so no request has to copy a month of summaries
+            try:
+                self.scanner.open_history_months()
+            except Exception as e:
+                self.logger.error(f"Opening summary history months failed. Details: {str(e)}")
+
+            try:
+                relays_count = self.scanner.refresh_onions()
+                if relays_count is not None:
+                    self.logger.debug(f"Refresh done, {relays_count} relays fetched.")
+            except Exception as e:
+                self.logger.error(f"Refresh failed. Details: {str(e)}")
+
+            # Exits are bound to relays already fetched, so the exit list goes second
+            exits_count = self.scanner.refresh_exit_list()
+            if exits_count is not None:
+                self.logger.debug(f"Exit list refresh done, {exits_count} exits fetched.")
+        except Exception as e:
+            self.logger.error(f"Refresh failed. Details: {str(e)}")
+        finally:
+            self.scanner.release_connection()
+
+
+    def run(self):
+        deadline = time.monotonic() + self._next_delay()
+
+        while not self._stopped.is_set():
+            timeout = min(self.POLL_INT, max(0, deadline - time.monotonic()))
+            requested = self._wait(timeout)
+
+            if requested or time.monotonic() >= deadline:
+                self._refresh()
+                deadline = time.monotonic() + self._next_delay()
+
+
+if __name__ == "__main__":
+    scheduler = RefreshScheduler(scanner)
+    scheduler.trigger()
+    scheduler.run()
@@ -1,10 +1,18 @@
+-- Digest of setup.sql and indexes.sql as last applied. Scanner runs them only when it differs.
+CREATE TABLE IF NOT EXISTS schema_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version CHAR(32) NOT NULL,
+    applied TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS event_types (
     event_name VARCHAR(20) PRIMARY KEY,
     event_description VARCHAR(255) NOT NULL
 );
 
-INSERT INTO event_types (event_name, event_description) VALUES ('tor_fetch', 'Hosts information was fetched from Tor Project resources.');
-INSERT INTO event_types (event_name, event_description) VALUES ('shodan_fetch', 'Hosts information was fetched with Shodan.');
+INSERT INTO event_types (event_name, event_description) VALUES ('tor_fetch', 'Hosts information was fetched from Tor Project resources.') ON CONFLICT (event_name) DO NOTHING;
+INSERT INTO event_types (event_name, event_description) VALUES ('shodan_fetch', 'Hosts information was fetched with Shodan.') ON CONFLICT (event_name) DO NOTHING;
+INSERT INTO event_types (event_name, event_description) VALUES ('exit_list_fetch', 'Tor exit addresses were fetched from the exit list.') ON CONFLICT (event_name) DO NOTHING;
 
 CREATE TABLE IF NOT EXISTS events
 (
@@ -12,7 +20,10 @@ CREATE TABLE IF NOT EXISTS events
     ts TIMESTAMP WITH TIME ZONE NOT NULL,
     event_name VARCHAR(20) NOT NULL REFERENCES event_types(event_name),
     user_name VARCHAR(32) NOT NULL,
-    comment VARCHAR(255)
+    comment VARCHAR(255),
+    duration INTERVAL,
+    row_count INTEGER,
+    stats JSONB
 );
 
 
@@ -23,8 +34,9 @@ CREATE TABLE IF NOT EXISTS edit_labels
 );
 
 
-INSERT INTO edit_labels (id, label_description) VALUES ('TE', 'Host information was found in some Tor relay Exit addresses list.');
-INSERT INTO edit_labels (id, label_description) VALUES ('OR', 'Host information was found in Onion Relays list.');
+INSERT INTO edit_labels (id, label_description) VALUES ('TE', 'Host information was found in some Tor relay Exit addresses list.') ON CONFLICT (id) DO NOTHING;
+INSERT INTO edit_labels (id, label_description) VALUES ('OR', 'Host information was found in Onion Relays list.') ON CONFLICT (id) DO NOTHING;
+INSERT INTO edit_labels (id, label_description) VALUES ('SH', 'Host information was fetched from Shodan InternetDB.') ON CONFLICT (id) DO NOTHING;
 
 
 CREATE TABLE IF NOT EXISTS hosts (
@@ -43,11 +55,24 @@ CREATE TABLE IF NOT EXISTS open_ports (
 );
 
 
+-- Relays used to be keyed by their first OR address. Such tables are dropped once, together with
+-- the onion-routing ports and the summaries built from them. The next Tor fetch loads the relays again.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = 'public' AND table_name = 'tor_exit_hosts' AND column_name = 'or_addr') THEN
+        DROP TABLE tor_exit_hosts, onion_routing_hosts;
+        DROP TABLE IF EXISTS host_summary;
+        DELETE FROM open_ports WHERE onion_routing IS TRUE;
+    END IF;
+END $$;
+
+
 CREATE TABLE IF NOT EXISTS onion_routing_hosts (
-    or_addr INET PRIMARY KEY REFERENCES hosts(ip_addr),
+    fingerprint CHAR(40) PRIMARY KEY,
+    or_addr INET NOT NULL REFERENCES hosts(ip_addr),
     or_port INTEGER NOT NULL,
     nickname VARCHAR(19) NOT NULL,
-    fingerprint CHAR(40) NOT NULL,
     last_seen TIMESTAMP NOT NULL,
     last_changed_address_or_port TIMESTAMP NOT NULL,
     first_seen TIMESTAMP NOT NULL,
@@ -57,12 +82,109 @@ CREATE TABLE IF NOT EXISTS onion_routing_hosts (
     verified_host_names VARCHAR(255)[],
     unverified_host_names VARCHAR(255)[],
     contact TEXT,
+    as_number VARCHAR(12),
+    content_hash CHAR(32)
+);
 
-    FOREIGN KEY (or_addr, or_port) REFERENCES open_ports(ip_addr, port)
+
+-- Every OR address and port of every relay. Several relays may share an address.
+CREATE TABLE IF NOT EXISTS relay_addresses (
+    fingerprint CHAR(40) REFERENCES onion_routing_hosts(fingerprint),
+    ip_addr INET,
+    port INTEGER,
+
+    PRIMARY KEY(fingerprint, ip_addr, port),
+    FOREIGN KEY (ip_addr, port) REFERENCES open_ports(ip_addr, port)
 );
 
 
 CREATE TABLE IF NOT EXISTS tor_exit_hosts (
     exit_addr INET PRIMARY KEY REFERENCES hosts(ip_addr),
-    or_addr INET REFERENCES onion_routing_hosts(or_addr)
-);
\ No newline at end of file
+    fingerprint CHAR(40) REFERENCES onion_routing_hosts(fingerprint),
+    exit_listed BOOLEAN NOT NULL DEFAULT FALSE,    -- the address is on the Tor exit list
+    exit_seen TIMESTAMP                            -- when the exit list last saw the address exiting
+);
+
+
+CREATE TABLE IF NOT EXISTS shodan_hosts (
+    ip_addr INET PRIMARY KEY REFERENCES hosts(ip_addr),
+    hostnames VARCHAR(255)[] NOT NULL,
+    cpes TEXT[] NOT NULL,
+    tags TEXT[] NOT NULL,
+    vulns TEXT[] NOT NULL,
+    last_modified_event INTEGER NOT NULL REFERENCES events(id)
+);
+
+
+
+-- One row per host with everything the summary pages show. Kept up to date by Scanner on every write.
+CREATE TABLE IF NOT EXISTS host_summary (
+    ip_addr INET PRIMARY KEY REFERENCES hosts(ip_addr) ON DELETE CASCADE,
+    ports INTEGER[] NOT NULL,
+    or_port INTEGER,
+    contact TEXT,
+    running BOOLEAN,
+    country CHAR(2),
+    nickname VARCHAR(19),
+    exit_addr INET,
+    as_number VARCHAR(12)
+);
+
+
+-- Summaries as they changed over time. Rows are only appended: one per changed summary, and one marked
+-- 'deleted' per deleted host. Every month is a partition of its own. Once seeded by the scheduler, it also
+-- starts with the summaries of all hosts at its first instant, so the state at any moment is read from
+-- a single partition.
+CREATE TABLE IF NOT EXISTS host_summary_history (
+    id BIGSERIAL,
+    ip_addr INET NOT NULL,
+    ts TIMESTAMP WITH TIME ZONE NOT NULL,
+    ports INTEGER[],
+    or_port INTEGER,
+    contact TEXT,
+    running BOOLEAN,
+    country CHAR(2),
+    nickname VARCHAR(19),
+    exit_addr INET,
+    as_number VARCHAR(12),
+    deleted BOOLEAN NOT NULL DEFAULT FALSE
+) PARTITION BY RANGE (ts);
+
+-- Months with a partition. A seeded one holds the summaries at its start.
+CREATE TABLE IF NOT EXISTS host_summary_history_months (
+    month TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+    seeded BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+
+-- State of the conditional requests to Onionoo and the exit list, stored with the data it was fetched into
+CREATE TABLE IF NOT EXISTS fetch_state (
+    source VARCHAR(16) PRIMARY KEY,
+    last_modified TEXT,
+    published TEXT
+);
+
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    status VARCHAR(16) NOT NULL CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    progress INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    result JSONB,
+    error TEXT,
+    created TIMESTAMP WITH TIME ZONE NOT NULL,
+    started TIMESTAMP WITH TIME ZONE,
+    finished TIMESTAMP WITH TIME ZONE
+);
+
+-- Columns added after the tables were first created
+ALTER TABLE onion_routing_hosts ADD COLUMN IF NOT EXISTS content_hash CHAR(32);
+ALTER TABLE events ADD COLUMN IF NOT EXISTS duration INTERVAL;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS row_count INTEGER;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS stats JSONB;
+ALTER TABLE onion_routing_hosts ADD COLUMN IF NOT EXISTS as_number VARCHAR(12);
+ALTER TABLE host_summary ADD COLUMN IF NOT EXISTS as_number VARCHAR(12);
+ALTER TABLE tor_exit_hosts ADD COLUMN IF NOT EXISTS exit_listed BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE tor_exit_hosts ADD COLUMN IF NOT EXISTS exit_seen TIMESTAMP;
+ALTER TABLE host_summary_history_months ADD COLUMN IF NOT EXISTS seeded BOOLEAN NOT NULL DEFAULT TRUE;
\ No newline at end of file
@@ -0,0 +1,24 @@
+import json
+import os
+import sys
+import tempfile
+
+
+# Modules importing 'scanner' build the module-level Scanner, which reads its config on import.
+# Tests never connect, so a config naming an unreachable database is enough.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'SCANNER_CONFIG' not in os.environ:
+    _config = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump({
+        "db_name": "scanner_test",
+        "db_user": "scanner",
+        "db_password": "scanner",
+        "host": "localhost",
+        "port": 5432,
+        "superuser_name": "postgres",
+        "superuser_password": "postgres",
+    }, _config)
+    _config.close()
+    os.environ['SCANNER_CONFIG'] = _config.name
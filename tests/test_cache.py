@@ -0,0 +1,56 @@
+from providers.cache import LRUCache
+
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = LRUCache(10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+
+    cache.set('c', b'cccc')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('c') == b'cccc'
+    assert cache.stats()['bytes'] == 8
+
+
+def test_replacing_an_entry_keeps_the_size_right():
+    cache = LRUCache(10)
+    cache.set('a', b'aaaa')
+    cache.set('a', b'aaaaaa')
+
+    assert cache.get('a') == b'aaaaaa'
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'entries': 1, 'bytes': 6}
+
+
+def test_values_larger_than_the_cache_are_not_stored():
+    cache = LRUCache(4)
+    cache.set('a', b'aa')
+    cache.set('b', b'bbbbb')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aa'
+
+
+def test_expired_entries_are_dropped(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('providers.cache.time.monotonic', lambda: now[0])
+    cache = LRUCache(10)
+    cache.set('a', b'aaaa', ttl=5)
+    cache.set('b', b'bbbb')
+
+    now[0] += 6
+
+    assert cache.get('a') is None
+    assert cache.get('b') == b'bbbb'
+    assert cache.stats()['entries'] == 1
+
+
+def test_custom_sizeof():
+    cache = LRUCache(100, sizeof=lambda value: 60)
+    cache.set('a', [1])
+    cache.set('b', [2])
+
+    assert cache.get('a') is None
+    assert cache.get('b') == [2]
@@ -0,0 +1,43 @@
+import ipaddress
+from datetime import datetime
+
+from providers.exitlist import ExitAddress, ExitList
+
+
+TORDNSEL = """@type tordnsel 1.0
+Downloaded 2024-01-01 12:00:00
+ExitNode 0011bd2485ad45d984ec4159c88fc066e5e3300e
+Published 2024-01-01 10:13:27
+LastStatus 2024-01-01 11:00:00
+ExitAddress 162.247.74.201 2024-01-01 11:09:44
+ExitAddress 2001:db8::5 2024-01-01 11:10:00
+ExitNode 00C4B4731658D3B4987132A3F77100CFCB190D97
+Published 2024-01-01 10:00:00
+ExitAddress 185.220.101.7
+"""
+
+
+def test_tordnsel_format():
+    exits = list(ExitList.parse_lines(TORDNSEL.splitlines()))
+
+    assert exits == [
+        ExitAddress(ipaddress.ip_address("162.247.74.201"), "0011BD2485AD45D984EC4159C88FC066E5E3300E",
+                    datetime(2024, 1, 1, 11, 9, 44)),
+        ExitAddress(ipaddress.ip_address("2001:db8::5"), "0011BD2485AD45D984EC4159C88FC066E5E3300E",
+                    datetime(2024, 1, 1, 11, 10)),
+        ExitAddress(ipaddress.ip_address("185.220.101.7"), "00C4B4731658D3B4987132A3F77100CFCB190D97", None),
+    ]
+
+
+def test_bulk_exit_list():
+    lines = [b"# bulk exit list\n", b"162.247.74.201\n", b"\n", b"2001:db8::5\n"]
+
+    assert list(ExitList.parse_lines(lines)) == [ExitAddress(ipaddress.ip_address("162.247.74.201")),
+                                                  ExitAddress(ipaddress.ip_address("2001:db8::5"))]
+
+
+def test_malformed_lines_are_skipped():
+    lines = ["ExitNode", "ExitAddress", "ExitAddress 999.1.1.1 2024-01-01 11:09:44",
+             "ExitAddress 10.0.0.1 2024-13-01 11:09:44", "not-an-address", "10.0.0.2"]
+
+    assert list(ExitList.parse_lines(lines)) == [ExitAddress(ipaddress.ip_address("10.0.0.2"))]
@@ -0,0 +1,80 @@
+import csv
+import io
+import ipaddress
+import json
+
+import pytest
+
+import export
+from export import EXPORT_COLUMNS, iter_csv, iter_export, iter_ndjson
+
+
+def _summary(index, ports=(443, 9001), exit_addr=None):
+    return {
+        'ip_addr': ipaddress.ip_address(f"10.0.{index // 256}.{index % 256}"),
+        'ports': list(ports) if ports is not None else None,
+        'or_port': 9001,
+        'contact': "Админ <admin@example.org>",
+        'running': True,
+        'country': "de",
+        'nickname': f"relay{index}",
+        'exit_addr': exit_addr,
+        'as_number': "AS24940",
+        'is_exit': exit_addr is not None,
+        'is_onion_routing': True,
+    }
+
+
+def test_csv(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_CHUNK_ROWS', 2)
+    summaries = [_summary(0), _summary(1, ports=None), _summary(2, exit_addr=ipaddress.ip_address("10.1.0.1"))]
+
+    chunks = list(iter_csv(iter(summaries)))
+    rows = list(csv.reader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+
+    # One chunk per 'EXPORT_CHUNK_ROWS' rows, the header goes with the first
+    assert len(chunks) == 2
+    assert rows[0] == list(EXPORT_COLUMNS)
+    assert rows[1][:4] == ["10.0.0.0", "443 9001", "9001", "Админ <admin@example.org>"]
+    assert rows[2][1] == ""
+    assert rows[3][EXPORT_COLUMNS.index('exit_addr')] == "10.1.0.1"
+    assert rows[3][EXPORT_COLUMNS.index('is_exit')] == "True"
+
+
+def test_csv_of_nothing_is_the_header():
+    assert b''.join(iter_csv(iter(()))).decode('utf-8').strip() == ','.join(EXPORT_COLUMNS)
+
+
+def test_ndjson(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_CHUNK_ROWS', 2)
+    summaries = [_summary(index) for index in range(3)]
+
+    chunks = list(iter_ndjson(iter(summaries)))
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+
+    assert len(chunks) == 2
+    assert [json.loads(line)['ip_addr'] for line in lines] == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+    assert json.loads(lines[0]) == dict(_summary(0), ip_addr="10.0.0.0")
+    assert "Админ" in lines[0]
+
+
+def test_ndjson_of_nothing():
+    assert list(iter_ndjson(iter(()))) == []
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        iter_export(None, 'xml')
+
+
+def test_parquet(monkeypatch):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    monkeypatch.setattr(export, 'EXPORT_CHUNK_ROWS', 2)
+    summaries = [_summary(index) for index in range(3)]
+
+    table = pq.read_table(io.BytesIO(b''.join(export.iter_parquet(iter(summaries)))))
+
+    assert table.num_rows == 3
+    assert table.column('ip_addr').to_pylist() == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+    assert table.column('ports').to_pylist()[0] == [443, 9001]
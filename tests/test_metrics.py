@@ -0,0 +1,64 @@
+import pytest
+
+from metrics import Registry
+
+
+def test_counter():
+    registry = Registry()
+    counter = registry.counter('jobs_total', "Jobs run.", ('kind',))
+    counter.inc(kind='tor_fetch')
+    counter.inc(2, kind='tor_fetch')
+    counter.inc(0.5, kind='shodan_fetch')
+
+    assert registry.render() == ('# HELP jobs_total Jobs run.\n'
+                                 '# TYPE jobs_total counter\n'
+                                 'jobs_total{kind="shodan_fetch"} 0.5\n'
+                                 'jobs_total{kind="tor_fetch"} 3\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('request_seconds', "Request time.", buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(2)
+
+    lines = registry.render().splitlines()
+
+    assert lines[1] == '# TYPE request_seconds histogram'
+    assert lines[2:] == ['request_seconds_bucket{le="0.1"} 1',
+                         'request_seconds_bucket{le="1"} 2',
+                         'request_seconds_bucket{le="+Inf"} 3',
+                         'request_seconds_count 3',
+                         'request_seconds_sum 2.55']
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.counter('errors_total', "Errors.", ('method',)).inc(method='a"b\\c\nd')
+
+    assert 'errors_total{method="a\\"b\\\\c\\nd"} 1' in registry.render()
+
+
+def test_wrong_labels_are_refused():
+    counter = Registry().counter('errors_total', "Errors.", ('method',))
+
+    with pytest.raises(ValueError):
+        counter.inc(endpoint='index')
+
+
+def test_names_are_registered_once():
+    registry = Registry()
+    registry.counter('errors_total', "Errors.")
+
+    with pytest.raises(ValueError):
+        registry.counter('errors_total', "Errors.")
+
+
+def test_callback_is_read_at_render_time():
+    registry = Registry()
+    size = [1]
+    registry.callback('cache_bytes', "Cache size.", 'gauge', lambda: size[0])
+    size[0] = 42
+
+    assert registry.render().splitlines()[1:] == ['# TYPE cache_bytes gauge', 'cache_bytes 42']
@@ -0,0 +1,52 @@
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from providers.onionoo import Onionoo
+from benchmarks.synthetic import PUBLISHED, generate_details_document
+
+
+PAGE_SIZE = 10
+
+
+# Serves pages of a synthetic details document. 'republish_at' is the offset from which pages
+# come from a document published an hour later.
+def _onionoo(monkeypatch, relays_count, republish_at=None):
+    onionoo = Onionoo()
+
+    def get(url, headers=None, endpoint='details'):
+        query = dict(field.split('=') for field in url.split('?')[1].split('&'))
+        offset, limit = int(query['offset']), int(query['limit'])
+        published = PUBLISHED
+        if republish_at is not None and offset >= republish_at:
+            published += timedelta(hours=1)
+        document = generate_details_document(relays_count, offset=offset, limit=limit, published=published)
+        return SimpleNamespace(status_code=200, content=json.dumps(document).encode('utf-8'),
+                               headers={'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+
+    monkeypatch.setattr(onionoo, '_get', get)
+    return onionoo
+
+
+def test_walks_every_page(monkeypatch):
+    onionoo = _onionoo(monkeypatch, 25)
+
+    relays = list(onionoo.iter_details(PAGE_SIZE))
+    onionoo.mark_details_fetched()
+
+    assert len(relays) == 25
+    assert onionoo.relays_published is not None
+
+
+def test_document_republished_during_the_walk_aborts_it(monkeypatch):
+    onionoo = _onionoo(monkeypatch, 35, republish_at=2 * PAGE_SIZE)
+
+    with pytest.raises(RuntimeError):
+        list(onionoo.iter_details(PAGE_SIZE))
+    onionoo.mark_details_fetched()
+
+    # Nothing is taken for walked, the next run starts over
+    assert onionoo.relays_published is None
+    assert onionoo.last_modified is None
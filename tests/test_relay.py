@@ -0,0 +1,63 @@
+import ipaddress
+
+from providers.relay import Relay
+
+
+DETAILS = {
+    "nickname": "relay0",
+    "fingerprint": "0011BD2485AD45D984EC4159C88FC066E5E3300E",
+    "or_addresses": ["185.220.101.1:9001", "[2001:db8::1]:443", "185.220.101.1:9001"],
+    "exit_addresses": ["185.220.101.2"],
+    "last_seen": "2024-01-01 10:00:00",
+    "first_seen": "2023-01-01 00:00:00",
+    "running": True,
+    "country": "de",
+    "as": "AS24940",
+    "contact": "admin@example.org",
+}
+
+
+def test_fields_are_parsed():
+    relay = Relay.from_details(DETAILS)
+
+    assert relay.or_addr == ipaddress.ip_address("185.220.101.1")
+    assert relay.or_port == 9001
+    assert relay.nickname == "relay0"
+    assert relay.as_number == "AS24940"
+    assert relay.exit_addresses == (ipaddress.ip_address("185.220.101.2"),)
+
+
+def test_or_addresses_are_unique_and_keep_their_order():
+    relay = Relay.from_details(DETAILS)
+
+    assert relay.or_addresses == ((ipaddress.ip_address("185.220.101.1"), 9001),
+                                  (ipaddress.ip_address("2001:db8::1"), 443))
+
+
+def test_missing_optional_fields():
+    relay = Relay.from_details({"or_addresses": ["[2001:db8::2]:9001"]})
+
+    assert relay.or_addr == ipaddress.ip_address("2001:db8::2")
+    assert relay.fingerprint is None
+    assert relay.exit_addresses == ()
+
+
+def test_content_hash_ignores_last_seen():
+    relay = Relay.from_details(DETAILS)
+    seen_later = Relay.from_details(dict(DETAILS, last_seen="2024-01-01 11:00:00"))
+
+    assert seen_later.last_seen == "2024-01-01 11:00:00"
+    assert seen_later.content_hash == relay.content_hash
+
+
+def test_content_hash_follows_other_fields():
+    relay = Relay.from_details(DETAILS)
+
+    assert Relay.from_details(dict(DETAILS, running=False)).content_hash != relay.content_hash
+    assert Relay.from_details(dict(DETAILS, exit_addresses=[])).content_hash != relay.content_hash
+
+
+def test_content_hash_ignores_key_order():
+    reordered = dict(reversed(list(DETAILS.items())))
+
+    assert Relay.from_details(reordered).content_hash == Relay.from_details(DETAILS).content_hash
@@ -0,0 +1,113 @@
+from scanner import Scanner
+
+
+def _filter(ip_addrs=(), networks=(), ports=(), countries=(), asns=(), onion_routing=None):
+    filter_ = Scanner.select_filter()
+    for ip_addr in ip_addrs:
+        assert filter_.add_ip_to_filter(ip_addr)
+    for network in networks:
+        assert filter_.add_network_to_filter(network)
+    for port in ports:
+        assert filter_.add_port_to_filter(port)
+    for country in countries:
+        assert filter_.add_country_to_filter(country)
+    for asn in asns:
+        assert filter_.add_asn_to_filter(asn)
+    if onion_routing is not None:
+        filter_.set_onion_routing_filter(onion_routing)
+    return filter_
+
+
+def test_empty_filter_selects_every_host():
+    sql, params = Scanner.select_filter().render_select_query()
+
+    assert "WHERE" not in sql
+    assert sql.rstrip().endswith("ORDER BY s.ip_addr")
+    assert params == {}
+
+
+def test_addresses_alone_are_looked_up_by_key():
+    sql, params = _filter(ip_addrs=[" 10.0.0.2", "10.0.0.1"]).render_select_query()
+
+    assert "s.ip_addr = ANY(%(ip_addrs)s::inet[])" in sql
+    assert "unnest" not in sql
+    assert params == {'ip_addrs': ["10.0.0.1", "10.0.0.2"]}
+
+
+def test_addresses_next_to_networks_are_folded_into_one_semi_join():
+    sql, params = _filter(ip_addrs=["10.0.0.1", "2001:db8::1", "192.168.1.1"], networks=["192.168.0.0/16"]).render_select_query()
+
+    assert sql.count("EXISTS (SELECT 1 FROM unnest(%(networks)s::cidr[]) n WHERE s.ip_addr <<= n)") == 1
+    assert "ip_addrs" not in params
+    assert " OR " not in sql
+    assert params['networks'] == ["10.0.0.1/32", "192.168.0.0/16", "2001:db8::1/128"]
+
+
+def test_networks_are_collapsed():
+    _, params = _filter(networks=["10.0.0.0/25", "10.0.0.128/25", "10.0.0.7/8"]).render_select_query()
+
+    assert params['networks'] == ["10.0.0.0/8"]
+
+
+def test_range_becomes_covering_networks():
+    filter_ = Scanner.select_filter()
+
+    assert filter_.add_range_to_filter("10.0.0.0", "10.0.0.5")
+    assert filter_.render_select_query()[1]['networks'] == ["10.0.0.0/30", "10.0.0.4/31"]
+    assert not filter_.add_range_to_filter("10.0.0.5", "2001:db8::1")
+
+
+def test_every_criterion_is_one_parameterized_clause():
+    sql, params = _filter(ports=[9001, 443], countries=["de"], asns=["as24940", 16276], onion_routing=True).render_select_query()
+
+    assert "s.ports && %(ports)s::integer[]" in sql
+    assert "s.or_port IS NOT NULL" in sql
+    assert "s.country = ANY(%(countries)s::bpchar[])" in sql
+    assert "s.as_number = ANY(%(asns)s::varchar[])" in sql
+    assert sql.count(" AND ") == 3
+    assert params == {'ports': [443, 9001], 'countries': ["de"], 'asns': ["AS16276", "AS24940"]}
+    for value in ("9001", "'de'", "AS24940"):
+        assert value not in sql
+
+
+def test_onion_routing_off():
+    sql, _ = _filter(onion_routing=False).render_select_query()
+
+    assert "s.or_port IS NULL" in sql
+
+
+def test_invalid_values_are_refused():
+    filter_ = Scanner.select_filter()
+
+    assert not filter_.add_ip_to_filter("10.0.0.256")
+    assert not filter_.add_network_to_filter("10.0.0.0/33")
+    assert not filter_.add_port_to_filter(0)
+    assert not filter_.add_port_to_filter(65536)
+    assert not filter_.add_country_to_filter("deu")
+    assert not filter_.add_asn_to_filter("AS")
+    assert not filter_.add_asn_to_filter(2 ** 32)
+    assert filter_.is_empty()
+
+
+def test_page_query_continues_after_the_cursor():
+    sql, params = _filter(ports=[443]).render_page_query("10.0.0.1", 100)
+
+    assert "s.ip_addr > %(after)s::inet" in sql
+    assert sql.rstrip().endswith("ORDER BY s.ip_addr LIMIT %(limit)s::integer")
+    assert params['after'] == "10.0.0.1"
+    assert params['limit'] == 100
+
+
+def test_cache_key_ignores_the_order_filters_were_built_in():
+    first = _filter(ip_addrs=["10.0.0.1", "10.0.0.2"], networks=["10.1.0.0/25", "10.1.0.128/25"], ports=[443, 9001])
+    second = _filter(ip_addrs=["10.0.0.2", "10.0.0.1"], networks=["10.1.0.0/24"], ports=[9001, 443])
+
+    assert first.cache_key() == second.cache_key()
+    assert first.cache_key() != _filter(ports=[443]).cache_key()
+
+
+def test_filter_from_addresses():
+    filter_, invalid = Scanner.filter_from_addresses(["10.0.0.1", " ", "10.1.0.0/16", "nonsense", "10.2.0.0/40"])
+
+    assert invalid == ["nonsense", "10.2.0.0/40"]
+    assert filter_.render_select_query()[1]['networks'] == ["10.0.0.1/32", "10.1.0.0/16"]
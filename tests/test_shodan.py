@@ -0,0 +1,57 @@
+import pytest
+
+from providers.shodan import TokenBucket
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+
+    def monotonic(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr('providers.shodan.time.monotonic', clock.monotonic)
+    monkeypatch.setattr('providers.shodan.time.sleep', clock.sleep)
+    return clock
+
+
+def test_burst_is_taken_without_waiting(clock):
+    bucket = TokenBucket(rate=2.0, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+
+    assert clock.slept == []
+
+
+def test_waits_for_the_next_token(clock):
+    bucket = TokenBucket(rate=2.0, burst=1)
+    bucket.acquire()
+    bucket.acquire()
+
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_tokens_refill_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=1.0, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 60
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.slept == []
+
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(1.0)]